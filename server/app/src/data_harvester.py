@@ -1,7 +1,7 @@
 import argparse
 import os
 from reactive_s3 import ReactiveS3Index, FileMetadata
-from typing import Dict, List
+from typing import Dict, List, Set
 import time
 import nimblephysics as nimble
 from nimblephysics import absPath
@@ -16,6 +16,7 @@ import traceback
 GEOMETRY_FOLDER_PATH = absPath('../../data/Geometry')
 DATA_FOLDER_PATH = absPath('../../data')
 MIN_TRIAL_LENGTH = 15  # trials with timesteps shorter than this will be removed
+IDLE_WAKEUP_SECONDS = 60.0  # with nothing to do, we wait for PubSub messages, but still check in at least this often
 # =====================================================
 
 
@@ -298,16 +299,25 @@ class DataHarvester:
     index: ReactiveS3Index
     queue: List[SubjectSnapshot]
     datasets: List[StandardizedDataset]
+    caughtUpSubjects: Set[str]
 
-    def __init__(self, bucket: str, deployment: str, disable_pubsub: bool) -> None:
+    def __init__(self, bucket: str, deployment: str, disable_pubsub: bool, indexSnapshotPath: str = '') -> None:
         self.bucket = bucket
         self.deployment = deployment
         self.queue = []
         self.datasets = []
+        self.caughtUpSubjects = set()
         self.index = ReactiveS3Index(bucket, deployment, disable_pubsub)
-        self.index.refreshIndex()
-        if not disable_pubsub:
-            self.index.register_pub_sub()
+        # If we have a snapshot of the index from our last run, start from that, and catch up with whatever changed
+        # while we were down in the background, once we're listening for new changes
+        if len(indexSnapshotPath) > 0 and self.index.loadSnapshot(indexSnapshotPath):
+            if not disable_pubsub:
+                self.index.register_pub_sub()
+            self.index.startCatchUp()
+        else:
+            self.index.refreshIndex()
+            if not disable_pubsub:
+                self.index.register_pub_sub()
 
     def recompute_queue(self):
         start_time = time.time()
@@ -349,10 +359,28 @@ class DataHarvester:
         print('Queue updated in ' + str(time.time() - start_time) + ' seconds')
         print('Queue length: '+str(len(self.queue)))
 
+    def catch_up_subject(self, subject: SubjectSnapshot) -> bool:
+        """
+        Until the index has caught up with the bucket after starting from a snapshot, the subject we're about to copy
+        may have changed (or been deleted) while we were down, so this re-lists it from S3 once, right before we copy
+        it. This returns True if that changed anything, in which case the queue needs to be recomputed.
+        """
+        if self.index.caughtUp:
+            self.caughtUpSubjects.clear()
+            return False
+        if subject.path in self.caughtUpSubjects:
+            return False
+        self.caughtUpSubjects.add(subject.path)
+        if len(self.index.refreshFolder(subject.path)) == 0:
+            return False
+        print('Subject ' + subject.path + ' changed since the index snapshot, recomputing queue')
+        self.recompute_queue()
+        return True
+
     def process_queue_forever(self):
         """
-        This busy-waits on the queue updating, and will process the head of the queue one at a time when it
-        becomes available.
+        This waits on the queue updating, and will process the head of the queue one at a time when it becomes
+        available.
 
         While processing, this blocks, so even though the queue is updating in the background, that shouldn't change
         the outcome of this process.
@@ -376,6 +404,10 @@ class DataHarvester:
                     start_time = time.time()
                     self.recompute_queue()
                     print('[PERFORMANCE] Recomputed queue in ' + str(time.time() - start_time) + ' seconds')
+                self.index.saveSnapshotIfDue()
+
+                if len(self.queue) > 0 and self.catch_up_subject(self.queue[0]):
+                    continue
 
                 if len(self.queue) > 0:
                     print('Processing queue: ' +
@@ -404,11 +436,14 @@ class DataHarvester:
                             break
 
                     self.queue.pop(0)  # Remove the processed item from the queue
+                else:
+                    # Sleep until PubSub tells us something changed
+                    self.index.wait_for_incoming_messages(IDLE_WAKEUP_SECONDS)
 
             except Exception as e:
                 print('Caught overall processing loop exception: '+str(e))
                 traceback.print_exc()  # Print the traceback
-            time.sleep(1)
+                time.sleep(1)
 
     def copy_snashots_other_process_entry_point(self, dataset):
         """
@@ -439,10 +474,13 @@ if __name__ == "__main__":
     parser.add_argument('--disable-pubsub', type=bool,
                         default=False,
                         help='Set this to true to disable the pubsub S3 change listener')
+    parser.add_argument('--index_snapshot', type=str,
+                        default='',
+                        help='If set, the index of the bucket is saved to a snapshot at this path, and loaded from it on startup, so restarts only have to catch up with what changed instead of waiting for a full listing of the bucket.')
     args = parser.parse_args()
 
     # 1. Launch a harvesting server
-    server = DataHarvester(args.bucket, args.deployment, args.disable_pubsub)
+    server = DataHarvester(args.bucket, args.deployment, args.disable_pubsub, args.index_snapshot)
 
     # 2. Run forever
     server.process_queue_forever()
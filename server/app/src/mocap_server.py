@@ -1,5 +1,5 @@
-from typing import Dict, List
-from reactive_s3 import ReactiveS3Index, FileMetadata
+from typing import Dict, Iterator, List, Optional, Set
+from reactive_s3 import ReactiveS3Index, FileMetadata, TransferManager
 import time
 import tempfile
 import os
@@ -7,9 +7,13 @@ import sys
 import subprocess
 import uuid
 import json
+import math
+import base64
 import shutil
 import boto3
 import threading
+import queue
+import heapq
 import argparse
 from typing import Tuple, Any
 import traceback
@@ -21,6 +25,68 @@ def absPath(path: str):
     return absolute_path
 
 
+# The engine prints a line starting with this for every segment whose web results are complete, followed by a JSON
+# object with the segment folder ('path', relative to the subject folder) and the names of its 'files'. This must match
+# SEGMENT_RESULTS_READY_PREFIX in engine/src/writers/web_results_writer.py.
+SEGMENT_RESULTS_READY_PREFIX = 'SEGMENT_RESULTS_READY: '
+
+# The engine prints this line once every result except the deferred plots is written, so we can upload them while the
+# plots finish. This must match RESULTS_READY_LINE in engine/src/engine.py.
+RESULTS_READY_LINE = 'RESULTS_READY'
+
+
+# The engine pins itself to the comma separated list of CPUs in this environment variable, if it's set. This must match
+# ENGINE_CPUS_ENV_VAR in engine/src/engine.py.
+ENGINE_CPUS_ENV_VAR = 'ADDB_ENGINE_CPUS'
+
+# How long to wait after a subject finishes before we'll dispatch it again, to give S3 a chance to update our index with
+# the results of processing it.
+RECENTLY_FINISHED_COOLDOWN_SECONDS = 10.0
+
+# The processing loop sleeps until something happens that might give it work to do, but it still wakes up at least this
+# often, to keep the status file and the index snapshot fresh.
+IDLE_WAKEUP_SECONDS = 60.0
+
+# How long to wait before checking the SLURM queue again, when it was too full to queue another job.
+SLURM_QUEUE_FULL_RETRY_SECONDS = 10.0
+
+# How often to check that PubSub is alive, how long to wait for our ping to come back, and how often to check again
+# while it's down, so we get back to processing soon after it recovers.
+PUBSUB_STATUS_CHECK_SECONDS = 60.0
+PUBSUB_PING_TIMEOUT_SECONDS = 5.0
+PUBSUB_DOWN_RECHECK_SECONDS = 10.0
+
+
+def getTotalMemoryMB() -> int:
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024 * 1024)
+
+
+def shouldUploadTrialFile(file: str) -> bool:
+    # Skip the files we've already uploaded
+    if file in ['_results.json', 'preview.bin.zip', 'plot.csv']:
+        return False
+    # Skip the files we don't want to upload
+    if file.endswith('.c3d') or file.endswith('.trc') or file.endswith('.mot'):
+        return False
+    return True
+
+
+def readArchiveChecksum(archivePath: str) -> Optional[str]:
+    """
+    The engine publishes the size and SHA-256 of each archive it writes next to it, as {archive}.json. This returns
+    that checksum in the base64 form S3 uses to verify an upload, or None if it wasn't published.
+    """
+    infoPath = archivePath + '.json'
+    if not os.path.exists(infoPath):
+        return None
+    with open(infoPath) as f:
+        info = json.load(f)
+    if info['size'] != os.path.getsize(archivePath):
+        print('WARNING! ARCHIVE SIZE ' + str(os.path.getsize(archivePath)) + ' DOES NOT MATCH PUBLISHED SIZE ' +
+              str(info['size']) + ' FOR ' + archivePath, flush=True)
+    return base64.b64encode(bytes.fromhex(info['sha256'])).decode('ascii')
+
+
 class TrialToProcess:
     index: ReactiveS3Index
 
@@ -55,41 +121,46 @@ class TrialToProcess:
         self.previewBinFile = self.trialPath + 'preview.bin.zip'
         self.plotCSVFile = self.trialPath + 'plot.csv'
 
-    def download(self, trialsFolderPath: str):
+    def download(self, trialsFolderPath: str, transfers: TransferManager):
+        """
+        This queues up downloads of the trial's files on `transfers`. They're done once `transfers.wait()` returns.
+        """
         file_system_trial_path = trialsFolderPath + self.trialName
         os.mkdir(file_system_trial_path)
 
         all_children: Dict[str, FileMetadata] = self.index.getChildren(self.trialPath)
 
         if self.index.exists(self.c3dFile):
-            self.index.download(self.c3dFile, file_system_trial_path+'markers.c3d')
+            transfers.download(self.c3dFile, file_system_trial_path+'markers.c3d')
         if self.index.exists(self.trcFile):
-            self.index.download(self.trcFile, file_system_trial_path+'markers.trc')
+            transfers.download(self.trcFile, file_system_trial_path+'markers.trc')
         if self.index.exists(self.grfFile):
-            self.index.download(self.grfFile, file_system_trial_path+'grf.mot')
+            transfers.download(self.grfFile, file_system_trial_path+'grf.mot')
         if self.index.exists(self.goldIKFile):
-            self.index.download(self.goldIKFile, file_system_trial_path+'manual_ik.mot')
+            transfers.download(self.goldIKFile, file_system_trial_path+'manual_ik.mot')
         for child in all_children:
             if child.endswith('.json') or child.endswith('REVIEWED') or child.endswith('.csv'):
-                os.makedirs(os.path.dirname(file_system_trial_path+child), exist_ok=True)
-                self.index.download(self.trialPath+child, file_system_trial_path+child)
+                transfers.download(self.trialPath+child, file_system_trial_path+child)
 
-    def upload(self, trialsFolderPath: str):
+    def upload(self, trialsFolderPath: str, transfers: TransferManager,
+               alreadyUploaded: Optional[Dict[str, str]] = None):
+        """
+        This queues up uploads of the trial's results on `transfers`. They're done once `transfers.wait()` returns.
+        """
         trialPath = trialsFolderPath + self.trialName
         # Recursively list all the files in the trial folder, and upload them
         for root, dirs, files in os.walk(trialPath):
             for file in files:
-                # Skip the files we've already uploaded
-                if file in ['_results.json', 'preview.bin.zip', 'plot.csv']:
-                    continue
-                # Skip the files we don't want to upload
-                if file.endswith('.c3d') or file.endswith('.trc') or file.endswith('.mot'):
+                if not shouldUploadTrialFile(file):
                     continue
                 file_path = os.path.join(root, file)
+                # Skip the segment results we uploaded while the engine was still running
+                if alreadyUploaded is not None and os.path.normpath(file_path) in alreadyUploaded:
+                    continue
                 relative_path = file_path.replace(trialPath, '')
                 if relative_path.startswith('/'):
                     relative_path = relative_path[1:]
-                self.index.uploadFile(self.trialPath + relative_path, file_path)
+                transfers.upload(self.trialPath + relative_path, file_path)
 
     def hasMarkers(self) -> bool:
         return self.index.exists(self.c3dFile) or self.index.exists(self.trcFile)
@@ -115,6 +186,16 @@ class TrialToProcess:
         else:
             return 0
 
+    def estimateTrialSize(self) -> int:
+        """
+        The size of the trial's input files in bytes, according to the index, so this works before we download them.
+        """
+        trialSize = 0
+        for file in [self.c3dFile, self.trcFile, self.grfFile]:
+            if self.index.exists(file):
+                trialSize += self.index.getMetadata(file).size
+        return trialSize
+
     def updateTrialSize(self, trialsFolderPath: str):
         # Set the size of the trial, in bytes.
         trialPath = trialsFolderPath + self.trialName
@@ -176,6 +257,7 @@ class SubjectToProcess:
         self.resultsFile = self.subjectPath + '_results.json'
         self.errorsFile = self.subjectPath + '_errors.json'
         self.osimResults = self.subjectPath + self.subjectName + '.zip'
+        self.plotsResults = self.subjectPath + self.subjectName + '_plots.zip'
         self.pytorchResults = self.subjectPath + self.subjectName + '.b3d'
         self.pytorchDynamicsOnlyResults = self.subjectPath + self.subjectName + '_dynamics_trials_only.b3d'
         self.noDynamicsFlag = self.subjectPath + 'NO_DYNAMICS_TRIALS'
@@ -242,13 +324,30 @@ class SubjectToProcess:
         """
         self.index.delete(self.queuedOnSlurmFlagFile)
 
-    def process(self):
+    def estimateResources(self) -> Tuple[int, int]:
+        """
+        Estimate the (CPUs, MB of RAM) it takes to process this subject from the total size of its input data. This
+        uses 4GB of RAM per 25MB of subject data, with a minimum of 16GB and a maximum of 64GB in 4GB increments, and 1
+        CPU per 4GB of RAM, with a minimum of 4 CPUs and a maximum of 16 CPUs.
+        """
+        subjectSizeMB = sum(trial.estimateTrialSize() for trial in self.trials.values()) / 1024 / 1024
+        memoryMB = max(16000, min(64000, int(math.ceil(subjectSizeMB / 25)) * 4000))
+        cpus = max(4, min(16, memoryMB // 4000))
+        return cpus, memoryMB
+
+    def process(self, cpuAffinity: Optional[List[int]] = None):
         """
         This tries to download the whole set of necessary files, launch the processor, and re-upload the results,
         while also managing the processing flag age.
+
+        If `cpuAffinity` is set, the engine is pinned to those CPUs, and sizes its worker pools to match.
         """
         print('Processing Subject '+str(self.subjectPath), flush=True)
 
+        # The local paths of the segment results we upload while the engine is still running, and where they went in
+        # the bucket, so we can take them down again if the subject fails
+        uploadedSegmentFiles: Dict[str, str] = {}
+        resultsUploaded = False
         try:
             procLogTopic = str(uuid.uuid4())
 
@@ -261,17 +360,20 @@ class SubjectToProcess:
             path = tempfile.mkdtemp()
             if not path.endswith('/'):
                 path += '/'
-            self.index.download(self.subjectStatusFile, path+'_subject.json')
-            if self.index.exists(self.opensimFile):
-                self.index.download(self.opensimFile, path +
-                                    'unscaled_generic.osim')
-            if self.index.exists(self.goldscalesFile):
-                self.index.download(self.goldscalesFile,
-                                    path+'manually_scaled.osim')
             trialsFolderPath = path + 'trials/'
             os.mkdir(trialsFolderPath)
+            with TransferManager(self.index) as transfers:
+                transfers.download(self.subjectStatusFile, path+'_subject.json')
+                if self.index.exists(self.opensimFile):
+                    transfers.download(self.opensimFile, path +
+                                       'unscaled_generic.osim')
+                if self.index.exists(self.goldscalesFile):
+                    transfers.download(self.goldscalesFile,
+                                       path+'manually_scaled.osim')
+                for trialName in self.trials:
+                    self.trials[trialName].download(trialsFolderPath, transfers)
+                transfers.wait()
             for trialName in self.trials:
-                self.trials[trialName].download(trialsFolderPath)
                 self.trials[trialName].updateTrialSize(trialsFolderPath)
 
             print('Done downloading, ready to process', flush=True)
@@ -283,88 +385,134 @@ class SubjectToProcess:
             enginePath = absPath('../../engine/src/engine.py')
             print('Calling Command:\n'+enginePath+' ' +
                   path+' '+self.subjectName+' '+self.getHref(), flush=True)
-            with open(path + 'log.txt', 'wb+') as logFile:
-                with subprocess.Popen([enginePath, path, self.subjectName, self.getHref()], stdout=subprocess.PIPE, stderr=subprocess.STDOUT) as proc:
-                    print('Process created: '+str(proc.pid), flush=True)
-
-                    unflushedLines: List[str] = []
-                    lastFlushed = time.time()
-                    for lineBytes in iter(proc.stdout.readline, b''):
-                        if lineBytes is None and proc.poll() is not None:
-                            break
-                        line = lineBytes.decode("utf-8")
-                        print('>>> '+str(line).strip(), flush=True)
-                        # Send to the log
-                        logFile.write(lineBytes)
-                        # Add it to the queue
-                        unflushedLines.append(line)
-
-                        now = time.time()
-                        elapsedSeconds = now - lastFlushed
-
-                        # Only flush in bulk, and only every 3 seconds
-                        if elapsedSeconds > 3.0 and len(unflushedLines) > 0:
-                            # Send to PubSub, in packets of at most 20 lines at a time
-                            if len(unflushedLines) > 20:
-                                toSend = unflushedLines[:20]
-                                logLine: Dict[str, str] = {}
-                                logLine['lines'] = toSend
-                                logLine['timestamp'] = now * 1000
+            # 4.1. Upload each segment's web results as soon as the engine announces them, on a separate thread so
+            # that we keep draining the engine's stdout while the uploads happen
+            segmentResultsQueue: queue.Queue = queue.Queue()
+            segmentUploader = threading.Thread(target=self.uploadSegmentResults,
+                                               args=(path, segmentResultsQueue, uploadedSegmentFiles), daemon=True)
+            segmentUploader.start()
+
+            def finishSegmentUploads():
+                # Let the uploader finish the segments it has been told about, and then exit
+                segmentResultsQueue.put(None)
+                segmentUploader.join()
+
+            # 4.2. Once the engine says everything but the deferred plots is written, upload the results on another
+            # thread while the plots finish
+            resultsUploader: Optional[threading.Thread] = None
+            resultsUploadErrors: List[Exception] = []
+
+            def uploadResultsWhileEngineRuns():
+                nonlocal resultsUploaded
+                try:
+                    finishSegmentUploads()
+                    self.uploadResults(path, trialsFolderPath, uploadedSegmentFiles)
+                    resultsUploaded = True
+                except Exception as e:
+                    resultsUploadErrors.append(e)
+
+            try:
+                with open(path + 'log.txt', 'wb+') as logFile:
+                    engineEnv = os.environ.copy()
+                    if cpuAffinity is not None:
+                        engineEnv[ENGINE_CPUS_ENV_VAR] = ','.join(str(cpu) for cpu in cpuAffinity)
+                    with subprocess.Popen([enginePath, path, self.subjectName, self.getHref()], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=engineEnv) as proc:
+                        print('Process created: '+str(proc.pid), flush=True)
+
+                        unflushedLines: List[str] = []
+                        lastFlushed = time.time()
+                        for lineBytes in iter(proc.stdout.readline, b''):
+                            if lineBytes is None and proc.poll() is not None:
+                                break
+                            line = lineBytes.decode("utf-8")
+                            print('>>> '+str(line).strip(), flush=True)
+                            if line.startswith(SEGMENT_RESULTS_READY_PREFIX):
                                 try:
-                                    self.index.pubSub.publish(
-                                        '/LOG/'+procLogTopic, logLine)
-                                except Exception as e:
-                                    print(
-                                        'Failed to send live log message: '+str(e), flush=True)
-                                unflushedLines = unflushedLines[20:]
-                                # Explicitly do NOT reset lastFlushed on this branch, because we want to immediately send the next batch of lines, until we've exhausted the queue.
-                            else:
+                                    segmentResults = json.loads(line[len(SEGMENT_RESULTS_READY_PREFIX):])
+                                    segmentResultsQueue.put({'path': str(segmentResults['path']),
+                                                             'files': [str(file) for file in segmentResults['files']]})
+                                except (ValueError, KeyError, TypeError) as e:
+                                    # The files will still go up with the rest of the trial once the engine exits
+                                    print('Ignoring malformed segment results line ' + line.strip() + ': ' + str(e),
+                                          flush=True)
+                            elif line.strip() == RESULTS_READY_LINE and resultsUploader is None:
+                                resultsUploader = threading.Thread(target=uploadResultsWhileEngineRuns, daemon=True)
+                                resultsUploader.start()
+                            # Send to the log
+                            logFile.write(lineBytes)
+                            # Add it to the queue
+                            unflushedLines.append(line)
+
+                            now = time.time()
+                            elapsedSeconds = now - lastFlushed
+
+                            # Only flush in bulk, and only every 3 seconds
+                            if elapsedSeconds > 3.0 and len(unflushedLines) > 0:
+                                # Send to PubSub, in packets of at most 20 lines at a time
+                                if len(unflushedLines) > 20:
+                                    toSend = unflushedLines[:20]
+                                    logLine: Dict[str, str] = {}
+                                    logLine['lines'] = toSend
+                                    logLine['timestamp'] = now * 1000
+                                    try:
+                                        self.index.pubSub.publish(
+                                            '/LOG/'+procLogTopic, logLine)
+                                    except Exception as e:
+                                        print(
+                                            'Failed to send live log message: '+str(e), flush=True)
+                                    unflushedLines = unflushedLines[20:]
+                                    # Explicitly do NOT reset lastFlushed on this branch, because we want to immediately send the next batch of lines, until we've exhausted the queue.
+                                else:
+                                    logLine: Dict[str, str] = {}
+                                    logLine['lines'] = unflushedLines
+                                    logLine['timestamp'] = now * 1000
+                                    try:
+                                        self.index.pubSub.publish(
+                                            '/LOG/'+procLogTopic, logLine)
+                                    except Exception as e:
+                                        print(
+                                            'Failed to send live log message: '+str(e), flush=True)
+                                    unflushedLines = []
+                                    # Reset lastFlushed, because we've sent everything, and we want to wait 3 seconds before sending again.
+                                    lastFlushed = now
+                        # Wait for the process to exit
+                        exitCode = 'Failed to exit after 60 seconds'
+                        for i in range(20):
+                            try:
+                                exitCode = proc.wait(timeout=3)
+                                break
+                            except Exception as e:
+                                line = 'Process has not exited!! Waiting another 3 seconds for the process to exit.'
+                                logFile.write(line)
+                                print('>>> '+line)
+                                # Send to PubSub
                                 logLine: Dict[str, str] = {}
-                                logLine['lines'] = unflushedLines
-                                logLine['timestamp'] = now * 1000
+                                logLine['line'] = line
+                                logLine['timestamp'] = time.time() * 1000
                                 try:
                                     self.index.pubSub.publish(
                                         '/LOG/'+procLogTopic, logLine)
                                 except Exception as e:
-                                    print(
-                                        'Failed to send live log message: '+str(e), flush=True)
-                                unflushedLines = []
-                                # Reset lastFlushed, because we've sent everything, and we want to wait 3 seconds before sending again.
-                                lastFlushed = now
-                    # Wait for the process to exit
-                    exitCode = 'Failed to exit after 60 seconds'
-                    for i in range(20):
+                                    print('Failed to send live log message: ' +
+                                          str(e), flush=True)
+                        line = 'exit: '+str(exitCode)
+                        # Send to the log
+                        logFile.write(line.encode("utf-8"))
+                        # Send to PubSub
+                        logLine: Dict[str, str] = {}
+                        logLine['line'] = line
+                        logLine['timestamp'] = time.time() * 1000
                         try:
-                            exitCode = proc.wait(timeout=3)
-                            break
+                            self.index.pubSub.publish(
+                                '/LOG/'+procLogTopic, logLine)
                         except Exception as e:
-                            line = 'Process has not exited!! Waiting another 3 seconds for the process to exit.'
-                            logFile.write(line)
-                            print('>>> '+line)
-                            # Send to PubSub
-                            logLine: Dict[str, str] = {}
-                            logLine['line'] = line
-                            logLine['timestamp'] = time.time() * 1000
-                            try:
-                                self.index.pubSub.publish(
-                                    '/LOG/'+procLogTopic, logLine)
-                            except Exception as e:
-                                print('Failed to send live log message: ' +
-                                      str(e), flush=True)
-                    line = 'exit: '+str(exitCode)
-                    # Send to the log
-                    logFile.write(line.encode("utf-8"))
-                    # Send to PubSub
-                    logLine: Dict[str, str] = {}
-                    logLine['line'] = line
-                    logLine['timestamp'] = time.time() * 1000
-                    try:
-                        self.index.pubSub.publish(
-                            '/LOG/'+procLogTopic, logLine)
-                    except Exception as e:
-                        print('Failed to send live log message: ' +
-                              str(e), flush=True)
-                    print('Process return code: '+str(exitCode), flush=True)
+                            print('Failed to send live log message: ' +
+                                  str(e), flush=True)
+                        print('Process return code: '+str(exitCode), flush=True)
+            finally:
+                finishSegmentUploads()
+                if resultsUploader is not None:
+                    resultsUploader.join()
 
             # 5. Upload the results back to S3
             if os.path.exists(path + 'log.txt'):
@@ -373,42 +521,22 @@ class SubjectToProcess:
                 print('WARNING! FILE NOT UPLOADED BECAUSE FILE NOT FOUND! ' +
                       self.logfile, flush=True)
 
-            if exitCode == 0:
-                for trialName in self.trials:
-                    self.trials[trialName].upload(trialsFolderPath)
-                # 5.1. Upload the downloadable {self.subjectName}.zip file
-                if os.path.exists(path + self.subjectName + '.zip'):
-                    self.index.uploadFile(
-                        self.osimResults, path + self.subjectName + '.zip')
-                else:
-                    print('WARNING! FILE NOT UPLOADED BECAUSE FILE NOT FOUND! ' +
-                          path + self.subjectName + '.zip', flush=True)
-                # 5.1.2. Upload the downloadable {self.subjectName}.b3d file, which can be loaded into PyTorch loaders
-                if os.path.exists(path + self.subjectName + '.b3d'):
-                    self.index.uploadFile(
-                        self.pytorchResults, path + self.subjectName + '.b3d')
-                if os.path.exists(path + self.subjectName + '_dynamics_trials_only.b3d'):
+            if resultsUploader is not None and len(resultsUploadErrors) > 0:
+                raise resultsUploadErrors[0]
+            if resultsUploader is not None and exitCode != 0:
+                # The results were complete and are already up, so only the deferred plots are missing
+                print('WARNING! The engine exited with code ' + str(exitCode) + ' after its results were uploaded, '
+                      'so the deferred plots may be missing.', flush=True)
+
+            if exitCode == 0 or resultsUploader is not None:
+                if resultsUploader is None:
+                    self.uploadResults(path, trialsFolderPath, uploadedSegmentFiles)
+                    resultsUploaded = True
+                # 5.3. Upload the plots last, if the engine generated them separately from the main zip
+                if os.path.exists(path + self.subjectName + '_plots.zip'):
                     self.index.uploadFile(
-                        self.pytorchDynamicsOnlyResults, path + self.subjectName + '_dynamics_trials_only.b3d')
-                if os.path.exists(path + 'NO_DYNAMICS_TRIALS'):
-                    self.index.uploadFile(
-                        self.noDynamicsFlag, path + 'NO_DYNAMICS_TRIALS')
-
-                # 5.2. Upload the _results.json file last, since that marks the trial as DONE on the frontend,
-                # and it starts to be able
-                if os.path.exists(path + '_results.json'):
-                    self.index.uploadFile(
-                        self.resultsFile, path + '_results.json')
-                    # Load the results file, and look for the 'linearResidual' field to indicate that there was dynamics
-                    # in the model. If there was, then we need to upload a DYNAMICS flag to the frontend to make it
-                    # easier to sort datasets by whether they have dynamics or not.
-                    with open(path + '_results.json') as results:
-                        resultsJson = json.loads(results.read())
-                        if 'linearResidual' in resultsJson:
-                            self.index.uploadText(self.dynamicsFlagFile, '')
-                else:
-                    print('WARNING! FILE NOT UPLOADED BECAUSE FILE NOT FOUND! ' +
-                          path + '_results.json', flush=True)
+                        self.plotsResults, path + self.subjectName + '_plots.zip',
+                        checksumSHA256=readArchiveChecksum(path + self.subjectName + '_plots.zip'))
 
                 with open(path+'_subject.json') as subj:
                     subjectJson = json.loads(subj.read())
@@ -443,6 +571,7 @@ class SubjectToProcess:
                 # 6. Clean up after ourselves
                 shutil.rmtree(path, ignore_errors=True)
             else:
+                self.deleteSegmentResults(uploadedSegmentFiles)
                 if os.path.exists(path + '_errors.json'):
                     self.index.uploadFile(
                         self.errorsFile, path + '_errors.json')
@@ -463,6 +592,9 @@ class SubjectToProcess:
             print('Caught exception in process(): {}'.format(e))
             traceback.print_exc()
 
+            if not resultsUploaded:
+                self.deleteSegmentResults(uploadedSegmentFiles)
+
             # TODO: We should probably re-upload a copy of the whole setup that led to the error
             # Let's upload a unique copy of the log to S3, so that we have it in case the user re-processes
             if os.path.exists(path + 'log.txt'):
@@ -472,6 +604,88 @@ class SubjectToProcess:
             # This uploads the ERROR flag
             self.pushError(1)
 
+    def uploadResults(self, path: str, trialsFolderPath: str, uploadedSegmentFiles: Dict[str, str]):
+        """
+        Upload everything the engine wrote except the deferred plots, finishing with the _results.json file.
+        """
+        # Everything up to the _results.json goes up concurrently
+        with TransferManager(self.index) as transfers:
+            for trialName in self.trials:
+                self.trials[trialName].upload(trialsFolderPath, transfers, uploadedSegmentFiles)
+            # 5.1. Upload the downloadable {self.subjectName}.zip file
+            if os.path.exists(path + self.subjectName + '.zip'):
+                transfers.upload(
+                    self.osimResults, path + self.subjectName + '.zip',
+                    checksumSHA256=readArchiveChecksum(path + self.subjectName + '.zip'))
+                if os.path.exists(path + self.subjectName + '.zip.json'):
+                    transfers.upload(
+                        self.osimResults + '.json', path + self.subjectName + '.zip.json')
+            else:
+                print('WARNING! FILE NOT UPLOADED BECAUSE FILE NOT FOUND! ' +
+                      path + self.subjectName + '.zip', flush=True)
+            # 5.1.2. Upload the downloadable {self.subjectName}.b3d file, which can be loaded into PyTorch loaders
+            if os.path.exists(path + self.subjectName + '.b3d'):
+                transfers.upload(
+                    self.pytorchResults, path + self.subjectName + '.b3d')
+            if os.path.exists(path + self.subjectName + '_dynamics_trials_only.b3d'):
+                transfers.upload(
+                    self.pytorchDynamicsOnlyResults, path + self.subjectName + '_dynamics_trials_only.b3d')
+            if os.path.exists(path + 'NO_DYNAMICS_TRIALS'):
+                transfers.upload(
+                    self.noDynamicsFlag, path + 'NO_DYNAMICS_TRIALS')
+            transfers.wait()
+
+        # 5.2. Upload the _results.json file last, since that marks the trial as DONE on the frontend,
+        # and it starts to be able
+        if os.path.exists(path + '_results.json'):
+            self.index.uploadFile(
+                self.resultsFile, path + '_results.json')
+            # Load the results file, and look for the 'linearResidual' field to indicate that there was dynamics
+            # in the model. If there was, then we need to upload a DYNAMICS flag to the frontend to make it
+            # easier to sort datasets by whether they have dynamics or not.
+            with open(path + '_results.json') as results:
+                resultsJson = json.loads(results.read())
+                if 'linearResidual' in resultsJson:
+                    self.index.uploadText(self.dynamicsFlagFile, '')
+        else:
+            print('WARNING! FILE NOT UPLOADED BECAUSE FILE NOT FOUND! ' +
+                  path + '_results.json', flush=True)
+
+    def uploadSegmentResults(self, path: str, segmentResultsQueue: queue.Queue, uploadedFiles: Dict[str, str]):
+        """
+        Upload the segment results announced on `segmentResultsQueue` until it yields None, recording the local path of
+        each file that made it in `uploadedFiles`, along with its path in the bucket. Anything that fails to upload
+        here just gets uploaded with the rest of the trial files once the engine exits.
+        """
+        while True:
+            segmentResults = segmentResultsQueue.get()
+            if segmentResults is None:
+                return
+            for file in segmentResults['files']:
+                if not shouldUploadTrialFile(file):
+                    continue
+                localPath = os.path.normpath(path + segmentResults['path'] + file)
+                try:
+                    bucketPath = self.subjectPath + segmentResults['path'] + file
+                    self.index.uploadFile(bucketPath, localPath)
+                    uploadedFiles[localPath] = bucketPath
+                except Exception as e:
+                    print('Failed to upload segment results file ' + localPath + ', will retry once processing '
+                          'finishes: ' + str(e), flush=True)
+
+    def deleteSegmentResults(self, uploadedFiles: Dict[str, str]):
+        """
+        Take down the segment results we uploaded while the engine was running, once the subject has failed, so that
+        it isn't left with half a set of results next to its ERROR flag.
+        """
+        for localPath, bucketPath in uploadedFiles.items():
+            try:
+                # The index may not have heard about these uploads yet, so don't let it skip them
+                self.index.delete(bucketPath, onlyIfIndexed=False)
+            except Exception as e:
+                print('Failed to delete segment results file ' + bucketPath + ': ' + str(e), flush=True)
+        uploadedFiles.clear()
+
     def pushProcessingFlag(self, procLogTopic: str):
         procData: Dict[str, str] = {}
         procData['logTopic'] = procLogTopic
@@ -556,10 +770,101 @@ class SubjectToProcess:
         return self.subjectPath + "::" + self.trialName + " uploaded @" + str(self.latestInputTimestamp())
 
 
+class SubjectQueue:
+    """
+    The subjects that should be processed, in the order we want to process them. First we prioritize subjects that are
+    not just copies in the "standardized" bucket, then we go oldest to newest.
+
+    Subjects are added, moved and removed one at a time as their files change. The order is kept in a heap, and entries
+    that get moved or removed are just marked stale and skipped over, so every update is O(log n).
+    """
+    heap: List[Tuple[bool, int, str]]
+    entries: Dict[str, Tuple[Tuple[bool, int, str], SubjectToProcess]]
+    # Bumped whenever a subject is added, moved or removed, so callers can tell if ordered() would have changed
+    version: int
+
+    def __init__(self) -> None:
+        self.heap = []
+        self.entries = {}
+        self.version = 0
+
+    @staticmethod
+    def getSortKey(subject: SubjectToProcess) -> Tuple[bool, int, str]:
+        # The path breaks ties, so the order is deterministic
+        return subject.subjectPath.startswith("standardized"), subject.latestInputTimestamp(), subject.subjectPath
+
+    def add(self, subject: SubjectToProcess) -> None:
+        """
+        This adds a subject to the queue, or moves it to its new spot if it's already queued.
+        """
+        sortKey = SubjectQueue.getSortKey(subject)
+        existing = self.entries.get(subject.subjectPath)
+        self.entries[subject.subjectPath] = (sortKey, subject)
+        if existing is None or existing[0] != sortKey:
+            heapq.heappush(self.heap, sortKey)
+            self.version += 1
+            self.compact()
+
+    def remove(self, subjectPath: str) -> None:
+        if subjectPath in self.entries:
+            del self.entries[subjectPath]
+            self.version += 1
+            self.compact()
+
+    def peek(self) -> Optional[SubjectToProcess]:
+        """
+        This returns the subject at the head of the queue, or None if the queue is empty.
+        """
+        while len(self.heap) > 0:
+            sortKey = self.heap[0]
+            entry = self.entries.get(sortKey[2])
+            if entry is not None and entry[0] == sortKey:
+                return entry[1]
+            heapq.heappop(self.heap)
+        return None
+
+    def iterate(self) -> Iterator[SubjectToProcess]:
+        """
+        This yields the queued subjects in processing order, popping them off a copy of the heap one at a time, so
+        callers that only need the first few subjects don't pay to sort the whole queue. The queue must not change
+        while this is being iterated.
+        """
+        heap = list(self.heap)
+        seen: Set[str] = set()
+        while len(heap) > 0:
+            sortKey = heapq.heappop(heap)
+            entry = self.entries.get(sortKey[2])
+            # Skip stale entries, and repeats from a subject that moved away from this spot and back again
+            if entry is None or entry[0] != sortKey or sortKey[2] in seen:
+                continue
+            seen.add(sortKey[2])
+            yield entry[1]
+
+    def ordered(self) -> List[SubjectToProcess]:
+        """
+        This returns all the queued subjects, in processing order.
+        """
+        # Copy the entries first, since the status file is written from other threads while the queue updates
+        entries = list(self.entries.values())
+        return [subject for sortKey, subject in sorted(entries, key=lambda entry: entry[0])]
+
+    def compact(self) -> None:
+        # Once the heap is mostly stale entries, rebuild it from the live ones
+        if len(self.heap) > 2 * len(self.entries) + 16:
+            self.heap = [sortKey for sortKey, subject in self.entries.values()]
+            heapq.heapify(self.heap)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, subjectPath: str) -> bool:
+        return subjectPath in self.entries
+
+
 class MocapServer:
     index: ReactiveS3Index
     currentlyProcessing: SubjectToProcess
-    queue: List[SubjectToProcess]
+    queue: SubjectQueue
     bucket: str
     deployment: str
     singularity_image_path: str
@@ -569,30 +874,78 @@ class MocapServer:
     pingId: str
     lastUploadedStatusStr: str
     lastUploadedStatusTimestamp: float
+    lastUploadedQueue: Optional[SubjectQueue]
+    lastUploadedQueueVersion: int
 
     pubSubIsAlive: bool
 
-    def __init__(self, bucket: str, deployment: str, singularity_image_path: str) -> None:
+    # Worker pool mode, where we process several subjects at once on this machine, each pinned to its own CPUs
+    workers: int
+    cpuBudget: int
+    memoryBudgetMB: int
+    freeCpus: Set[int]
+    freeMemoryMB: int
+    inFlight: Dict[str, Tuple[SubjectToProcess, List[int], int]]
+    caughtUpSubjects: Set[str]
+    pingReceived: threading.Event
+    nextSlurmQueueCheck: float
+    recentlyFinished: Dict[str, float]
+    workerLock: threading.Lock
+    statusLock: threading.Lock
+
+    def __init__(self, bucket: str, deployment: str, singularity_image_path: str, workers: int = 1,
+                 cpuBudget: int = 0, memoryBudgetMB: int = 0, indexSnapshotPath: str = '') -> None:
         self.bucket = bucket
         self.deployment = deployment
         self.singularity_image_path = singularity_image_path
-        self.queue = []
+        self.queue = SubjectQueue()
         self.currentlyProcessing = None
 
+        # Set up the worker pool. A budget of 0 means we get to use everything the machine has.
+        self.workers = workers
+        if hasattr(os, 'sched_getaffinity'):
+            availableCpus = sorted(os.sched_getaffinity(0))
+        else:
+            availableCpus = list(range(os.cpu_count() or 1))
+        if cpuBudget > 0:
+            availableCpus = availableCpus[:cpuBudget]
+        self.cpuBudget = len(availableCpus)
+        self.memoryBudgetMB = memoryBudgetMB if memoryBudgetMB > 0 else getTotalMemoryMB()
+        self.freeCpus = set(availableCpus)
+        self.freeMemoryMB = self.memoryBudgetMB
+        self.inFlight = {}
+        self.recentlyFinished = {}
+        self.workerLock = threading.Lock()
+        self.statusLock = threading.Lock()
+        if self.workers > 1:
+            print('Running a pool of ' + str(self.workers) + ' workers, with a budget of ' + str(self.cpuBudget) +
+                  ' CPUs and ' + str(self.memoryBudgetMB) + 'MB of RAM')
+
         # Set up for status reporting
         self.serverId = str(uuid.uuid4())
         print('Booting as server ID: '+self.serverId)
         self.lastUploadedStatusStr = ''
         self.lastUploadedStatusTimestamp = 0
+        self.lastUploadedQueue = None
+        self.lastUploadedQueueVersion = 0
+        self.nextSlurmQueueCheck = 0.0
 
-        # Set up index
+        # Set up index. If we have a snapshot of it from our last run, we can start from that, and catch up with
+        # whatever changed while we were down in the background. We register for PubSub first, so we don't miss
+        # anything that changes while we catch up.
         self.index = ReactiveS3Index(bucket, deployment)
-        self.index.refreshIndex()
-        self.index.register_pub_sub()
+        self.caughtUpSubjects = set()
+        if len(indexSnapshotPath) > 0 and self.index.loadSnapshot(indexSnapshotPath):
+            self.index.register_pub_sub()
+            self.index.startCatchUp()
+        else:
+            self.index.refreshIndex()
+            self.index.register_pub_sub()
         self.pubSubIsAlive = True
 
         # Subscribe to PubSub status checks.
         self.pingId = str(self.serverId[:16]).replace('-', '')
+        self.pingReceived = threading.Event()
         self.index.pubSub.subscribe("/PING/" + self.pingId, self.on_pub_sub_status_received)
 
         pubsub_status_thread = threading.Thread(
@@ -602,78 +955,138 @@ class MocapServer:
     def recompute_queue(self):
         start_time = time.time()
 
-        should_process_subjects: List[SubjectToProcess] = []
+        should_process_subjects = SubjectQueue()
 
         # 1. Collect all Trials
         for folder in self.index.listAllFolders():
-            if self.index.hasChildren(folder, ['trials/', '_subject.json']):
-                if not folder.endswith('/'):
-                    folder += '/'
+            if not folder.endswith('/'):
+                folder += '/'
+            if self.is_subject_folder(folder):
                 subject = SubjectToProcess(self.index, folder)
                 if subject.shouldProcess():
-                    should_process_subjects.append(subject)
+                    should_process_subjects.add(subject)
 
-        # 2. Sort Trials. First we prioritize subjects that are not just copies in the "standardized" bucket, then
-        # we sort oldest to newest. The sort method gets passed a Tuple, which goes left to right, True before False,
-        # and low to high.
-        should_process_subjects.sort(key=lambda x: (
-            x.subjectPath.startswith("standardized"), x.latestInputTimestamp()))
-
-        # 3. Update the queue. There's another thread that busy-waits on the queue changing, that can then grab a queue entry and continue
+        # 2. Update the queue. There's another thread that busy-waits on the queue changing, that can then grab a
+        # queue entry and continue
         self.queue = should_process_subjects
 
         print('Queue updated in ' + str(time.time() - start_time) + ' seconds')
-        print('Queue length: '+str(len(self.queue)))
-        if len(self.queue) > 0:
-            print('Queue head: '+str(self.queue[0].subjectPath))
+        self.print_queue_summary()
 
-        # 4. Update status file
+        # 3. Update status file
         self.update_status_file()
 
+    def update_queue(self, subjectFolders: Set[str]):
+        """
+        This updates the queue for just the subject folders in `subjectFolders` (the ones the index reports as touched
+        by changes), rather than rescanning the whole index like recompute_queue().
+        """
+        start_time = time.time()
+        for folder in subjectFolders:
+            if self.is_subject_folder(folder):
+                subject = SubjectToProcess(self.index, folder)
+                if subject.shouldProcess():
+                    self.queue.add(subject)
+                    continue
+            self.queue.remove(folder)
+
+        print('Queue updated for ' + str(len(subjectFolders)) + ' subjects in ' + str(time.time() - start_time) +
+              ' seconds')
+        self.print_queue_summary()
+        self.update_status_file()
+
+    def is_subject_folder(self, folder: str) -> bool:
+        return self.index.exists(folder + '_subject.json') and self.index.folderExists(folder + 'trials/')
+
+    def catch_up_subject(self, subject: SubjectToProcess) -> bool:
+        """
+        Until the index has caught up with the bucket after starting from a snapshot, the subject we're about to
+        process may have changed (or been processed by someone else) while we were down, so this re-lists it from S3
+        once, right before we process it. This returns True if that changed the queue, in which case the caller should
+        pick its next subject again.
+        """
+        if self.index.caughtUp:
+            self.caughtUpSubjects.clear()
+            return False
+        if subject.subjectPath in self.caughtUpSubjects:
+            return False
+        self.caughtUpSubjects.add(subject.subjectPath)
+        changedKeys = self.index.refreshFolder(subject.subjectPath)
+        if len(changedKeys) == 0:
+            return False
+        print('Subject ' + subject.subjectPath + ' changed since the index snapshot, updating queue')
+        self.update_queue(self.index.getSubjectFolders(changedKeys))
+        return True
+
+    def print_queue_summary(self):
+        print('Queue length: '+str(len(self.queue)))
+        head = self.queue.peek()
+        if head is not None:
+            print('Queue head: '+str(head.subjectPath))
+
     def update_status_file(self):
         """
-        This writes an updated version of our status file to S3, if anything has changed since our last write
+        This writes an updated version of our status file to S3, if anything has changed since our last write. The
+        queue is only listed out in order when we actually upload, since that means sorting the whole thing.
         """
+        with self.workerLock:
+            inFlight = [{'path': subjectPath, 'cpus': len(cpus), 'memoryMB': memoryMB}
+                        for subjectPath, (subject, cpus, memoryMB) in self.inFlight.items()]
         status: Dict[str, Any] = {}
         if self.currentlyProcessing is not None:
             status['currently_processing'] = self.currentlyProcessing.subjectPath
+        elif len(inFlight) > 0:
+            status['currently_processing'] = inFlight[0]['path']
         else:
             status['currently_processing'] = 'none'
-        status['job_queue'] = [x.subjectPath for x in self.queue]
+        status['in_flight'] = inFlight
         statusStr: str = json.dumps(status)
-
-        currentTimestamp = time.time()
-        elapsedSinceUpload = currentTimestamp - self.lastUploadedStatusTimestamp
-
-        if (statusStr != self.lastUploadedStatusStr) or (elapsedSinceUpload > 60):
-            self.lastUploadedStatusStr = statusStr
-            self.lastUploadedStatusTimestamp = currentTimestamp
-            self.index.uploadText(
-                'protected/server_status/'+self.serverId, statusStr)
-            print('Uploaded updated status file')
+        queue = self.queue
+        queueVersion = queue.version
+
+        # The worker threads update the status too, as their subjects finish
+        with self.statusLock:
+            currentTimestamp = time.time()
+            elapsedSinceUpload = currentTimestamp - self.lastUploadedStatusTimestamp
+
+            queueChanged = queue is not self.lastUploadedQueue or queueVersion != self.lastUploadedQueueVersion
+            if (statusStr != self.lastUploadedStatusStr) or queueChanged or (elapsedSinceUpload > 60):
+                self.lastUploadedStatusStr = statusStr
+                self.lastUploadedStatusTimestamp = currentTimestamp
+                self.lastUploadedQueue = queue
+                self.lastUploadedQueueVersion = queueVersion
+                status['job_queue'] = [x.subjectPath for x in queue.ordered()]
+                self.index.uploadText(
+                    'protected/server_status/'+self.serverId, json.dumps(status))
+                print('Uploaded updated status file')
 
     def on_pub_sub_status_received(self, topic: str, payload: bytes):
         print(f'Received PubSub status update on server {self.serverId}')
         self.index.pubSub.alive = True
+        self.pingReceived.set()
 
     def check_pub_sub_status_forever(self):
         while True:
             # First, assume that PubSub is down.
             self.index.pubSub.alive = False
+            self.pingReceived.clear()
 
-            # Send a status update message and wait a few seconds.
+            # Send a status update message and wait for it to come back, for up to a few seconds.
             print('Sending /PING/'+self.pingId)
             self.index.pubSub.publish('/PING/'+self.pingId, {'test': True})
-            time.sleep(5)
+            self.pingReceived.wait(PUBSUB_PING_TIMEOUT_SECONDS)
 
             # If we didn't get a response, then PubSub is down.
             if self.index.pubSub.alive:
-                self.pubSubIsAlive = True
+                if not self.pubSubIsAlive:
+                    self.pubSubIsAlive = True
+                    # The processing loop holds off while PubSub is down, so let it know it can get going again
+                    self.index.wake_up()
+                time.sleep(PUBSUB_STATUS_CHECK_SECONDS)
             else:
                 print('PubSub is down!')
                 self.pubSubIsAlive = False
-
-            time.sleep(60)
+                time.sleep(PUBSUB_DOWN_RECHECK_SECONDS)
 
     def get_slurm_job_queue_len(self) -> Tuple[int, int]:
         """
@@ -697,9 +1110,106 @@ class MocapServer:
             print('Failed to get SLURM job queue length: '+str(e))
             return 0, 0
 
+    def dispatch_local_subjects(self) -> int:
+        """
+        In worker pool mode, this starts processing subjects from the head of the queue on background threads, for as
+        long as there are free workers and enough of the CPU and memory budgets left for the next subject's estimated
+        needs. It returns the number of subjects it started.
+        """
+        started = 0
+        with self.workerLock:
+            if len(self.inFlight) >= self.workers:
+                return started
+        self.expire_recently_finished()
+        for subject in self.queue.iterate():
+            with self.workerLock:
+                if len(self.inFlight) >= self.workers:
+                    break
+                if subject.subjectPath in self.inFlight or subject.subjectPath in self.recentlyFinished:
+                    continue
+            if self.catch_up_subject(subject):
+                # The queue changed under us, so go around again and pick from the updated queue
+                self.index.wake_up()
+                break
+            cpus, memoryMB = subject.estimateResources()
+            # A subject that needs more than our whole budget still gets to run, it just has to run alone
+            cpus = min(cpus, self.cpuBudget)
+            memoryMB = min(memoryMB, self.memoryBudgetMB)
+            with self.workerLock:
+                if cpus > len(self.freeCpus) or memoryMB > self.freeMemoryMB:
+                    # Wait for room rather than skipping ahead, so smaller subjects further back in the queue can't
+                    # starve the one at the front
+                    break
+                allocatedCpus = sorted(self.freeCpus)[:cpus]
+                self.freeCpus.difference_update(allocatedCpus)
+                self.freeMemoryMB -= memoryMB
+                self.inFlight[subject.subjectPath] = (subject, allocatedCpus, memoryMB)
+            print('Starting to process subject ' + subject.subjectPath + ' on ' + str(cpus) + ' CPUs with ' +
+                  str(memoryMB) + 'MB of RAM reserved')
+            worker = threading.Thread(target=self.process_local_subject,
+                                      args=(subject, allocatedCpus, memoryMB), daemon=True)
+            worker.start()
+            started += 1
+        if started > 0:
+            self.update_status_file()
+        return started
+
+    def expire_recently_finished(self):
+        """
+        This forgets about subjects that finished long enough ago that S3 has caught up with them.
+        """
+        now = time.time()
+        with self.workerLock:
+            self.recentlyFinished = {subjectPath: finishedTime for subjectPath, finishedTime in
+                                     self.recentlyFinished.items()
+                                     if now - finishedTime < RECENTLY_FINISHED_COOLDOWN_SECONDS}
+
+    def next_subject_to_process(self) -> Optional[SubjectToProcess]:
+        """
+        This returns the first subject in the queue, skipping over any that only just finished, since S3 may not have
+        caught up with their results yet.
+        """
+        self.expire_recently_finished()
+        for subject in self.queue.iterate():
+            if subject.subjectPath not in self.recentlyFinished:
+                return subject
+        return None
+
+    def wait_for_work(self):
+        """
+        This blocks until there might be something new to do: PubSub messages arrive, a worker finishes, PubSub comes
+        back up, or the next deadline passes (a finished subject's cooldown running out, or the time to check a full
+        SLURM queue again).
+        """
+        self.expire_recently_finished()
+        now = time.time()
+        deadline = now + IDLE_WAKEUP_SECONDS
+        with self.workerLock:
+            for finishedTime in self.recentlyFinished.values():
+                deadline = min(deadline, finishedTime + RECENTLY_FINISHED_COOLDOWN_SECONDS)
+        if self.nextSlurmQueueCheck > now:
+            deadline = min(deadline, self.nextSlurmQueueCheck)
+        self.index.wait_for_incoming_messages(max(0.0, deadline - now))
+
+    def process_local_subject(self, subject: SubjectToProcess, cpus: List[int], memoryMB: int):
+        start_time = time.time()
+        try:
+            subject.process(cpus)
+        finally:
+            with self.workerLock:
+                del self.inFlight[subject.subjectPath]
+                self.freeCpus.update(cpus)
+                self.freeMemoryMB += memoryMB
+                self.recentlyFinished[subject.subjectPath] = time.time()
+            # There's room for another subject now
+            self.index.wake_up()
+            self.update_status_file()
+            print('[PERFORMANCE] Processed subject ' + subject.subjectPath + ' in ' + str(time.time() - start_time) +
+                  ' seconds')
+
     def process_queue_forever(self):
         """
-        This busy-waits on the queue updating, and will process the head of the queue one at a time when it becomes available.
+        This waits on the queue updating, and will process the head of the queue one at a time when it becomes available.
 
         While processing, this blocks, so even though the queue is updating in the background, that shouldn't change the outcome of this process.
         """
@@ -715,18 +1225,30 @@ class MocapServer:
                 # checked.
                 print('Processing incoming messages...')
                 start_time = time.time()
-                any_changed = self.index.process_incoming_messages()
+                touchedSubjectFolders: Set[str] = set()
+                any_changed = self.index.process_incoming_messages(touchedSubjectFolders=touchedSubjectFolders)
                 print('[PERFORMANCE] Processed incoming messages in ' + str(time.time() - start_time) + ' seconds')
                 if any_changed:
-                    print('Incoming messages changed the state of the index, recomputing queue')
+                    print('Incoming messages changed the state of the index, updating queue')
                     start_time = time.time()
-                    self.recompute_queue()
-                    print('[PERFORMANCE] Recomputed queue in ' + str(time.time() - start_time) + ' seconds')
+                    self.update_queue(touchedSubjectFolders)
+                    print('[PERFORMANCE] Updated queue in ' + str(time.time() - start_time) + ' seconds')
+                self.index.saveSnapshotIfDue()
+
+                # In worker pool mode, the subjects are processed on their own threads, so we only dispatch them here
+                if len(self.singularity_image_path) == 0 and self.workers > 1:
+                    if self.pubSubIsAlive:
+                        self.dispatch_local_subjects()
+                    self.wait_for_work()
+                    continue
 
-                if len(self.queue) > 0 and self.pubSubIsAlive:
+                nextSubject = self.next_subject_to_process() if self.pubSubIsAlive else None
+                if nextSubject is not None and time.time() >= self.nextSlurmQueueCheck:
+                    if self.catch_up_subject(nextSubject):
+                        continue
                     start_time = time.time()
 
-                    self.currentlyProcessing = self.queue[0]
+                    self.currentlyProcessing = nextSubject
                     self.update_status_file()
 
                     # This will update the state of S3, which will in turn update and remove this element from our
@@ -734,6 +1256,7 @@ class MocapServer:
                     # process again. So the key idea is DON'T MANUALLY MANAGE THE WORK QUEUE! That happens in
                     # self.onChange()
 
+                    queueFull = False
                     if len(self.singularity_image_path) > 0:
                         reprocessing_job: bool = self.currentlyProcessing.subjectPath.startswith('standardized')
 
@@ -791,24 +1314,25 @@ class MocapServer:
                         else:
                             print(
                                 'Not queueing subject for processing on SLURM, because the queue is too long. Waiting for some jobs to finish')
+                            queueFull = True
+                            self.nextSlurmQueueCheck = time.time() + SLURM_QUEUE_FULL_RETRY_SECONDS
                     else:
                         # Launch the subject as a normal process on this local machine
                         self.currentlyProcessing.process()
 
+                    # We need to avoid race conditions with S3 by not immediately processing this subject again. Give
+                    # S3 a chance to update, while we get on with the rest of the queue.
+                    if not queueFull:
+                        with self.workerLock:
+                            self.recentlyFinished[self.currentlyProcessing.subjectPath] = time.time()
+
                     # This helps our status thread to keep track of what we're doing
                     self.currentlyProcessing = None
                     self.update_status_file()
 
                     print('[PERFORMANCE] Processed subject in ' + str(time.time() - start_time) + ' seconds')
-
-                    # We need to avoid race conditions with S3 by not immediately processing the next item. Give S3 a
-                    # chance to update.
-                    print(
-                        'Sleeping for 10 seconds before attempting to process the next item...')
-                    time.sleep(10)
-                    print('Done sleeping')
                 else:
-                    time.sleep(1)
+                    self.wait_for_work()
             except Exception as e:
                 print(
                     'Encountered an error!!! Sleeping for 10 seconds, then re-entering the processing loop')
@@ -827,6 +1351,18 @@ if __name__ == "__main__":
     parser.add_argument('--singularity_image_path', type=str,
                         default='',
                         help='If set, this assumes we are running as a SLURM job, and will process subjects by launching child SLURM jobs that use a singularity image to run the processing server.')
+    parser.add_argument('--workers', type=int,
+                        default=1,
+                        help='When processing subjects on this machine (without a singularity image), the maximum number of subjects to process at once.')
+    parser.add_argument('--cpu_budget', type=int,
+                        default=0,
+                        help='With more than one worker, the number of CPUs to share between the subjects being processed. Defaults to all the CPUs available to the server.')
+    parser.add_argument('--memory_budget_mb', type=int,
+                        default=0,
+                        help='With more than one worker, the MB of RAM to share between the subjects being processed, based on their estimated needs. Defaults to all the RAM on the machine.')
+    parser.add_argument('--index_snapshot', type=str,
+                        default='',
+                        help='If set, the index of the bucket is saved to a snapshot at this path, and loaded from it on startup, so restarts only have to catch up with what changed instead of waiting for a full listing of the bucket.')
     args = parser.parse_args()
 
     subjectPath = os.getenv('PROCESS_SUBJECT_S3_PATH', '')
@@ -845,7 +1381,9 @@ if __name__ == "__main__":
 
         # 1. Launch a processing server
         server = MocapServer(args.bucket, args.deployment,
-                             args.singularity_image_path)
+                             args.singularity_image_path, args.workers,
+                             args.cpu_budget, args.memory_budget_mb,
+                             args.index_snapshot)
 
         # 2. Run forever
         server.process_queue_forever()
@@ -1 +1,2 @@
 from .reactive_s3_index import ReactiveS3Index, FileMetadata
+from .transfer_manager import TransferManager
@@ -0,0 +1,68 @@
+import os
+import time
+import sqlite3
+from typing import List, Iterable, Optional, Tuple
+
+# Bump this whenever the layout of the snapshot changes, so old snapshots get ignored rather than misread
+SNAPSHOT_FORMAT_VERSION = 1
+
+# A file in the snapshot, as (key, lastModified, size, eTag)
+SnapshotRow = Tuple[str, int, int, str]
+
+
+def writeIndexSnapshot(path: str, bucketName: str, rows: Iterable[SnapshotRow], highWaterMark: int) -> int:
+    """
+    This writes the metadata for every file in the index to a SQLite snapshot at `path`, along with the high-water
+    mark: the lastModified time of the newest change the snapshot reflects. The snapshot is written next to `path` and
+    then moved into place, so a crash part way through never leaves a half written snapshot behind. This returns the
+    number of files written.
+    """
+    tmpPath = path + '.tmp'
+    if os.path.exists(tmpPath):
+        os.remove(tmpPath)
+    folder = os.path.dirname(path)
+    if len(folder) > 0:
+        os.makedirs(folder, exist_ok=True)
+    db = sqlite3.connect(tmpPath)
+    try:
+        # The snapshot gets rebuilt from scratch every time, so there's nothing to protect with a journal
+        db.execute('PRAGMA journal_mode = OFF')
+        db.execute('PRAGMA synchronous = OFF')
+        db.execute('CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT)')
+        db.execute('CREATE TABLE files (key TEXT, lastModified INTEGER, size INTEGER, eTag TEXT)')
+        db.executemany('INSERT INTO meta VALUES (?, ?)', [
+            ('version', str(SNAPSHOT_FORMAT_VERSION)),
+            ('bucket', bucketName),
+            ('highWaterMark', str(highWaterMark)),
+            ('savedAt', str(int(time.time() * 1000)))])
+        cursor = db.executemany('INSERT INTO files VALUES (?, ?, ?, ?)', rows)
+        numFiles = cursor.rowcount
+        db.commit()
+    finally:
+        db.close()
+    os.replace(tmpPath, path)
+    return numFiles
+
+
+def readIndexSnapshot(path: str, bucketName: str) -> Optional[Tuple[List[SnapshotRow], int]]:
+    """
+    This reads back a snapshot written by writeIndexSnapshot(), returning the rows for the files in it and its
+    high-water mark. If there's no usable snapshot at `path` (it's missing, unreadable, in an old format, or of a
+    different bucket), this returns None.
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        db = sqlite3.connect(path)
+        try:
+            meta = dict(db.execute('SELECT name, value FROM meta').fetchall())
+            if meta.get('version') != str(SNAPSHOT_FORMAT_VERSION) or meta.get('bucket') != bucketName:
+                print('Ignoring the index snapshot at ' + path + ', since it is in an old format or of another bucket')
+                return None
+            rows = db.execute('SELECT key, lastModified, size, eTag FROM files').fetchall()
+            return rows, int(meta['highWaterMark'])
+        finally:
+            db.close()
+    except (sqlite3.Error, KeyError, ValueError) as e:
+        print('Failed to read the index snapshot at ' + path + ': ' + str(e))
+        return None
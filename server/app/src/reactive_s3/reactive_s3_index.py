@@ -1,19 +1,31 @@
 import os
 from .pubsub import PubSub
+from .index_snapshot import readIndexSnapshot, writeIndexSnapshot
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 import json
 import time
+import sys
 import tempfile
-from typing import Dict, List, Set, Callable, Any
+from typing import Dict, List, Set, Tuple, Union, Callable, Any, Optional, Hashable, Iterable
 import threading
+import functools
+from collections import OrderedDict
 from datetime import datetime
 
 
 class FileMetadata:
+    """
+    The index holds one of these for every file in the bucket, so they're kept small: there's no per-instance
+    __dict__, and ETags are held as their raw digest bytes rather than as hex strings, wherever they are plain hex
+    digests (ETags of multipart uploads aren't, and are kept as they are).
+    """
+    __slots__ = ('key', 'lastModified', 'size', '_eTag')
     key: str
     lastModified: int
     size: int
-    eTag: str
+    _eTag: Union[bytes, str]
 
     def __init__(self, key: str, lastModified: int, size: int, eTag: str) -> None:
         self.key = key
@@ -21,6 +33,24 @@ class FileMetadata:
         self.size = size
         self.eTag = eTag
 
+    @property
+    def eTag(self) -> str:
+        if isinstance(self._eTag, bytes):
+            return self._eTag.hex()
+        return self._eTag
+
+    @eTag.setter
+    def eTag(self, eTag: str) -> None:
+        self._eTag = eTag
+        # Only store the bytes if they round trip back to exactly the same string
+        if len(eTag) > 0 and len(eTag) % 2 == 0:
+            try:
+                digest = bytes.fromhex(eTag)
+                if digest.hex() == eTag:
+                    self._eTag = digest
+            except ValueError:
+                pass
+
     def __str__(self) -> str:
         return "<"+self.key+", "+str(self.size)+">"
 
@@ -28,6 +58,100 @@ class FileMetadata:
         return "<"+self.key+", "+str(self.size)+"b, "+str(self.lastModified)+"ms>"
 
 
+class FolderNode:
+    """
+    A folder in the tree of folders implied by the paths of the files in the bucket, with the number, total size and
+    latest modification time of all the files under it. Subfolders and files are keyed by name, without any trailing
+    slash, in separate maps (S3 allows both a file `a/b` and a folder `a/b/`), and the placeholder file for a folder
+    (`a/b/`) lives under the empty name in that folder's files.
+    """
+    __slots__ = ('folders', 'files', 'numFiles', 'size', 'lastModified')
+    folders: Dict[str, 'FolderNode']
+    files: Dict[str, FileMetadata]
+    numFiles: int
+    size: int
+    lastModified: int
+
+    def __init__(self) -> None:
+        self.folders = {}
+        self.files = {}
+        self.numFiles = 0
+        self.size = 0
+        self.lastModified = 0
+
+    def addFile(self, file: FileMetadata) -> None:
+        self.numFiles += 1
+        self.size += file.size
+        self.lastModified = max(self.lastModified, file.lastModified)
+
+    def removeFile(self, file: FileMetadata) -> None:
+        self.numFiles -= 1
+        self.size -= file.size
+        # Only a file that was the latest one under this folder can change its latest modification time
+        if file.lastModified >= self.lastModified:
+            self.lastModified = max([folder.lastModified for folder in self.folders.values()] +
+                                    [file.lastModified for file in self.files.values()] + [0])
+
+
+class IncomingMessageQueue:
+    """
+    The messages the index has received, but not yet applied. PubSub puts messages here from its own thread, and they
+    get taken off by whichever thread processes them, so everything goes through a lock.
+
+    Messages coalesce by key: a newer message for a key replaces one that's still waiting (keeping its place in line),
+    since only the latest UPDATE or DELETE of each file matters by the time we get to it.
+    """
+    lock: threading.Lock
+    condition: threading.Condition
+    messages: 'OrderedDict[Hashable, Tuple[str, Any, Any]]'
+    numCoalesced: int
+    woken: bool
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.messages = OrderedDict()
+        self.numCoalesced = 0
+        self.woken = False
+
+    def put(self, key: Hashable, message: Tuple[str, Any, Any]) -> None:
+        with self.lock:
+            if key in self.messages:
+                self.numCoalesced += 1
+            self.messages[key] = message
+            self.condition.notify_all()
+
+    def wait(self, timeout: Optional[float]) -> None:
+        """
+        This blocks until there are messages waiting, someone calls wake(), or `timeout` seconds pass.
+        """
+        with self.lock:
+            if len(self.messages) == 0 and not self.woken:
+                self.condition.wait(timeout)
+            self.woken = False
+
+    def wake(self) -> None:
+        with self.lock:
+            self.woken = True
+            self.condition.notify_all()
+
+    def takeAll(self) -> Tuple[List[Tuple[Hashable, Tuple[str, Any, Any]]], int]:
+        """
+        This takes every waiting message off the queue, in order, as (key, message) pairs, along with the number of
+        messages that were coalesced away since the last time.
+        """
+        with self.lock:
+            messages = self.messages
+            numCoalesced = self.numCoalesced
+            self.messages = OrderedDict()
+            self.numCoalesced = 0
+        return list(messages.items()), numCoalesced
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.messages)
+
+
 def makeTopicPubSubSafe(path: str) -> str:
 
     # Check if the path contains a user ID by searching for the ":" character.
@@ -60,22 +184,73 @@ def makeTopicPubSubSafe(path: str) -> str:
     return path
 
 
+# Every file transfer can split into up to S3_TRANSFER_CONCURRENCY concurrent part requests, and the TransferManager
+# runs many transfers at once, so the client needs more than the default 10 pooled connections to avoid queueing.
+S3_MAX_POOL_CONNECTIONS = 64
+S3_TRANSFER_CONCURRENCY = 4
+# Files above this size are transferred in parts of this size. Most trial inputs are smaller than this, and go in a
+# single request.
+S3_MULTIPART_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def makeTransferConfig() -> TransferConfig:
+    return TransferConfig(multipart_threshold=S3_MULTIPART_CHUNK_SIZE,
+                          multipart_chunksize=S3_MULTIPART_CHUNK_SIZE,
+                          max_concurrency=S3_TRANSFER_CONCURRENCY)
+
+
+# How often to save the index snapshot (if one is configured), as long as anything has changed since the last save
+INDEX_SNAPSHOT_INTERVAL_SECONDS = 10 * 60
+
+
+def makeS3Client():
+    """
+    The low level S3 client, which (unlike boto3 resources) is safe to share between threads
+    """
+    return boto3.client('s3', region_name='us-west-2', config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS))
+
+
+def holdingIndexLock(method: Callable) -> Callable:
+    """
+    Run a ReactiveS3Index method while holding the index's lock. Every method that reads or changes the file table or
+    the folder tree does this, since subjects being processed on worker threads read the index while the main thread
+    applies incoming messages to it.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 class ReactiveS3Index:
     disable_pubsub: bool
     pubSub: PubSub
     files: Dict[str, FileMetadata]
-    children: Dict[str, List[str]]
+    tree: FolderNode
     bucketName: str
     deployment: str
-    lock: threading.Lock
+    # Held while reading or changing `files` or `tree`, see holdingIndexLock()
+    lock: threading.RLock
+
+    # The index can be saved to, and loaded from, a snapshot on local disk, so that restarts don't have to list the
+    # whole bucket before getting to work. After loading a snapshot, `caughtUp` is False until the index has been
+    # reconciled with a fresh listing of the bucket.
+    snapshotPath: str
+    snapshotHighWaterMark: int
+    lastSnapshotTime: float
+    changedSinceSnapshot: bool
+    caughtUp: bool
+    deletedDuringCatchUp: Set[str]
 
     def __init__(self, bucket: str, deployment: str, disable_pubsub = False) -> None:
-        self.s3_low_level = boto3.client('s3', region_name='us-west-2')
+        self.s3_low_level = makeS3Client()
         self.s3 = boto3.resource('s3', region_name='us-west-2')
-        self.lock = threading.Lock()
+        self.lock = threading.RLock()
         self.bucketName = bucket
         self.deployment = deployment
         self.bucket = self.s3.Bucket(self.bucketName)
+        self.transferConfig = makeTransferConfig()
         self.disable_pubsub = disable_pubsub
         if not disable_pubsub:
             try:
@@ -85,8 +260,14 @@ class ReactiveS3Index:
                 print('PubSub disabled')
                 self.disable_pubsub = True
         self.files = {}
-        self.children = {}
-        self.incomingMessages = []
+        self.tree = FolderNode()
+        self.incomingMessages = IncomingMessageQueue()
+        self.snapshotPath = ''
+        self.snapshotHighWaterMark = 0
+        self.lastSnapshotTime = 0
+        self.changedSinceSnapshot = False
+        self.caughtUp = True
+        self.deletedDuringCatchUp = set()
 
     # Add pickling support
     def __getstate__(self):
@@ -97,24 +278,41 @@ class ReactiveS3Index:
         if 'pubSub' in state:
             del state['pubSub']
         del state['bucket']
+        del state['transferConfig']
+        del state['incomingMessages']
         return state
 
     # Add unpickling support - always unpickle with PubSub disabled, since we don't want multiple instances of the
     # PubSub connection from separate processing threads.
     def __setstate__(self, state):
         self.__dict__.update(state)
-        self.s3_low_level = boto3.client('s3', region_name='us-west-2')
+        self.s3_low_level = makeS3Client()
         self.s3 = boto3.resource('s3', region_name='us-west-2')
         self.bucket = self.s3.Bucket(self.bucketName)
-        self.lock = threading.Lock()
+        self.transferConfig = makeTransferConfig()
+        self.lock = threading.RLock()
         self.disable_pubsub = True
-        self.incomingMessages = []
+        self.incomingMessages = IncomingMessageQueue()
+        # Only the original index gets to write its snapshot
+        self.snapshotPath = ''
 
     def queue_pub_sub_update_message(self, topic: str, payload: bytes) -> None:
-        self.incomingMessages.append(('UPDATE', topic, payload))
+        self.queue_pub_sub_message(('UPDATE', topic, payload))
 
     def queue_pub_sub_delete_message(self, topic: str, payload: bytes) -> None:
-        self.incomingMessages.append(('DELETE', topic, payload))
+        self.queue_pub_sub_message(('DELETE', topic, payload))
+
+    def queue_pub_sub_message(self, message: Tuple[str, str, bytes]) -> None:
+        try:
+            key: str = json.loads(message[2])['key']
+        except (ValueError, KeyError, TypeError) as e:
+            print('Dropping a malformed PubSub message on ' + message[1] + ': ' + str(e))
+            return
+        self.incomingMessages.put(key, message)
+
+    def queue_catch_up_message(self, listedSince: int, listing: Dict[str, FileMetadata]) -> None:
+        # This gets a key of its own, so it never coalesces with anything
+        self.incomingMessages.put(object(), ('CATCH_UP', listedSince, listing))
 
     def register_pub_sub(self) -> None:
         """
@@ -131,182 +329,438 @@ class ReactiveS3Index:
         #
         # self.pubSub.addResumeListener(self.refreshIndex)
 
-    def process_incoming_messages(self) -> bool:
-        """
-        This processes incoming PubSub messages
-        """
-        any_changes = False
-        while len(self.incomingMessages) > 0:
-            message = self.incomingMessages.pop(0)
+    @holdingIndexLock
+    def process_incoming_messages(self,
+                                  changedKeys: Optional[Set[str]] = None,
+                                  touchedSubjectFolders: Optional[Set[str]] = None) -> bool:
+        """
+        This processes incoming PubSub messages. If `changedKeys` is given, the keys of the files that the messages
+        changed are added to it. If `touchedSubjectFolders` is given, the subject folders holding those files are
+        added to it (see getSubjectFolders()).
+        """
+        messages, numCoalesced = self.incomingMessages.takeAll()
+        if len(messages) == 0:
+            return False
+        keys: Set[str] = set()
+        for key, message in messages:
+            if message[0] == 'CATCH_UP':
+                keys.update(self._onCatchUp(message[1], message[2]))
+                continue
+            changed = False
             if message[0] == 'UPDATE':
-                any_changes |= self._onUpdate(message[1], message[2])
+                changed = self._onUpdate(message[1], message[2])
             elif message[0] == 'DELETE':
-                any_changes |= self._onDelete(message[1], message[2])
-        return any_changes
-
+                changed = self._onDelete(message[1], message[2])
+            if changed:
+                keys.add(key)
+        if numCoalesced > 0:
+            print('Applied ' + str(len(messages)) + ' incoming messages, after coalescing away ' + str(numCoalesced) +
+                  ' older messages about the same files')
+        if changedKeys is not None:
+            changedKeys.update(keys)
+        if touchedSubjectFolders is not None:
+            touchedSubjectFolders.update(self.getSubjectFolders(keys))
+        return len(keys) > 0
+
+    def wait_for_incoming_messages(self, timeout: Optional[float] = None) -> None:
+        """
+        This blocks until there are incoming messages to process, another thread calls wake_up(), or `timeout` seconds
+        pass, whichever comes first.
+        """
+        self.incomingMessages.wait(timeout)
+
+    def wake_up(self) -> None:
+        """
+        This wakes up a thread that's blocked in wait_for_incoming_messages(), so it can react to something other than
+        a message.
+        """
+        self.incomingMessages.wake()
+
+    @holdingIndexLock
+    def getSubjectFolders(self, keys: Iterable[str]) -> Set[str]:
+        """
+        This returns the subject folders (the folders with a _subject.json in them) that hold any of `keys`. The
+        folder of a _subject.json in `keys` always counts, even if the file was just deleted, since that folder just
+        stopped being a subject.
+        """
+        folders: Set[str] = set()
+        for key in keys:
+            if key.endswith('/_subject.json'):
+                folders.add(key[:-len('_subject.json')])
+            cursor = key.find('/')
+            while cursor != -1:
+                folder = key[:cursor + 1]
+                if folder + '_subject.json' in self.files:
+                    folders.add(folder)
+                cursor = key.find('/', cursor + 1)
+        return folders
+
+    @holdingIndexLock
     def load_only_folder(self, folder: str) -> None:
         """
         This updates the index
         """
         print('Loading folder '+folder)
         self.files.clear()
-        self.children.clear()
+        self.tree = FolderNode()
         for object in self.bucket.objects.filter(Prefix=folder):
             key: str = object.key
             lastModified: int = int(object.last_modified.timestamp() * 1000)
             eTag = object.e_tag[1:-1]  # Remove the double quotes around the ETag value
             size: int = object.size
             file = FileMetadata(key, lastModified, size, eTag)
-            self.updateChildrenOnAddFile(key)
+            self.updateChildrenOnAddFile(file)
             self.files[key] = file
         print('Folder load finished!')
 
+    @holdingIndexLock
     def refreshIndex(self) -> None:
         """
         This updates the index
         """
         print('Doing full index refresh...')
         self.files.clear()
-        self.children.clear()
+        self.tree = FolderNode()
         for object in self.bucket.objects.all():
             key: str = object.key
             lastModified: int = int(object.last_modified.timestamp() * 1000)
             eTag = object.e_tag[1:-1]  # Remove the double quotes around the ETag value
             size: int = object.size
             file = FileMetadata(key, lastModified, size, eTag)
-            self.updateChildrenOnAddFile(key)
+            self.updateChildrenOnAddFile(file)
             self.files[key] = file
+        self.caughtUp = True
         print('Full index refresh finished!')
+        self.saveSnapshot()
+
+    @holdingIndexLock
+    def loadSnapshot(self, path: str) -> bool:
+        """
+        This loads the index from a snapshot saved by saveSnapshot(), and remembers `path` as where to save snapshots
+        from now on. The snapshot can be arbitrarily out of date, so once PubSub is registered, call startCatchUp() to
+        bring the index up to date with the bucket. This returns False, and leaves the index empty, if there was no
+        usable snapshot to load.
+        """
+        self.snapshotPath = path
+        start_time = time.time()
+        snapshot = readIndexSnapshot(path, self.bucketName)
+        if snapshot is None:
+            return False
+        rows, self.snapshotHighWaterMark = snapshot
+        self.files.clear()
+        self.tree = FolderNode()
+        for key, lastModified, size, eTag in rows:
+            file = FileMetadata(key, lastModified, size, eTag)
+            self.updateChildrenOnAddFile(file)
+            self.files[key] = file
+        self.caughtUp = False
+        self.lastSnapshotTime = time.time()
+        print('[PERFORMANCE] Loaded ' + str(len(self.files)) + ' files from the index snapshot at ' + path + ' in ' +
+              str(time.time() - start_time) + ' seconds')
+        return True
 
-    def updateChildrenOnAddFile(self, path: str):
-        cursor = -1
-        subPath = ''
-        while True:
-            try:
-                cursor = path.index('/', cursor+1)
-                subPath = path[:cursor]
-                # End all files/folders with a slash
-                if len(subPath) > 0 and subPath[-1] != '/':
-                    subPath += '/'
-                if subPath not in self.children:
-                    self.children[subPath] = []
-                self.children[subPath].append(path)
-            except ValueError:
-                # the slash was not found
-                break
+    def startCatchUp(self) -> None:
+        """
+        This lists the whole bucket on a background thread, and then queues the listing up for
+        process_incoming_messages() to reconcile the index with. S3 has no way to list only the files that changed
+        since the snapshot, but the index is usable from the snapshot while the listing runs, and only the keys that
+        actually differ from it get applied and reported as changed.
+        """
+        def listBucket():
+            while True:
+                try:
+                    start_time = time.time()
+                    listedSince = int(start_time * 1000)
+                    listing = self.listFiles('')
+                    print('[PERFORMANCE] Listed ' + str(len(listing)) + ' files to catch up the index in ' +
+                          str(time.time() - start_time) + ' seconds')
+                    self.queue_catch_up_message(listedSince, listing)
+                    return
+                except Exception as e:
+                    print('Failed to list the bucket to catch up the index, retrying in 60 seconds: ' + str(e))
+                    time.sleep(60)
+
+        threading.Thread(target=listBucket, daemon=True).start()
+
+    def listFiles(self, prefix: str) -> Dict[str, FileMetadata]:
+        """
+        This lists every file in the bucket under `prefix`. Unlike the rest of the listing code, this goes through the
+        low level client, so it's safe to call from a background thread.
+        """
+        files: Dict[str, FileMetadata] = {}
+        paginator = self.s3_low_level.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucketName, Prefix=prefix):
+            for object in page.get('Contents', []):
+                key: str = object['Key']
+                lastModified: int = int(object['LastModified'].timestamp() * 1000)
+                eTag = object['ETag'][1:-1]  # Remove the double quotes around the ETag value
+                files[key] = FileMetadata(key, lastModified, object['Size'], eTag)
+        return files
+
+    def refreshFolder(self, folder: str) -> Set[str]:
+        """
+        This re-lists just the files under `folder` from S3, and brings that part of the index up to date with them,
+        returning the keys that changed.
+        """
+        listedSince = int(time.time() * 1000)
+        return self.reconcile(folder, self.listFiles(folder), listedSince)
+
+    @holdingIndexLock
+    def reconcile(self, prefix: str, listing: Dict[str, FileMetadata], listedSince: int) -> Set[str]:
+        """
+        This brings the part of the index under `prefix` in line with a listing of the bucket that started at
+        `listedSince` (in ms), and returns the keys that changed. Changes that PubSub told us about while the listing
+        was running are newer than the listing, so they're kept.
+        """
+        changedKeys: Set[str] = set()
+        for key, file in listing.items():
+            existing = self.files.get(key)
+            if existing is None and key in self.deletedDuringCatchUp:
+                continue
+            if existing is not None and (existing.lastModified > file.lastModified or (
+                    existing.lastModified == file.lastModified and existing.size == file.size and
+                    existing.eTag == file.eTag)):
+                continue
+            self.files[key] = file
+            self.updateChildrenOnAddFile(file)
+            changedKeys.add(key)
+        if prefix == '':
+            indexedKeys = list(self.files.keys())
+        else:
+            indexedKeys = [file.key for file in self.getChildren(prefix).values()]
+            if prefix in self.files:
+                indexedKeys.append(prefix)
+        for key in indexedKeys:
+            if key not in listing and self.files[key].lastModified < listedSince:
+                self.updateChildrenOnRemoveFile(key)
+                del self.files[key]
+                changedKeys.add(key)
+        if len(changedKeys) > 0:
+            self.changedSinceSnapshot = True
+        return changedKeys
+
+    @holdingIndexLock
+    def saveSnapshot(self) -> None:
+        """
+        This saves the index to its snapshot, if it has one.
+        """
+        if len(self.snapshotPath) == 0:
+            return
+        start_time = time.time()
+        try:
+            # The latest modification time in the whole index is the high-water mark of the snapshot
+            numFiles = writeIndexSnapshot(self.snapshotPath, self.bucketName,
+                                          ((file.key, file.lastModified, file.size, file.eTag)
+                                           for file in self.files.values()),
+                                          self.tree.lastModified)
+        except Exception as e:
+            print('Failed to save the index snapshot to ' + self.snapshotPath + ': ' + str(e))
+            return
+        self.snapshotHighWaterMark = self.tree.lastModified
+        self.lastSnapshotTime = time.time()
+        self.changedSinceSnapshot = False
+        print('[PERFORMANCE] Saved ' + str(numFiles) + ' files to the index snapshot at ' + self.snapshotPath +
+              ' in ' + str(time.time() - start_time) + ' seconds')
+
+    def saveSnapshotIfDue(self) -> None:
+        """
+        This saves the index to its snapshot, if it has one, and there are changes that haven't been saved for a
+        while. Call this regularly from the thread that processes the incoming messages.
+        """
+        if self.caughtUp and self.changedSinceSnapshot and \
+                time.time() - self.lastSnapshotTime > INDEX_SNAPSHOT_INTERVAL_SECONDS:
+            self.saveSnapshot()
+
+    def updateChildrenOnAddFile(self, file: FileMetadata):
+        """
+        This adds a file to the folder tree, replacing any previous version of it, and updates the totals of all the
+        folders it's in
+        """
+        parts = file.key.split('/')
+        node = self.tree
+        path: List[FolderNode] = [node]
+        for part in parts[:-1]:
+            if part not in node.folders:
+                # The same names ('trials', 'markers.c3d', ...) show up in thousands of folders, so share one copy
+                node.folders[sys.intern(part)] = FolderNode()
+            node = node.folders[part]
+            path.append(node)
+        if parts[-1] in node.files:
+            self.updateChildrenOnRemoveFile(file.key)
+            self.updateChildrenOnAddFile(file)
+            return
+        node.files[sys.intern(parts[-1])] = file
+        for folder in path:
+            folder.addFile(file)
 
     def updateChildrenOnRemoveFile(self, path: str):
-        cursor = -1
-        subPath = ''
-        while True:
-            try:
-                cursor = path.index('/', cursor+1)
-                subPath = path[:cursor]
-                # End all files/folders with a slash
-                if len(subPath) > 0 and subPath[-1] != '/':
-                    subPath += '/'
-                if subPath in self.children and path in self.children[subPath]:
-                    self.children[subPath].remove(path)
-                    if len(self.children[subPath]) == 0:
-                        del self.children[subPath]
-            except ValueError:
-                # the slash was not found
-                break
-
+        """
+        This removes a file from the folder tree, pruning any folders that are left empty
+        """
+        node = self.tree
+        nodes: List[FolderNode] = [node]
+        parts = path.split('/')
+        for part in parts[:-1]:
+            if part not in node.folders:
+                return
+            node = node.folders[part]
+            nodes.append(node)
+        if parts[-1] not in node.files:
+            return
+        file = node.files.pop(parts[-1])
+        # Work back up from the file, so each folder's subfolders already have up to date totals when we get to it
+        for i in reversed(range(len(nodes))):
+            nodes[i].removeFile(file)
+            if i > 0 and nodes[i].numFiles == 0:
+                del nodes[i - 1].folders[parts[i - 1]]
+
+    @holdingIndexLock
+    def getFolderNode(self, folder: str) -> Optional[FolderNode]:
+        """
+        This returns the node of the folder tree for a given folder (which must end with a slash), or None if there
+        are no files in it
+        """
+        if folder == '':
+            return self.tree
+        if not folder.endswith('/'):
+            return None
+        node = self.tree
+        for part in folder[:-1].split('/'):
+            if part not in node.folders:
+                return None
+            node = node.folders[part]
+        return node
+
+    @holdingIndexLock
     def listAllFolders(self) -> Set[str]:
         """
         This parses the different file names, and lists all virtual folders implied by the paths, along with all real folders
         """
-        return set(self.children.keys())
-        # folders: Set[str] = set()
-        # for path in self.files:
-        #     cursor = -1
-        #     while True:
-        #         try:
-        #             cursor = path.index('/', cursor+1)
-        #             subPath = path[:cursor]
-        #             # End all files/folders with a slash
-        #             if len(subPath) > 0 and subPath[-1] != '/':
-        #                 subPath += '/'
-        #             folders.add(subPath)
-        #         except ValueError:
-        #             # the slash was not found
-        #             folders.add(path)
-        #             break
-        # return folders
-
+        folders: Set[str] = set()
+        toVisit: List[Tuple[str, FolderNode]] = [('', self.tree)]
+        while len(toVisit) > 0:
+            prefix, node = toVisit.pop()
+            for name, subfolder in node.folders.items():
+                folder = prefix + name + '/'
+                folders.add(folder)
+                toVisit.append((folder, subfolder))
+        return folders
+
+    @holdingIndexLock
     def exists(self, path: str) -> bool:
         return path in self.files
 
+    @holdingIndexLock
     def getMetadata(self, path: str) -> FileMetadata:
         return self.files[path]
 
+    @holdingIndexLock
     def getChildren(self, folder: str) -> Dict[str, FileMetadata]:
         """
         This returns a list of all the children of a given folder
         """
         children: Dict[str, FileMetadata] = {}
-        if folder in self.children:
-            toRemove = []
-            for path in self.children[folder]:
-                if path != folder:
-                    if path in self.files:
-                        children[path[len(folder):]] = self.files[path]
-                    else:
-                        print('DATA SYNCHRONIZATION ISSUE: '+path +
-                              ' in children['+folder+'], but not in files. Removing from children['+folder+']', flush=True)
-                        toRemove.append(path)
-            for path in toRemove:
-                self.children[folder].remove(path)
-        # for path in self.files:
-        #     if path.startswith(folder) and path != folder:
-        #         subPath = path[len(folder):]
-        #         children[subPath] = self.files[path]
+        node = self.getFolderNode(folder)
+        if node is None:
+            return children
+        toVisit: List[FolderNode] = [node]
+        while len(toVisit) > 0:
+            node = toVisit.pop()
+            for file in node.files.values():
+                if file.key != folder:
+                    children[file.key[len(folder):]] = file
+            toVisit.extend(node.folders.values())
         return children
 
+    @holdingIndexLock
     def getImmediateChildren(self, folder: str) -> Dict[str, FileMetadata]:
         """
         This returns a list of folders that are children of 'folder'
         """
-        allChildren: Dict[str, FileMetadata] = self.getChildren(folder)
         immediateChildren: Dict[str, FileMetadata] = {}
-        for key in allChildren:
-            pathParts: List[str] = key.split('/')
-            if len(pathParts) > 0:
-                folderName = pathParts[0]
-                if folderName in immediateChildren:
-                    immediateChildren[folderName].size += allChildren[key].size
-                    immediateChildren[folderName].lastModified = max(
-                        allChildren[key].lastModified, immediateChildren[folderName].lastModified)
-                else:
-                    immediateChildren[folderName] = FileMetadata(
-                        key=folderName, lastModified=allChildren[key].lastModified, size=allChildren[key].size, eTag=allChildren[key].eTag)
+        node = self.getFolderNode(folder)
+        if node is None:
+            return immediateChildren
+        for fileName, file in node.files.items():
+            # The placeholder file for the folder itself doesn't count as one of its children
+            if file.key != folder:
+                immediateChildren[fileName] = FileMetadata(
+                    key=fileName, lastModified=file.lastModified, size=file.size, eTag=file.eTag)
+        for folderName, subfolder in node.folders.items():
+            if folderName in immediateChildren:
+                immediateChildren[folderName].size += subfolder.size
+                immediateChildren[folderName].lastModified = max(
+                    subfolder.lastModified, immediateChildren[folderName].lastModified)
+            else:
+                immediateChildren[folderName] = FileMetadata(
+                    key=folderName, lastModified=subfolder.lastModified, size=subfolder.size, eTag='')
         return immediateChildren
 
+    @holdingIndexLock
+    def folderExists(self, folder: str) -> bool:
+        """
+        This returns True if there are any files in the given folder (which must end with a slash)
+        """
+        node = self.getFolderNode(folder)
+        return node is not None and node is not self.tree
+
+    @holdingIndexLock
     def hasChildren(self, folder: str, subPaths: List[str]) -> bool:
         """
         This returns True if a given folder has the listed children, and False otherwise
         """
-        children: Dict[str, FileMetadata] = self.getChildren(folder)
+        node = self.getFolderNode(folder)
+        if node is None:
+            return False
         for path in subPaths:
-            foundChild = False
             if len(subPaths) == 1 and subPaths[0] == 'INCOMPATIBLE':
-                print('Checking for '+path+' in '+str(children.keys()))
-            for key in children:
-                if key.startswith(path) or key.startswith('/'+path):
-                    foundChild = True
-                    break
-            if not foundChild:
+                print('Checking for '+path+' in '+str(list(node.folders.keys()) + list(node.files.keys())))
+            if not self.hasChildStartingWith(node, path, folder) and \
+                    not ('' in node.folders and self.hasChildStartingWith(node.folders[''], path, folder)):
                 return False
         return True
 
-    def uploadFile(self, bucketPath: str, localPath: str):
+    def hasChildStartingWith(self, node: FolderNode, path: str, folder: str) -> bool:
         """
-        This uploads a local file to a given spot in the bucket
+        This returns True if there's a file under `node` whose path relative to it starts with `path`. Every part of
+        `path` but the last has to match a folder exactly, and the last one only has to be the start of a name.
+        """
+        parts = path.split('/')
+        for part in parts[:-1]:
+            if part not in node.folders:
+                return False
+            node = node.folders[part]
+        for name, file in node.files.items():
+            # Don't count the placeholder file for `folder` itself
+            if name.startswith(parts[-1]) and file.key != folder:
+                return True
+        for name in node.folders:
+            if name.startswith(parts[-1]):
+                return True
+        return False
+
+    def uploadFile(self, bucketPath: str, localPath: str, checksumSHA256: Optional[str] = None,
+                   callback: Optional[Callable[[int], None]] = None):
+        """
+        This uploads a local file to a given spot in the bucket. If `checksumSHA256` (the base64 encoded SHA-256 of the
+        file) is given, S3 verifies the upload: files small enough to go up in a single request are checked against
+        `checksumSHA256` itself, and larger ones still go up in parallel parts, with S3 checking the SHA-256 of every
+        part. If `callback` is given, it's called with the number of bytes sent as the upload progresses.
+
+        This is safe to call from several threads at once.
         """
         print('uploading file '+localPath+' to '+bucketPath)
-        self.s3.Object(self.bucketName, bucketPath).put(
-            Body=open(localPath, 'rb'))
+        if checksumSHA256 is not None and os.path.getsize(localPath) < self.transferConfig.multipart_threshold:
+            # A whole-file checksum only works for a single request upload
+            with open(localPath, 'rb') as f:
+                self.s3_low_level.put_object(Bucket=self.bucketName, Key=bucketPath, Body=f,
+                                             ChecksumSHA256=checksumSHA256)
+            if callback is not None:
+                callback(os.path.getsize(localPath))
+        else:
+            extraArgs = {'ChecksumAlgorithm': 'SHA256'} if checksumSHA256 is not None else None
+            self.s3_low_level.upload_file(localPath, self.bucketName, bucketPath, ExtraArgs=extraArgs,
+                                          Config=self.transferConfig, Callback=callback)
         if 'pubSub' in self.__dict__ and self.pubSub is not None:
             topic = makeTopicPubSubSafe("/UPDATE/"+bucketPath)
             body = {'key': bucketPath, 'lastModified': time.time() * 1000, 'size': os.path.getsize(localPath)}
@@ -315,9 +769,9 @@ class ReactiveS3Index:
 
     def uploadText(self, bucketPath: str, text: str):
         """
-        This uploads text to the file at this path
+        This uploads text to the file at this path. This is safe to call from several threads at once.
         """
-        self.s3.Object(self.bucketName, bucketPath).put(Body=text)
+        self.s3_low_level.put_object(Bucket=self.bucketName, Key=bucketPath, Body=text.encode('utf-8'))
         if 'pubSub' in self.__dict__ and self.pubSub is not None:
             topic = makeTopicPubSubSafe("/UPDATE/"+bucketPath)
             body = {'key': bucketPath, 'lastModified': time.time() * 1000, 'size': len(text.encode('utf-8'))}
@@ -331,22 +785,29 @@ class ReactiveS3Index:
         j = json.dumps(contents)
         self.uploadText(bucketPath, j)
 
-    def delete(self, bucketPath: str):
+    def delete(self, bucketPath: str, onlyIfIndexed: bool = True):
         """
-        This deletes a file from S3
+        This deletes a file from S3. By default, files that aren't in the index are skipped, but with `onlyIfIndexed`
+        unset, the file is deleted even if the index hasn't heard about it yet. This is safe to call from several threads
+        at once.
         """
-        if not self.exists(bucketPath):
+        if onlyIfIndexed and not self.exists(bucketPath):
             return bytearray()
-        self.s3.Object(self.bucketName, bucketPath).delete()
+        self.s3_low_level.delete_object(Bucket=self.bucketName, Key=bucketPath)
         if 'pubSub' in self.__dict__ and self.pubSub is not None:
             topic = makeTopicPubSubSafe("/DELETE/"+bucketPath)
             body = {'key': bucketPath}
             self.queue_pub_sub_delete_message(topic, json.dumps(body).encode('utf-8'))
             self.pubSub.publish(topic, body)
 
-    def download(self, bucketPath: str, localPath: str) -> None:
+    def download(self, bucketPath: str, localPath: str, callback: Optional[Callable[[int], None]] = None) -> None:
+        """
+        This downloads a file from the bucket. If `callback` is given, it's called with the number of bytes received as
+        the download progresses. This is safe to call from several threads at once.
+        """
         print('downloading file '+bucketPath+' into '+localPath)
-        self.bucket.download_file(bucketPath, localPath)
+        self.s3_low_level.download_file(self.bucketName, bucketPath, localPath, Config=self.transferConfig,
+                                        Callback=callback)
 
     def download_to_tmp(self, bucketPath: str) -> str:
         """
@@ -418,7 +879,8 @@ class ReactiveS3Index:
         file = FileMetadata(key, last_modified, size, e_tag)
         print("onUpdate() file: "+str(file))
         self.files[key] = file
-        self.updateChildrenOnAddFile(key)
+        self.updateChildrenOnAddFile(file)
+        self.changedSinceSnapshot = True
         return True
 
     def _onDelete(self, topic: str, payload: bytes) -> bool:
@@ -429,8 +891,27 @@ class ReactiveS3Index:
         key: str = body['key']
         print("onDelete() key: "+str(key))
         anyDeleted = False
+        if not self.caughtUp:
+            # The catch up listing might have seen this file before it was deleted, so make sure it doesn't come back
+            self.deletedDuringCatchUp.add(key)
         if key in self.files:
             self.updateChildrenOnRemoveFile(key)
             del self.files[key]
+            self.changedSinceSnapshot = True
             anyDeleted = True
-        return anyDeleted
\ No newline at end of file
+        return anyDeleted
+
+    def _onCatchUp(self, listedSince: int, listing: Dict[str, FileMetadata]) -> Set[str]:
+        """
+        The listing of the bucket from startCatchUp() is ready
+        """
+        start_time = time.time()
+        changedKeys = self.reconcile('', listing, listedSince)
+        newerThanSnapshot = sum(1 for file in listing.values() if file.lastModified > self.snapshotHighWaterMark)
+        self.caughtUp = True
+        self.deletedDuringCatchUp.clear()
+        print('[PERFORMANCE] Caught up the index with the bucket in ' + str(time.time() - start_time) + ' seconds: ' +
+              str(len(changedKeys)) + ' keys changed, ' + str(newerThanSnapshot) +
+              ' files are newer than the snapshot')
+        self.saveSnapshot()
+        return changedKeys
\ No newline at end of file
@@ -0,0 +1,147 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import List, Optional, Callable
+from .reactive_s3_index import ReactiveS3Index
+
+
+class TransferManager:
+    """
+    This runs S3 uploads and downloads through a ReactiveS3Index concurrently, on a bounded pool of threads. Every
+    transfer is retried with exponential backoff if it fails, and progress is reported in bytes across all the
+    transfers in flight.
+
+    Use this as a context manager, and call wait() whenever later work depends on the transfers submitted so far:
+
+        with TransferManager(index) as transfers:
+            transfers.download(bucketPath, localPath)
+            ...
+            transfers.wait()
+    """
+    index: ReactiveS3Index
+    maxAttempts: int
+    backoffSeconds: float
+    progressIntervalSeconds: float
+    progressCallback: Optional[Callable[[int, int], None]]
+
+    # Progress reporting, guarded by the lock
+    lock: threading.Lock
+    totalBytes: int
+    transferredBytes: int
+    totalFiles: int
+    finishedFiles: int
+    lastReportedProgress: float
+
+    pending: List[Future]
+
+    def __init__(self,
+                 index: ReactiveS3Index,
+                 maxWorkers: int = 16,
+                 maxAttempts: int = 5,
+                 backoffSeconds: float = 0.5,
+                 progressIntervalSeconds: float = 5.0,
+                 progressCallback: Optional[Callable[[int, int], None]] = None) -> None:
+        self.index = index
+        self.executor = ThreadPoolExecutor(max_workers=maxWorkers)
+        self.maxAttempts = maxAttempts
+        self.backoffSeconds = backoffSeconds
+        self.progressIntervalSeconds = progressIntervalSeconds
+        self.progressCallback = progressCallback
+        self.lock = threading.Lock()
+        self.totalBytes = 0
+        self.transferredBytes = 0
+        self.totalFiles = 0
+        self.finishedFiles = 0
+        self.lastReportedProgress = time.time()
+        self.pending = []
+
+    def __enter__(self) -> 'TransferManager':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        # If we're leaving because of an error, don't wait around for the rest of the transfers to finish
+        self.executor.shutdown(wait=exc_type is None, cancel_futures=exc_type is not None)
+
+    def download(self, bucketPath: str, localPath: str) -> Future:
+        """
+        This queues a download of a file from the bucket, creating the folder it goes into if necessary.
+        """
+        size = self.index.getMetadata(bucketPath).size if self.index.exists(bucketPath) else 0
+        os.makedirs(os.path.dirname(localPath) or '.', exist_ok=True)
+        return self._submit(size, lambda callback: self.index.download(bucketPath, localPath, callback=callback))
+
+    def upload(self, bucketPath: str, localPath: str, checksumSHA256: Optional[str] = None) -> Future:
+        """
+        This queues an upload of a local file to the bucket.
+        """
+        size = os.path.getsize(localPath)
+        return self._submit(size, lambda callback: self.index.uploadFile(
+            bucketPath, localPath, checksumSHA256=checksumSHA256, callback=callback))
+
+    def wait(self) -> None:
+        """
+        This blocks until every transfer submitted so far has finished, and raises the error of the first one that
+        failed on all of its attempts, if any did.
+        """
+        pending = self.pending
+        self.pending = []
+        firstError: Optional[BaseException] = None
+        for future in pending:
+            error = future.exception()
+            if error is not None and firstError is None:
+                firstError = error
+        self._reportProgress(force=True)
+        if firstError is not None:
+            raise firstError
+
+    def _submit(self, size: int, transfer: Callable[[Callable[[int], None]], None]) -> Future:
+        with self.lock:
+            self.totalBytes += size
+            self.totalFiles += 1
+        future = self.executor.submit(self._runWithRetries, transfer)
+        self.pending.append(future)
+        return future
+
+    def _runWithRetries(self, transfer: Callable[[Callable[[int], None]], None]) -> None:
+        for attempt in range(self.maxAttempts):
+            # Track the bytes from this attempt, so that we can take them back out of the progress if it fails
+            attemptBytes = [0]
+
+            def callback(numBytes: int):
+                attemptBytes[0] += numBytes
+                self._addProgress(numBytes)
+
+            try:
+                transfer(callback)
+                with self.lock:
+                    self.finishedFiles += 1
+                return
+            except Exception as e:
+                self._addProgress(-attemptBytes[0])
+                if attempt == self.maxAttempts - 1:
+                    raise
+                delay = self.backoffSeconds * (2 ** attempt)
+                print('Transfer failed on attempt ' + str(attempt + 1) + ' of ' + str(self.maxAttempts) +
+                      ', retrying in ' + str(delay) + ' seconds: ' + str(e), flush=True)
+                time.sleep(delay)
+
+    def _addProgress(self, numBytes: int) -> None:
+        with self.lock:
+            self.transferredBytes += numBytes
+        self._reportProgress()
+
+    def _reportProgress(self, force: bool = False) -> None:
+        with self.lock:
+            now = time.time()
+            if not force and now - self.lastReportedProgress < self.progressIntervalSeconds:
+                return
+            self.lastReportedProgress = now
+            transferredBytes = self.transferredBytes
+            totalBytes = self.totalBytes
+            message = 'Transferred ' + str(round(transferredBytes / 1024 / 1024, 1)) + 'MB of ' + \
+                      str(round(totalBytes / 1024 / 1024, 1)) + 'MB (' + str(self.finishedFiles) + ' of ' + \
+                      str(self.totalFiles) + ' files)'
+        print(message, flush=True)
+        if self.progressCallback is not None:
+            self.progressCallback(transferredBytes, totalBytes)
@@ -0,0 +1,240 @@
+import unittest
+import os
+import json
+import tempfile
+import threading
+import time
+from src.reactive_s3.reactive_s3_index import ReactiveS3Index, FileMetadata
+
+
+def makeIndex() -> ReactiveS3Index:
+    return ReactiveS3Index('test-bucket', 'DEV', disable_pubsub=True)
+
+
+def update(index: ReactiveS3Index, key: str, size: int, lastModified: int):
+    index._onUpdate('', json.dumps({'key': key, 'size': size, 'lastModified': lastModified, 'eTag': 'etag'}))
+
+
+def delete(index: ReactiveS3Index, key: str):
+    index._onDelete('', json.dumps({'key': key}))
+
+
+class TestFolderTree(unittest.TestCase):
+    def test_folders_and_children(self):
+        index = makeIndex()
+        update(index, 'protected/user/subject/', 0, 1)
+        update(index, 'protected/user/subject/_subject.json', 10, 2)
+        update(index, 'protected/user/subject/trials/walk/markers.c3d', 100, 3)
+        update(index, 'protected/user/subject/trials/run/markers.c3d', 200, 4)
+
+        self.assertEqual(index.listAllFolders(), {
+            'protected/', 'protected/user/', 'protected/user/subject/', 'protected/user/subject/trials/',
+            'protected/user/subject/trials/walk/', 'protected/user/subject/trials/run/'})
+        self.assertTrue(index.folderExists('protected/user/subject/trials/'))
+        self.assertFalse(index.folderExists('protected/user/subject/_subject.json/'))
+
+        # The placeholder for the folder itself isn't one of its children
+        self.assertEqual(set(index.getChildren('protected/user/subject/').keys()), {
+            '_subject.json', 'trials/walk/markers.c3d', 'trials/run/markers.c3d'})
+        self.assertEqual(index.getChildren('protected/user/subject'), {})
+
+        immediateChildren = index.getImmediateChildren('protected/user/subject/')
+        self.assertEqual(set(immediateChildren.keys()), {'_subject.json', 'trials'})
+        self.assertEqual(immediateChildren['trials'].size, 300)
+        self.assertEqual(immediateChildren['trials'].lastModified, 4)
+
+        self.assertTrue(index.hasChildren('protected/user/subject/', ['trials/', '_subject.json']))
+        self.assertFalse(index.hasChildren('protected/user/subject/', ['trials/', 'README']))
+
+    def test_aggregates_follow_updates_and_deletes(self):
+        index = makeIndex()
+        update(index, 'data/a/one.c3d', 100, 5)
+        update(index, 'data/a/two.c3d', 50, 9)
+        update(index, 'data/b/three.c3d', 10, 1)
+
+        # Overwriting a file replaces its size, rather than adding to it
+        update(index, 'data/a/one.c3d', 30, 6)
+        self.assertEqual(index.getImmediateChildren('data/')['a'].size, 80)
+
+        # Deleting the latest file rolls the latest modification time back
+        delete(index, 'data/a/two.c3d')
+        self.assertEqual(index.getImmediateChildren('data/')['a'].size, 30)
+        self.assertEqual(index.getImmediateChildren('data/')['a'].lastModified, 6)
+
+        # Empty folders disappear
+        delete(index, 'data/a/one.c3d')
+        self.assertFalse(index.folderExists('data/a/'))
+        self.assertEqual(index.listAllFolders(), {'data/', 'data/b/'})
+        self.assertEqual(index.tree.numFiles, 1)
+
+
+class TestFileMetadata(unittest.TestCase):
+    def test_etags_round_trip(self):
+        for eTag in ['d41d8cd98f00b204e9800998ecf8427e', 'd41d8cd98f00b204e9800998ecf8427e-12', 'D41D8CD9', '', 'etag']:
+            self.assertEqual(FileMetadata('a/b.c3d', 1, 2, eTag).eTag, eTag)
+        self.assertEqual(FileMetadata('a/b.c3d', 1, 2, 'd41d8cd98f00b204e9800998ecf8427e')._eTag,
+                         bytes.fromhex('d41d8cd98f00b204e9800998ecf8427e'))
+
+
+class TestIncomingMessages(unittest.TestCase):
+    def test_messages_coalesce_by_key(self):
+        index = makeIndex()
+        for size in [1, 2, 3]:
+            index.queue_pub_sub_update_message('/UPDATE/data/subject/trials/walk/markers.c3d', json.dumps({
+                'key': 'data/subject/trials/walk/markers.c3d', 'size': size, 'lastModified': size, 'eTag': ''}))
+        index.queue_pub_sub_update_message('/UPDATE/data/subject/_subject.json', json.dumps({
+            'key': 'data/subject/_subject.json', 'size': 10, 'lastModified': 1, 'eTag': ''}))
+        index.queue_pub_sub_update_message('/UPDATE/data/other/README', json.dumps({
+            'key': 'data/other/README', 'size': 10, 'lastModified': 1, 'eTag': ''}))
+        index.queue_pub_sub_delete_message('/DELETE/data/other/README', json.dumps({'key': 'data/other/README'}))
+        index.queue_pub_sub_update_message('/UPDATE/malformed', b'not json')
+        self.assertEqual(len(index.incomingMessages), 3)
+
+        changedKeys = set()
+        touchedSubjectFolders = set()
+        self.assertTrue(index.process_incoming_messages(changedKeys, touchedSubjectFolders))
+        # The README was deleted before we ever applied its creation, so it never changed the index
+        self.assertEqual(changedKeys, {'data/subject/trials/walk/markers.c3d', 'data/subject/_subject.json'})
+        self.assertEqual(touchedSubjectFolders, {'data/subject/'})
+        self.assertEqual(index.getMetadata('data/subject/trials/walk/markers.c3d').size, 3)
+        self.assertEqual(len(index.incomingMessages), 0)
+
+        # Deleting the _subject.json still reports its folder, even though it's no longer a subject
+        delete(index, 'data/subject/_subject.json')
+        self.assertEqual(index.getSubjectFolders(['data/subject/_subject.json']), {'data/subject/'})
+        self.assertEqual(index.getSubjectFolders(['data/subject/trials/walk/markers.c3d']), set())
+
+    def test_wait_wakes_up_for_messages(self):
+        index = makeIndex()
+        # Nothing is waiting, so this times out
+        start = time.time()
+        index.wait_for_incoming_messages(0.05)
+        self.assertGreaterEqual(time.time() - start, 0.04)
+
+        def sendMessage():
+            time.sleep(0.05)
+            index.queue_pub_sub_update_message('/UPDATE/data/b.c3d', json.dumps({
+                'key': 'data/b.c3d', 'size': 1, 'lastModified': 1, 'eTag': ''}))
+
+        sender = threading.Thread(target=sendMessage)
+        sender.start()
+        start = time.time()
+        index.wait_for_incoming_messages(10)
+        self.assertLess(time.time() - start, 5)
+        sender.join()
+
+        # Waking up doesn't need a message, and only lasts for one wait
+        index.process_incoming_messages()
+        index.wake_up()
+        start = time.time()
+        index.wait_for_incoming_messages(10)
+        self.assertLess(time.time() - start, 5)
+        start = time.time()
+        index.wait_for_incoming_messages(0.05)
+        self.assertGreaterEqual(time.time() - start, 0.04)
+
+
+class S3ClientMock:
+    def __init__(self):
+        self.calls = []
+
+    def put_object(self, **kwargs):
+        self.calls.append(('put_object', kwargs['Key'], kwargs.get('ChecksumSHA256'), None))
+
+    def upload_file(self, localPath, bucket, key, ExtraArgs=None, Config=None, Callback=None):
+        self.calls.append(('upload_file', key, None, ExtraArgs))
+
+
+class TestUploadFile(unittest.TestCase):
+    def upload(self, size: int, checksumSHA256=None):
+        index = makeIndex()
+        index.s3_low_level = S3ClientMock()
+        index.transferConfig.multipart_threshold = 1024
+        with tempfile.TemporaryDirectory() as tempDir:
+            localPath = os.path.join(tempDir, 'results.zip')
+            with open(localPath, 'wb') as f:
+                f.write(b'0' * size)
+            index.uploadFile('data/s/results.zip', localPath, checksumSHA256=checksumSHA256)
+        return index.s3_low_level.calls
+
+    def test_small_file_checked_against_whole_file_checksum(self):
+        self.assertEqual(self.upload(100, 'checksum'), [('put_object', 'data/s/results.zip', 'checksum', None)])
+
+    def test_large_file_with_checksum_still_goes_up_in_parts(self):
+        self.assertEqual(self.upload(4096, 'checksum'),
+                         [('upload_file', 'data/s/results.zip', None, {'ChecksumAlgorithm': 'SHA256'})])
+
+    def test_no_checksum(self):
+        self.assertEqual(self.upload(100), [('upload_file', 'data/s/results.zip', None, None)])
+
+
+class TestLocking(unittest.TestCase):
+    def test_reads_are_safe_while_messages_are_applied(self):
+        index = makeIndex()
+        errors = []
+        done = threading.Event()
+
+        def read():
+            try:
+                while not done.is_set():
+                    index.getChildren('data/')
+                    index.listAllFolders()
+            except Exception as e:
+                errors.append(e)
+
+        reader = threading.Thread(target=read)
+        reader.start()
+        for i in range(2000):
+            index.queue_pub_sub_update_message(
+                '', json.dumps({'key': 'data/s' + str(i % 50) + '/f' + str(i), 'size': 1, 'lastModified': i}))
+            if i % 10 == 0:
+                index.process_incoming_messages()
+        index.process_incoming_messages()
+        done.set()
+        reader.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(index.getChildren('data/')), 2000)
+
+
+class TestSnapshot(unittest.TestCase):
+    def test_snapshot_round_trip_and_catch_up(self):
+        with tempfile.TemporaryDirectory() as folder:
+            snapshotPath = os.path.join(folder, 'snapshots', 'index.sqlite')
+            index = makeIndex()
+            index.snapshotPath = snapshotPath
+            update(index, 'data/a/kept.c3d', 10, 100)
+            update(index, 'data/a/changed.c3d', 20, 100)
+            update(index, 'data/a/deleted.c3d', 30, 100)
+            index.saveSnapshot()
+            self.assertFalse(index.changedSinceSnapshot)
+
+            restarted = makeIndex()
+            self.assertTrue(restarted.loadSnapshot(snapshotPath))
+            self.assertFalse(restarted.caughtUp)
+            self.assertEqual(restarted.snapshotHighWaterMark, 100)
+            self.assertEqual(restarted.getImmediateChildren('data/')['a'].size, 60)
+            self.assertEqual(restarted.getMetadata('data/a/kept.c3d').eTag, 'etag')
+
+            # While the bucket is being listed, PubSub tells us about a new file, which the listing doesn't include
+            update(restarted, 'data/a/new.c3d', 5, 500)
+            listing = {
+                'data/a/kept.c3d': FileMetadata('data/a/kept.c3d', 100, 10, 'etag'),
+                'data/a/changed.c3d': FileMetadata('data/a/changed.c3d', 200, 25, 'etag2'),
+                'data/b/added.c3d': FileMetadata('data/b/added.c3d', 300, 40, 'etag'),
+            }
+            restarted.queue_catch_up_message(400, listing)
+            changedKeys = set()
+            self.assertTrue(restarted.process_incoming_messages(changedKeys))
+            self.assertEqual(changedKeys, {'data/a/changed.c3d', 'data/a/deleted.c3d', 'data/b/added.c3d'})
+            self.assertTrue(restarted.caughtUp)
+            self.assertEqual(set(restarted.getChildren('data/').keys()),
+                             {'a/kept.c3d', 'a/changed.c3d', 'a/new.c3d', 'b/added.c3d'})
+
+            # Catching up saves a fresh snapshot
+            self.assertEqual(makeIndex().loadSnapshot(snapshotPath), True)
+
+    def test_missing_snapshot(self):
+        with tempfile.TemporaryDirectory() as folder:
+            index = makeIndex()
+            self.assertFalse(index.loadSnapshot(os.path.join(folder, 'index.sqlite')))
+            self.assertTrue(index.caughtUp)
@@ -0,0 +1,154 @@
+import unittest
+import threading
+import time
+from typing import List
+from src.mocap_server import SubjectQueue, MocapServer
+
+
+class SubjectMock:
+    """
+    Just enough of a SubjectToProcess to sort it in the queue.
+    """
+    def __init__(self, subjectPath: str, timestamp: int):
+        self.subjectPath = subjectPath
+        self.timestamp = timestamp
+
+    def latestInputTimestamp(self) -> int:
+        return self.timestamp
+
+
+def paths(queue: SubjectQueue) -> List[str]:
+    return [subject.subjectPath for subject in queue.ordered()]
+
+
+class TestSubjectQueue(unittest.TestCase):
+    def test_add_orders_oldest_first(self):
+        queue = SubjectQueue()
+        queue.add(SubjectMock('data/b/', 20))
+        queue.add(SubjectMock('data/a/', 30))
+        queue.add(SubjectMock('data/c/', 10))
+        self.assertEqual(paths(queue), ['data/c/', 'data/b/', 'data/a/'])
+        self.assertEqual(queue.peek().subjectPath, 'data/c/')
+        self.assertEqual(len(queue), 3)
+        self.assertTrue('data/a/' in queue)
+        self.assertFalse('data/d/' in queue)
+
+    def test_standardized_goes_last(self):
+        queue = SubjectQueue()
+        queue.add(SubjectMock('standardized/a/', 10))
+        queue.add(SubjectMock('data/b/', 20))
+        self.assertEqual(paths(queue), ['data/b/', 'standardized/a/'])
+        self.assertEqual(queue.peek().subjectPath, 'data/b/')
+
+    def test_ties_break_on_path(self):
+        queue = SubjectQueue()
+        queue.add(SubjectMock('data/b/', 10))
+        queue.add(SubjectMock('data/a/', 10))
+        self.assertEqual(paths(queue), ['data/a/', 'data/b/'])
+        self.assertEqual(queue.peek().subjectPath, 'data/a/')
+
+    def test_move(self):
+        queue = SubjectQueue()
+        queue.add(SubjectMock('data/a/', 10))
+        queue.add(SubjectMock('data/b/', 20))
+        # Re-uploading a file makes the subject newer, so it moves to the back
+        moved = SubjectMock('data/a/', 30)
+        queue.add(moved)
+        self.assertEqual(paths(queue), ['data/b/', 'data/a/'])
+        self.assertEqual(queue.peek().subjectPath, 'data/b/')
+        self.assertEqual(len(queue), 2)
+        queue.remove('data/b/')
+        self.assertIs(queue.peek(), moved)
+
+    def test_add_again_keeps_latest_subject(self):
+        queue = SubjectQueue()
+        queue.add(SubjectMock('data/a/', 10))
+        version = queue.version
+        again = SubjectMock('data/a/', 10)
+        queue.add(again)
+        self.assertIs(queue.peek(), again)
+        self.assertEqual(len(queue.heap), 1)
+        # The order didn't change, so neither does the version
+        self.assertEqual(queue.version, version)
+
+    def test_remove(self):
+        queue = SubjectQueue()
+        queue.add(SubjectMock('data/a/', 10))
+        queue.add(SubjectMock('data/b/', 20))
+        version = queue.version
+        queue.remove('data/a/')
+        self.assertGreater(queue.version, version)
+        self.assertEqual(paths(queue), ['data/b/'])
+        self.assertEqual(queue.peek().subjectPath, 'data/b/')
+        self.assertFalse('data/a/' in queue)
+        # Removing something that isn't queued does nothing
+        version = queue.version
+        queue.remove('data/missing/')
+        self.assertEqual(queue.version, version)
+        queue.remove('data/b/')
+        self.assertIsNone(queue.peek())
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(paths(queue), [])
+
+    def test_peek_empty(self):
+        self.assertIsNone(SubjectQueue().peek())
+
+    def test_iterate_skips_stale_entries(self):
+        queue = SubjectQueue()
+        queue.add(SubjectMock('data/a/', 10))
+        queue.add(SubjectMock('data/b/', 20))
+        queue.add(SubjectMock('data/c/', 30))
+        # Move a subject away and back again, so the heap holds its old spot twice
+        queue.add(SubjectMock('data/a/', 40))
+        queue.add(SubjectMock('data/a/', 10))
+        queue.remove('data/b/')
+        self.assertEqual([subject.subjectPath for subject in queue.iterate()], ['data/a/', 'data/c/'])
+        self.assertEqual([subject.subjectPath for subject in queue.iterate()], paths(queue))
+
+    def test_iterate_is_lazy(self):
+        queue = SubjectQueue()
+        for i in range(100):
+            queue.add(SubjectMock('data/' + str(i) + '/', i))
+        subjects = queue.iterate()
+        self.assertEqual(next(subjects).subjectPath, 'data/0/')
+        self.assertEqual(next(subjects).subjectPath, 'data/1/')
+        # Iterating doesn't touch the queue itself
+        self.assertEqual(len(queue.heap), 100)
+        self.assertEqual(queue.peek().subjectPath, 'data/0/')
+
+    def test_next_subject_skips_recently_finished_head(self):
+        server = MocapServer.__new__(MocapServer)
+        server.queue = SubjectQueue()
+        server.workerLock = threading.Lock()
+        server.recentlyFinished = {}
+        server.queue.add(SubjectMock('data/a/', 10))
+        server.queue.add(SubjectMock('data/b/', 20))
+        server.queue.add(SubjectMock('data/c/', 30))
+        self.assertEqual(server.next_subject_to_process().subjectPath, 'data/a/')
+        server.recentlyFinished['data/a/'] = time.time()
+        self.assertEqual(server.next_subject_to_process().subjectPath, 'data/b/')
+        server.recentlyFinished['data/b/'] = time.time()
+        self.assertEqual(server.next_subject_to_process().subjectPath, 'data/c/')
+        server.recentlyFinished['data/c/'] = time.time()
+        self.assertIsNone(server.next_subject_to_process())
+        # Once the cooldown runs out, the head is up for grabs again
+        server.recentlyFinished['data/a/'] = 0.0
+        self.assertEqual(server.next_subject_to_process().subjectPath, 'data/a/')
+
+    def test_compaction(self):
+        queue = SubjectQueue()
+        for i in range(10):
+            queue.add(SubjectMock('data/' + str(i) + '/', i))
+        # Moving the same subject over and over leaves stale entries behind in the heap, which get compacted away
+        for timestamp in range(100, 1100):
+            queue.add(SubjectMock('data/0/', timestamp))
+            self.assertLessEqual(len(queue.heap), 2 * len(queue) + 16)
+        for i in range(1, 10):
+            queue.remove('data/' + str(i) + '/')
+            self.assertLessEqual(len(queue.heap), 2 * len(queue) + 16)
+        self.assertEqual(paths(queue), ['data/0/'])
+        self.assertEqual(queue.peek().latestInputTimestamp(), 1099)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import unittest
+import os
+import tempfile
+import threading
+from typing import Dict, List
+from src.reactive_s3.transfer_manager import TransferManager
+
+
+class FileMetadataMock:
+    def __init__(self, size: int):
+        self.size = size
+
+
+class ReactiveS3IndexMock:
+    """
+    Just enough of a ReactiveS3Index to transfer files, where the transfers report their progress in two halves, and
+    each file can be set up to fail a number of times before it succeeds.
+    """
+    def __init__(self, sizes: Dict[str, int], failures: Dict[str, int] = {}):
+        self.sizes = sizes
+        self.failures = dict(failures)
+        self.attempts: List[str] = []
+        self.uploaded: Dict[str, str] = {}
+        self.lock = threading.Lock()
+
+    def exists(self, path: str) -> bool:
+        return path in self.sizes
+
+    def getMetadata(self, path: str) -> FileMetadataMock:
+        return FileMetadataMock(self.sizes[path])
+
+    def transfer(self, bucketPath: str, size: int, callback):
+        with self.lock:
+            self.attempts.append(bucketPath)
+            shouldFail = self.failures.get(bucketPath, 0) > 0
+            if shouldFail:
+                self.failures[bucketPath] -= 1
+        callback(size // 2)
+        if shouldFail:
+            raise IOError('Connection reset while transferring ' + bucketPath)
+        callback(size - size // 2)
+
+    def download(self, bucketPath: str, localPath: str, callback=None):
+        self.transfer(bucketPath, self.sizes[bucketPath], callback)
+        with open(localPath, 'w') as f:
+            f.write(bucketPath)
+
+    def uploadFile(self, bucketPath: str, localPath: str, checksumSHA256=None, callback=None):
+        self.transfer(bucketPath, os.path.getsize(localPath), callback)
+        with self.lock:
+            self.uploaded[bucketPath] = localPath
+
+
+class TestTransferManager(unittest.TestCase):
+    def test_download(self):
+        index = ReactiveS3IndexMock({'subject/trials/a/markers.c3d': 1000, 'subject/trials/b/markers.c3d': 3000})
+        progress = []
+        with tempfile.TemporaryDirectory() as tmp:
+            with TransferManager(index, maxWorkers=4, progressCallback=lambda done, total: progress.append(
+                    (done, total))) as transfers:
+                for trial in ['a', 'b']:
+                    transfers.download('subject/trials/' + trial + '/markers.c3d',
+                                       os.path.join(tmp, trial, 'markers.c3d'))
+                transfers.wait()
+            for trial in ['a', 'b']:
+                with open(os.path.join(tmp, trial, 'markers.c3d')) as f:
+                    self.assertEqual(f.read(), 'subject/trials/' + trial + '/markers.c3d')
+        self.assertEqual(progress[-1], (4000, 4000))
+
+    def test_retries_with_backoff(self):
+        index = ReactiveS3IndexMock({'subject/_subject.json': 100}, failures={'subject/_subject.json': 2})
+        progress = []
+        with tempfile.TemporaryDirectory() as tmp:
+            with TransferManager(index, backoffSeconds=0.0, progressCallback=lambda done, total: progress.append(
+                    (done, total))) as transfers:
+                transfers.download('subject/_subject.json', os.path.join(tmp, '_subject.json'))
+                transfers.wait()
+        self.assertEqual(index.attempts, ['subject/_subject.json'] * 3)
+        # The bytes from the failed attempts don't count towards the progress
+        self.assertEqual(progress[-1], (100, 100))
+
+    def test_wait_raises_after_last_attempt(self):
+        index = ReactiveS3IndexMock({}, failures={'subject/log.txt': 10})
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, 'log.txt'), 'w') as f:
+                f.write('log')
+            with TransferManager(index, maxAttempts=3, backoffSeconds=0.0) as transfers:
+                transfers.upload('subject/log.txt', os.path.join(tmp, 'log.txt'))
+                with self.assertRaises(IOError):
+                    transfers.wait()
+        self.assertEqual(index.attempts, ['subject/log.txt'] * 3)
+        self.assertEqual(index.uploaded, {})
+
+    def test_upload(self):
+        index = ReactiveS3IndexMock({})
+        with tempfile.TemporaryDirectory() as tmp:
+            for i in range(20):
+                with open(os.path.join(tmp, str(i) + '.json'), 'w') as f:
+                    f.write('{}')
+            with TransferManager(index, maxWorkers=8) as transfers:
+                for i in range(20):
+                    transfers.upload('subject/' + str(i) + '.json', os.path.join(tmp, str(i) + '.json'))
+                transfers.wait()
+        self.assertEqual(len(index.uploaded), 20)
@@ -5,6 +5,7 @@ import json
 import numpy as np
 import os
 import importlib.resources
+from utilities.fork_pool import fork_pool_map
 
 
 class ThresholdsDetector(AbstractDetector):
@@ -68,6 +69,33 @@ class ThresholdsDetector(AbstractDetector):
             }
         }
 
+    @staticmethod
+    def get_marker_tensor(marker_observations: List[Dict[str, np.ndarray]]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Pack the per-frame marker dictionaries into a single array, so that checks over the marker cloud can be done as
+        whole-trial array operations.
+
+        :param marker_observations:
+        :return: A (T, M, 3) array of marker positions, with NaN wherever a marker is not observed, and a (T, M) boolean
+        array which is True wherever a marker is observed
+        """
+        marker_names: Dict[str, int] = {}
+        for obs in marker_observations:
+            for marker_name in obs:
+                if marker_name not in marker_names:
+                    marker_names[marker_name] = len(marker_names)
+
+        trial_len = len(marker_observations)
+        markers = np.full((trial_len, len(marker_names), 3), np.nan)
+        observed = np.zeros((trial_len, len(marker_names)), dtype=bool)
+        for t, obs in enumerate(marker_observations):
+            if len(obs) == 0:
+                continue
+            columns = [marker_names[marker_name] for marker_name in obs]
+            markers[t, columns, :] = np.array(list(obs.values()), dtype=np.float64).reshape((-1, 3))
+            observed[t, columns] = True
+        return markers, observed
+
     @staticmethod
     def has_input_outliers(trial_header: nimble.biomechanics.SubjectOnDiskTrial,
                            raw_force_plate_forces: List[List[np.ndarray]]) -> bool:
@@ -77,41 +105,33 @@ class ThresholdsDetector(AbstractDetector):
         :return:
         """
         marker_observations: List[Dict[str, np.ndarray]] = trial_header.getMarkerObservations()
+        markers, observed = ThresholdsDetector.get_marker_tensor(marker_observations)
+        trial_len = markers.shape[0]
 
-        for t in range(len(marker_observations)):
+        # 1. Check for any marker that is too far from the median of the marker cloud
 
-            # 1. Check for any marker that is too far from the median of the marker cloud
-
-            # 1.1. Collect the median of the marker cloud
-            marker_xs: List[float] = []
-            marker_ys: List[float] = []
-            marker_zs: List[float] = []
-            for marker_name in marker_observations[t]:
-                marker_pos = marker_observations[t][marker_name]
-                marker_xs.append(marker_pos[0])
-                marker_ys.append(marker_pos[1])
-                marker_zs.append(marker_pos[2])
-            median_x = np.median(marker_xs)
-            median_y = np.median(marker_ys)
-            median_z = np.median(marker_zs)
+        # 1.1. Collect the median of the marker cloud. Frames with no markers have nothing to check, and (to match taking
+        # the plain median of every observed value) a non-finite observation makes the whole frame's median undefined,
+        # so those frames are skipped too.
+        has_markers = np.any(observed, axis=1)
+        has_nan = np.any(observed[:, :, np.newaxis] & np.isnan(markers), axis=(1, 2))
+        checked_frames = has_markers & ~has_nan
+        if np.any(checked_frames):
+            checked_markers = markers[checked_frames]
+            medians = np.nanmedian(checked_markers, axis=1)
 
             # 1.2. Check the distance of each marker from the median
-            any_out_of_bounds = False
-            for marker_name in marker_observations[t]:
-                marker_pos = marker_observations[t][marker_name]
-                if np.linalg.norm(marker_pos - np.array([median_x, median_y, median_z])) > 2.5:
-                    any_out_of_bounds = True
-                    break
-
-            if any_out_of_bounds:
+            distances = np.linalg.norm(checked_markers - medians[:, np.newaxis, :], axis=2)
+            if np.any(np.nan_to_num(distances, nan=0.0) > 2.5):
                 return True
 
-            # 2. Check for any force plate that has a total force magnitude greater than 2500 N
+        # 2. Check for any force plate that has a total force magnitude greater than 2500 N
+        for plate in range(len(raw_force_plate_forces)):
+            forces = np.array(raw_force_plate_forces[plate], dtype=np.float64).reshape((-1, 3))[:trial_len]
+            if np.any(np.linalg.norm(forces, axis=1) > 2500.0):
+                return True
 
-            for plate in range(len(raw_force_plate_forces)):
-                force = raw_force_plate_forces[plate][t]
-                if np.linalg.norm(force) > 2500.0:
-                    return True
+        return False
 
     @staticmethod
     def smooth_positions(dt: float, frames: nimble.biomechanics.FrameList) -> Tuple[np.ndarray, np.ndarray]:
@@ -260,137 +280,344 @@ class ThresholdsDetector(AbstractDetector):
 
         return largest_min_weighted_distance
 
-    def estimate_missing_grfs(self, subject: nimble.biomechanics.SubjectOnDisk, trials: List[int]) -> List[List[nimble.biomechanics.MissingGRFReason]]:
-        osim: nimble.biomechanics.OpenSimFile = subject.readOpenSimFile(processingPass=0, ignoreGeometry=True)
-        skel: nimble.dynamics.Skeleton = osim.skeleton
-        foot_markers: List[List[Tuple[nimble.dynamics.BodyNode, np.ndarray]]] = self.get_foot_marker_sets(osim)
-        foot_bodies = [skel.getBodyNode(body_name) for body_name in subject.getGroundForceBodies()]
+    @staticmethod
+    def distance_points_to_convex_hulls_2d(points: np.ndarray, hull_points: np.ndarray) -> np.ndarray:
+        """
+        Get the distance from each 2D point to the convex hull of its own small set of 2D points, for a whole batch at
+        once. Points inside the hull have a distance of 0.
 
-        if not subject.hasLoadedAllFrames():
-            subject.loadAllFrames(doNotStandardizeForcePlateData=True)
-        trial_protos = subject.getHeaderProto().getTrials()
+        Rather than building each hull explicitly, this relies on two facts about small point sets: a point outside
+        the hull is closest to one of the hull edges, which are a subset of the segments between all pairs of points
+        (and every other such segment lies inside the hull, so it can't be any closer), and a point is inside the hull
+        if and only if it is inside one of the triangles formed by triples of points.
 
-        result: List[List[nimble.biomechanics.MissingGRFReason]] = []
-        for trial in trials:
-            trial_len = subject.getTrialLength(trial)
-            trial_proto = trial_protos[trial]
+        :param points: An (N, 2) array of query points
+        :param hull_points: An (N, K, 2) array, holding the K points whose convex hull we test against for each query
+        :return: An (N,) array of distances
+        """
+        num_points = points.shape[0]
+        k = hull_points.shape[1]
+        if num_points == 0:
+            return np.zeros(0)
+        if k == 0:
+            return np.full(num_points, np.inf)
+        if k == 1:
+            return np.linalg.norm(points - hull_points[:, 0, :], axis=1)
+
+        # 1. Distance to the closest segment between any pair of points
+        pair_i, pair_j = np.triu_indices(k, 1)
+        a = hull_points[:, pair_i, :]
+        ab = hull_points[:, pair_j, :] - a
+        ap = points[:, np.newaxis, :] - a
+        ab_squared = np.sum(ab * ab, axis=2)
+        safe_ab_squared = np.where(ab_squared > 0.0, ab_squared, 1.0)
+        s = np.clip(np.sum(ap * ab, axis=2) / safe_ab_squared, 0.0, 1.0)
+        s = np.where(ab_squared > 0.0, s, 0.0)
+        closest_offsets = ap - s[:, :, np.newaxis] * ab
+        distances = np.min(np.linalg.norm(closest_offsets, axis=2), axis=1)
+
+        # 2. Zero out the points that fall inside any triangle of points
+        if k >= 3:
+            triangles = np.array([(i, j, l) for i in range(k) for j in range(i + 1, k) for l in range(j + 1, k)])
+            v0 = hull_points[:, triangles[:, 0], :]
+            v1 = hull_points[:, triangles[:, 1], :]
+            v2 = hull_points[:, triangles[:, 2], :]
+            p = points[:, np.newaxis, :]
+
+            def cross(o: np.ndarray, u: np.ndarray, v: np.ndarray) -> np.ndarray:
+                return (u[..., 0] - o[..., 0]) * (v[..., 1] - o[..., 1]) - (u[..., 1] - o[..., 1]) * (v[..., 0] - o[..., 0])
+
+            d0 = cross(v0, v1, p)
+            d1 = cross(v1, v2, p)
+            d2 = cross(v2, v0, p)
+            has_negative = (d0 < 0) | (d1 < 0) | (d2 < 0)
+            has_positive = (d0 > 0) | (d1 > 0) | (d2 > 0)
+            # Collinear triples have no interior, and points on them are already at distance 0 from their segments
+            non_degenerate = cross(v0, v1, v2) != 0.0
+            inside = np.any(non_degenerate & ~(has_negative & has_positive), axis=1)
+            distances = np.where(inside, 0.0, distances)
+
+        return distances
 
-            passes = trial_proto.getPasses()
+    @staticmethod
+    def get_foot_marker_world_positions(skel: nimble.dynamics.Skeleton,
+                                        foot_markers: List[List[Tuple[nimble.dynamics.BodyNode, np.ndarray]]],
+                                        positions: np.ndarray,
+                                        frames: np.ndarray) -> List[np.ndarray]:
+        """
+        Get the world positions of every foot marker on the requested frames, so that they can be reused across all
+        the force plates instead of being recomputed per plate, per foot, per frame.
 
-            raw_force_plates: List[nimble.biomechanics.ForcePlate] = trial_proto.getForcePlates()
-            raw_force_plate_forces: List[List[np.ndarray]] = [plate.forces for plate in raw_force_plates]
-            raw_force_plate_cops: List[List[np.ndarray]] = [plate.centersOfPressure for plate in raw_force_plates]
+        :param skel:
+        :param foot_markers:
+        :param positions:
+        :param frames: The frame indices to compute marker positions for
+        :return: One (len(frames), num_markers, 3) array per foot
+        """
+        foot_marker_positions = [np.zeros((len(frames), len(markers), 3)) for markers in foot_markers]
+        for i, t in enumerate(frames):
+            skel.setPositions(positions[:, t])
+            for b in range(len(foot_markers)):
+                foot_marker_positions[b][i, :, :] = np.reshape(skel.getMarkerWorldPositions(foot_markers[b]), (-1, 3))
+        return foot_marker_positions
 
-            # 1. Rapidly check if the entire trial is bad for some reason that can be checked cheaply, without running
-            # the smoother first.
+    @staticmethod
+    def get_force_weighted_convex_foot_cop_error_batched(contact_frames: np.ndarray,
+                                                         foot_marker_positions: List[np.ndarray],
+                                                         force_plate_forces: np.ndarray,
+                                                         force_plate_cops: np.ndarray,
+                                                         dt: float) -> float:
+        """
+        A batched equivalent of get_force_weighted_convex_foot_cop_error(), which computes the 2D convex hull distances
+        for all the in-contact frames in one vectorized sweep, and then reduces them over each contiguous contact
+        period on each force plate.
+
+        :param contact_frames: The sorted frame indices where at least one force plate has more than 10 N of force
+        :param foot_marker_positions: One (len(contact_frames), num_markers, 3) array per foot, from
+        get_foot_marker_world_positions()
+        :param force_plate_forces: A (num_plates, trial_len, 3) array of raw force plate forces
+        :param force_plate_cops: A (num_plates, trial_len, 3) array of raw force plate centers of pressure
+        :param dt:
+        :return:
+        """
+        num_contact_bodies = len(foot_marker_positions)
+        num_force_plates = force_plate_forces.shape[0]
+        if num_contact_bodies == 0 or num_force_plates == 0 or len(contact_frames) == 0:
+            return 0.0
+        trial_len = force_plate_forces.shape[1]
+
+        # Map from a frame index to its row in the precomputed marker arrays
+        contact_row = np.full(trial_len, -1, dtype=np.int64)
+        contact_row[contact_frames] = np.arange(len(contact_frames))
+
+        force_mags = np.linalg.norm(force_plate_forces, axis=2)
+        in_contact = force_mags > 10.0
+
+        # The distances are measured in the plane orthogonal to the Y axis, so we only need the X and Z coordinates
+        plate_index, frame_index = np.nonzero(in_contact)
+        cops_2d = force_plate_cops[plate_index, frame_index][:, [0, 2]]
+        rows = contact_row[frame_index]
+        weighted_distances = np.zeros((num_contact_bodies, num_force_plates, trial_len))
+        for b in range(num_contact_bodies):
+            hulls_2d = foot_marker_positions[b][rows][:, :, [0, 2]]
+            distances = ThresholdsDetector.distance_points_to_convex_hulls_2d(cops_2d, hulls_2d)
+            weighted_distances[b, plate_index, frame_index] = distances * force_mags[plate_index, frame_index]
+        contact_force_mags = np.where(in_contact, force_mags, 0.0)
 
-            # 1.1. If the marker RMS is greater than 8cm on average, the trial is probably bad in the IK somehow, and
-            # we should mark the entire trial as excluded.
-            if np.mean(subject.getTrialMarkerRMSs(trial, 0)) > 0.08:
-                result.append([nimble.biomechanics.MissingGRFReason.tooHighMarkerRMS] * trial_len)
-                continue
-            # 1.2. If the inputs have crazy outliers (markers that are too far from the median, or force plates with
-            # forces greater than 2500 N), we should mark the entire trial as excluded, because those crazy outliers
-            # will tend to drag the other optimization steps to crazy places.
-            elif self.has_input_outliers(trial_proto, raw_force_plate_forces):
-                result.append([nimble.biomechanics.MissingGRFReason.hasInputOutliers] * trial_len)
+        largest_min_weighted_distance = 0.0
+        for f in range(num_force_plates):
+            edges = np.flatnonzero(np.diff(np.concatenate([[0], in_contact[f].astype(np.int8), [0]])))
+            starts = edges[0::2]
+            if len(starts) == 0:
                 continue
-            # 1.3. If the trial has no force plate data, we should mark the entire trial as excluded, because we can't
-            # use data that doesn't have force plates to do dynamics optimization.
-            if len(raw_force_plate_forces) == 0:
-                result.append([nimble.biomechanics.MissingGRFReason.hasNoForcePlateData] * trial_len)
+            # Frames between contact periods contribute zeros, so summing from each start to the next start gives the
+            # total over just that contact period.
+            period_distances = np.add.reduceat(weighted_distances[:, f, :], starts, axis=1)
+            # The unbatched implementation adds each frame's force once per contact body, so we match that here to
+            # produce identical weighted averages and thresholds.
+            period_forces = np.add.reduceat(contact_force_mags[f], starts) * num_contact_bodies
+            valid = period_forces * dt > 10.0
+            if not np.any(valid):
                 continue
+            min_weighted_distances = np.min(period_distances[:, valid] / period_forces[valid], axis=0)
+            largest_min_weighted_distance = max(largest_min_weighted_distance, float(np.max(min_weighted_distances)))
 
-            # 2. Get the smoothed positions and velocities. We do this by getting the poses from the second pass, which
-            # is the acceleration minimizing smoother. If the trial doesn't have this pass, we mark the entire trial as
-            # excluded.
-            if len(passes) < 2 or passes[1].getType() != nimble.biomechanics.ProcessingPassType.ACC_MINIMIZING_FILTER:
-                result.append([nimble.biomechanics.MissingGRFReason.hasInputOutliers] * trial_len)
-                continue
-            poses = passes[1].getPoses()
-            vels = passes[1].getVels()
-
-            # 3. Check if the trial has badly wrapped IK based on the smoothed velocities. In theory, the previous code
-            # should prevent this from happening, but it seems in our dataset that sometimes the IK can still produce
-            # angular wrapping situations, where a joint angle jumps from 0 to 2PI, for example. When we smooth the
-            # position jump, this manifests as unrealistically high velocities.
-            if np.max(np.abs(vels)) > 40.0:
-                result.append([nimble.biomechanics.MissingGRFReason.velocitiesStillTooHighAfterFiltering] * trial_len)
-                continue
+        return largest_min_weighted_distance
 
-            # 4. We can now begin the more computationally expensive checks. Here, we're checking that the center of
-            # pressure is generally beneath the convex hull outline of a foot. The convex hull is defined by a set of
-            # markers given at the top of the file. If the CoP is outside the convex hull, we mark the frame as bad,
-            # because something is probably wrong with the force plate data. Often this can be a force plate that's
-            # miscalibrated in space, or someone has a bug in their CoP calculation code.
-            dt = subject.getTrialTimestep(trial)
-            cop_foot_error = self.get_force_weighted_convex_foot_cop_error(skel,
-                                                                           foot_markers,
-                                                                           poses,
-                                                                           raw_force_plate_forces,
-                                                                           raw_force_plate_cops,
-                                                                           dt)
-            if cop_foot_error > 0.01:
-                print(f"!! Trial {trial} has a force-weighted center-of-pressure-outside-of-foot error of {cop_foot_error}m, which is higher than the threshold of 0.01m.")
-                result.append([nimble.biomechanics.MissingGRFReason.copOutsideConvexFootError] * trial_len)
-                continue
+    @staticmethod
+    def get_farthest_larger_force_offsets(force_mags: np.ndarray, extend_frames: int) -> np.ndarray:
+        """
+        For every frame i, find the largest offset j in [1, extend_frames] such that force_mags[i] < force_mags[i + j],
+        or 0 if there is no such frame. This is one whole-trial comparison per offset, so it is linear in the trial
+        length.
 
-            # 5. Estimate the trial type -- this is most important for identifying treadmill trials, which will tend to
-            # have almost all steps on the force plates. Overground trials need further attention.
-            trial_type = trial_proto.getBasicTrialType()
-
-            # 6. Check for missing GRFs on footsteps off force plates, for data that is overground and has passed all
-            # the other checks -- For now we just check if the total force magnitude is less than 10 N. This has the
-            # obvious problem that if you have overground sprinting, we will exclude flight phase frames. Because this
-            # case is so rare, I'm comfortable just asking users to manually annotate those frames, if they care about
-            # getting dynamics on them. We can always come back and add a more sophisticated heuristic later. This is
-            # a simple and extremely effective heuristic, which catches 99.8% of remaining bad frames in the dataset.
-            if trial_type == nimble.biomechanics.BasicTrialType.OVERGROUND:
-                missing = []
-                force_mags: List[float] = []
-                # 6.1. Grab the frames with too little force, mark them as missing.
-                for i in range(trial_len):
-                    forces = [raw_force_plate_forces[f][i] for f in range(len(raw_force_plate_forces))]
-                    total_force_mag = 0.0
-                    for force in forces:
-                        total_force_mag += np.linalg.norm(force)
-                    if total_force_mag < 10.0:
-                        missing.append(nimble.biomechanics.MissingGRFReason.zeroForceFrame)
-                    else:
-                        missing.append(nimble.biomechanics.MissingGRFReason.notMissingGRF)
-                    force_mags.append(total_force_mag)
-
-                # 6.2. Now we can go through and extend all the missing segments into the "rising force ramp" and
-                # "falling force ramp" regions at the edge of the missing segments.
-
-                # 6.2.1. Start with the rising force ramp, which we can tell by checking left-to-right if any frame has
-                # more force magnitude than any of the previous few frames which may have been marked as missing, and
-                # if so, extend the missing segment to include that frame.
-                extend_frames = 20
-                extended_frames = 0
-
-                for i in range(trial_len):
-                    if missing[i] != nimble.biomechanics.MissingGRFReason.notMissingGRF or i == 0:
-                        for j in range(1, extend_frames + 1):
-                            if i + j < trial_len and force_mags[i] < force_mags[i + j]:
-                                for k in range(j):
-                                    if not missing[i + k]:
-                                        extended_frames += 1
-                                    missing[i + k] = nimble.biomechanics.MissingGRFReason.extendedToNearestPeakForce
-                                # break
-
-                # 6.2.2. Now do the same for the falling force ramp, but right-to-left.
-                for i in range(trial_len - 1, -1, -1):
-                    if missing[i] != nimble.biomechanics.MissingGRFReason.notMissingGRF or i == trial_len - 1:
-                        for j in range(1, extend_frames + 1):
-                            if i - j >= 0 and force_mags[i] < force_mags[i - j]:
-                                for k in range(j):
-                                    if not missing[i - k]:
-                                        extended_frames += 1
-                                    missing[i - k] = nimble.biomechanics.MissingGRFReason.extendedToNearestPeakForce
-                                # break
-
-                result.append(missing)
-            else:
-                result.append([nimble.biomechanics.MissingGRFReason.notMissingGRF] * trial_len)
-        return result
\ No newline at end of file
+        :param force_mags:
+        :param extend_frames:
+        :return: An integer array with the same length as force_mags
+        """
+        trial_len = len(force_mags)
+        offsets = np.zeros(trial_len, dtype=np.int64)
+        for j in range(1, min(extend_frames, trial_len - 1) + 1):
+            offsets[:trial_len - j][force_mags[:trial_len - j] < force_mags[j:]] = j
+        return offsets
+
+    @staticmethod
+    def extend_missing_into_force_ramp(missing: List[nimble.biomechanics.MissingGRFReason],
+                                       force_mags: np.ndarray,
+                                       extend_frames: int) -> List[nimble.biomechanics.MissingGRFReason]:
+        """
+        Extend the missing segments left-to-right into the rising force ramps that follow them. Starting from every
+        frame that is missing (or the first frame), every frame up to (but not including) the farthest frame within
+        `extend_frames` that has more force is marked as extendedToNearestPeakForce. Frames marked this way count as
+        missing themselves, so the extension cascades forward. To get the falling force ramps, call this on the
+        reversed inputs and reverse the result.
+
+        This produces exactly the labels of the original nested-loop implementation, in a single left-to-right pass.
+
+        :param missing:
+        :param force_mags:
+        :param extend_frames:
+        :return: A new list of labels
+        """
+        trial_len = len(missing)
+        offsets = ThresholdsDetector.get_farthest_larger_force_offsets(np.asarray(force_mags), extend_frames).tolist()
+        result = list(missing)
+        # Every frame before `reach` is covered by the extension of some earlier (or the current) missing frame
+        reach = 0
+        for i in range(trial_len):
+            if i == 0 or i < reach or missing[i] != nimble.biomechanics.MissingGRFReason.notMissingGRF:
+                reach = max(reach, i + offsets[i])
+            if i < reach:
+                result[i] = nimble.biomechanics.MissingGRFReason.extendedToNearestPeakForce
+        return result
+
+    def estimate_missing_grfs(self,
+                              subject: nimble.biomechanics.SubjectOnDisk,
+                              trials: List[int],
+                              num_processes: int = 1) -> List[List[nimble.biomechanics.MissingGRFReason]]:
+        """
+        Estimate the MissingGRFReason for every frame of each of the requested trials.
+
+        Each trial is classified independently, so if `num_processes` is greater than 1 the trials are split across a
+        pool of worker processes. The workers are forked from this process, so they share the already-loaded subject,
+        and each one builds its own skeleton and foot marker sets once, on startup. The results are returned in the
+        same order as `trials` either way.
+        """
+        if not subject.hasLoadedAllFrames():
+            subject.loadAllFrames(doNotStandardizeForcePlateData=True)
+
+        if num_processes > 1 and len(trials) > 1:
+            return self.estimate_missing_grfs_in_parallel(subject, trials, num_processes)
+
+        skel, foot_markers = self.load_skeleton_and_foot_markers(subject)
+        return [self.estimate_missing_grfs_for_trial(subject, trial, skel, foot_markers) for trial in trials]
+
+    def estimate_missing_grfs_in_parallel(self,
+                                          subject: nimble.biomechanics.SubjectOnDisk,
+                                          trials: List[int],
+                                          num_processes: int) -> List[List[nimble.biomechanics.MissingGRFReason]]:
+        # The enum values are sent back as plain ints, and converted back here in trial order
+        trial_results: List[List[int]] = fork_pool_map(_estimate_missing_grfs_worker, trials, (self, subject),
+                                                       num_processes, initializer=_init_missing_grf_worker)
+        return [[nimble.biomechanics.MissingGRFReason(reason) for reason in reasons] for reasons in trial_results]
+
+    def load_skeleton_and_foot_markers(self, subject: nimble.biomechanics.SubjectOnDisk) -> Tuple[
+            nimble.dynamics.Skeleton, List[List[Tuple[nimble.dynamics.BodyNode, np.ndarray]]]]:
+        osim: nimble.biomechanics.OpenSimFile = subject.readOpenSimFile(processingPass=0, ignoreGeometry=True)
+        skel: nimble.dynamics.Skeleton = osim.skeleton
+        foot_markers: List[List[Tuple[nimble.dynamics.BodyNode, np.ndarray]]] = self.get_foot_marker_sets(osim)
+        return skel, foot_markers
+
+    def estimate_missing_grfs_for_trial(self,
+                                        subject: nimble.biomechanics.SubjectOnDisk,
+                                        trial: int,
+                                        skel: nimble.dynamics.Skeleton,
+                                        foot_markers: List[List[Tuple[nimble.dynamics.BodyNode, np.ndarray]]]) -> List[
+            nimble.biomechanics.MissingGRFReason]:
+        trial_protos = subject.getHeaderProto().getTrials()
+        trial_len = subject.getTrialLength(trial)
+        trial_proto = trial_protos[trial]
+
+        passes = trial_proto.getPasses()
+
+        raw_force_plates: List[nimble.biomechanics.ForcePlate] = trial_proto.getForcePlates()
+        raw_force_plate_forces: List[List[np.ndarray]] = [plate.forces for plate in raw_force_plates]
+        raw_force_plate_cops: List[List[np.ndarray]] = [plate.centersOfPressure for plate in raw_force_plates]
+
+        # 1. Rapidly check if the entire trial is bad for some reason that can be checked cheaply, without running
+        # the smoother first.
+
+        # 1.1. If the marker RMS is greater than 8cm on average, the trial is probably bad in the IK somehow, and
+        # we should mark the entire trial as excluded.
+        if np.mean(subject.getTrialMarkerRMSs(trial, 0)) > 0.08:
+            return [nimble.biomechanics.MissingGRFReason.tooHighMarkerRMS] * trial_len
+        # 1.2. If the inputs have crazy outliers (markers that are too far from the median, or force plates with
+        # forces greater than 2500 N), we should mark the entire trial as excluded, because those crazy outliers
+        # will tend to drag the other optimization steps to crazy places.
+        elif self.has_input_outliers(trial_proto, raw_force_plate_forces):
+            return [nimble.biomechanics.MissingGRFReason.hasInputOutliers] * trial_len
+        # 1.3. If the trial has no force plate data, we should mark the entire trial as excluded, because we can't
+        # use data that doesn't have force plates to do dynamics optimization.
+        if len(raw_force_plate_forces) == 0:
+            return [nimble.biomechanics.MissingGRFReason.hasNoForcePlateData] * trial_len
+
+        # 2. Get the smoothed positions and velocities. We do this by getting the poses from the second pass, which
+        # is the acceleration minimizing smoother. If the trial doesn't have this pass, we mark the entire trial as
+        # excluded.
+        if len(passes) < 2 or passes[1].getType() != nimble.biomechanics.ProcessingPassType.ACC_MINIMIZING_FILTER:
+            return [nimble.biomechanics.MissingGRFReason.hasInputOutliers] * trial_len
+        poses = passes[1].getPoses()
+        vels = passes[1].getVels()
+
+        # 3. Check if the trial has badly wrapped IK based on the smoothed velocities. In theory, the previous code
+        # should prevent this from happening, but it seems in our dataset that sometimes the IK can still produce
+        # angular wrapping situations, where a joint angle jumps from 0 to 2PI, for example. When we smooth the
+        # position jump, this manifests as unrealistically high velocities.
+        if np.max(np.abs(vels)) > 40.0:
+            return [nimble.biomechanics.MissingGRFReason.velocitiesStillTooHighAfterFiltering] * trial_len
+
+        # 4. We can now begin the more computationally expensive checks. Here, we're checking that the center of
+        # pressure is generally beneath the convex hull outline of a foot. The convex hull is defined by a set of
+        # markers given at the top of the file. If the CoP is outside the convex hull, we mark the frame as bad,
+        # because something is probably wrong with the force plate data. Often this can be a force plate that's
+        # miscalibrated in space, or someone has a bug in their CoP calculation code.
+        dt = subject.getTrialTimestep(trial)
+        force_plate_forces = np.array(raw_force_plate_forces, dtype=np.float64).reshape(
+            (len(raw_force_plate_forces), -1, 3))
+        force_plate_cops = np.array(raw_force_plate_cops, dtype=np.float64).reshape(
+            (len(raw_force_plate_cops), -1, 3))
+        contact_frames = np.flatnonzero(np.any(np.linalg.norm(force_plate_forces, axis=2) > 10.0, axis=0))
+        foot_marker_positions = self.get_foot_marker_world_positions(skel, foot_markers, poses, contact_frames)
+        cop_foot_error = self.get_force_weighted_convex_foot_cop_error_batched(contact_frames,
+                                                                               foot_marker_positions,
+                                                                               force_plate_forces,
+                                                                               force_plate_cops,
+                                                                               dt)
+        if cop_foot_error > 0.01:
+            print(f"!! Trial {trial} has a force-weighted center-of-pressure-outside-of-foot error of {cop_foot_error}m, which is higher than the threshold of 0.01m.")
+            return [nimble.biomechanics.MissingGRFReason.copOutsideConvexFootError] * trial_len
+
+        # 5. Estimate the trial type -- this is most important for identifying treadmill trials, which will tend to
+        # have almost all steps on the force plates. Overground trials need further attention.
+        trial_type = trial_proto.getBasicTrialType()
+
+        # 6. Check for missing GRFs on footsteps off force plates, for data that is overground and has passed all
+        # the other checks -- For now we just check if the total force magnitude is less than 10 N. This has the
+        # obvious problem that if you have overground sprinting, we will exclude flight phase frames. Because this
+        # case is so rare, I'm comfortable just asking users to manually annotate those frames, if they care about
+        # getting dynamics on them. We can always come back and add a more sophisticated heuristic later. This is
+        # a simple and extremely effective heuristic, which catches 99.8% of remaining bad frames in the dataset.
+        if trial_type == nimble.biomechanics.BasicTrialType.OVERGROUND:
+            # 6.1. Grab the frames with too little force, mark them as missing.
+            force_mags: np.ndarray = np.sum(np.linalg.norm(force_plate_forces, axis=2), axis=0)[:trial_len]
+            missing = [nimble.biomechanics.MissingGRFReason.zeroForceFrame if total_force_mag < 10.0 else
+                       nimble.biomechanics.MissingGRFReason.notMissingGRF for total_force_mag in force_mags]
+
+            # 6.2. Now we can go through and extend all the missing segments into the "rising force ramp" and
+            # "falling force ramp" regions at the edge of the missing segments.
+
+            # 6.2.1. Start with the rising force ramp, which we can tell by checking left-to-right if any frame has
+            # more force magnitude than any of the previous few frames which may have been marked as missing, and
+            # if so, extend the missing segment to include that frame.
+            extend_frames = 20
+            missing = self.extend_missing_into_force_ramp(missing, force_mags, extend_frames)
+
+            # 6.2.2. Now do the same for the falling force ramp, but right-to-left.
+            missing = self.extend_missing_into_force_ramp(missing[::-1], force_mags[::-1], extend_frames)[::-1]
+
+            return missing
+        else:
+            return [nimble.biomechanics.MissingGRFReason.notMissingGRF] * trial_len
+
+
+def _init_missing_grf_worker(state: Tuple[ThresholdsDetector, nimble.biomechanics.SubjectOnDisk]):
+    # Each worker builds its own skeleton and foot marker sets once, on startup
+    detector, subject = state
+    skel, foot_markers = detector.load_skeleton_and_foot_markers(subject)
+    return detector, subject, skel, foot_markers
+
+
+def _estimate_missing_grfs_worker(state, trial: int) -> List[int]:
+    detector, subject, skel, foot_markers = state
+    reasons = detector.estimate_missing_grfs_for_trial(subject, trial, skel, foot_markers)
+    return [int(reason) for reason in reasons]
@@ -1,10 +1,82 @@
 import nimblephysics as nimble
 import numpy as np
-from typing import List, Tuple
+from typing import List, Tuple, Optional, Dict, Any
+from utilities.fork_pool import fork_pool_map
 from utilities.scale_opensim_model import scale_opensim_model
+from dynamics_pass.solve_telemetry import IterationPolicy, SolveTelemetry, run_ipopt_optimization
 
 
-def dynamics_pass(subject: nimble.biomechanics.SubjectOnDisk):
+def run_segment_pose_optimization(dynamics_fitter: nimble.biomechanics.DynamicsFitter,
+                                  dynamics_init: nimble.biomechanics.DynamicsInitialization,
+                                  skel: nimble.dynamics.Skeleton,
+                                  segment: int,
+                                  iteration_policy: Optional[IterationPolicy] = None
+                                  ) -> Tuple[np.ndarray, SolveTelemetry]:
+    """
+    Run a position-only optimization on a single segment, with the body parameters held fixed, and return the
+    optimized poses for that segment along with the telemetry for the solve.
+    """
+    if len(dynamics_init.probablyMissingGRF[segment]) < 1000:
+        iteration_limit = 200
+        lbfgs_history_length = 20
+    elif len(dynamics_init.probablyMissingGRF[segment]) < 5000:
+        iteration_limit = 100
+        lbfgs_history_length = 15
+    else:
+        iteration_limit = 50
+        lbfgs_history_length = 3
+
+    telemetry = run_ipopt_optimization(
+        dynamics_fitter,
+        dynamics_init,
+        nimble.biomechanics.DynamicsFitProblemConfig(
+            skel)
+        .setDefaults(True)
+        .setOnlyOneTrial(segment)
+        .setResidualWeight(1e-2)
+        .setConstrainResidualsZero(False)
+        .setIncludePoses(True)
+        .setJointWeight(0.0)  # We have to disable this, because we don't have the joint info
+        .setMarkerWeight(50.0)
+        .setRegularizePoses(0.01)
+        .setRegularizeJointAcc(1e-6),
+        'segment ' + str(segment),
+        [segment],
+        iteration_limit,
+        lbfgs_history_length,
+        iteration_policy)
+
+    return np.array(dynamics_init.poseTrials[segment]), telemetry
+
+
+def _run_segment_pose_optimization_worker(state, segment: int) -> Tuple[np.ndarray, SolveTelemetry]:
+    dynamics_fitter, dynamics_init, skel, iteration_policy = state
+    return run_segment_pose_optimization(dynamics_fitter, dynamics_init, skel, segment, iteration_policy)
+
+
+def run_segment_pose_optimizations(dynamics_fitter: nimble.biomechanics.DynamicsFitter,
+                                   dynamics_init: nimble.biomechanics.DynamicsInitialization,
+                                   skel: nimble.dynamics.Skeleton,
+                                   num_processes: int = 1,
+                                   iteration_policy: Optional[IterationPolicy] = None
+                                   ) -> List[Tuple[np.ndarray, SolveTelemetry]]:
+    """
+    Run the position-only optimization on every segment in `dynamics_init`, and return the optimized poses and solve
+    telemetry for each segment, in order. If `num_processes` is greater than 1, the segments are solved concurrently
+    in a pool of forked worker processes, each with its own copy of the skeleton and fitter.
+    """
+    num_segments = len(dynamics_init.poseTrials)
+    if num_processes <= 1 or num_segments <= 1:
+        return [run_segment_pose_optimization(dynamics_fitter, dynamics_init, skel, segment, iteration_policy)
+                for segment in range(num_segments)]
+
+    return fork_pool_map(_run_segment_pose_optimization_worker, range(num_segments),
+                         (dynamics_fitter, dynamics_init, skel, iteration_policy), num_processes)
+
+
+def dynamics_pass(subject: nimble.biomechanics.SubjectOnDisk,
+                  num_processes: int = 1,
+                  iteration_policy: Optional[IterationPolicy] = None) -> List[Dict[str, Any]]:
     """
     This function is responsible for running the dynamics pass on the subject. It assumes that we already have a
     reasonably accurate guess for the subject's body scales, marker offsets, and motion. This function will then
@@ -13,7 +85,13 @@ def dynamics_pass(subject: nimble.biomechanics.SubjectOnDisk):
     observed GRF data, while smoothing the motion that does not have observed GRF data.
     - Run a full "kitchen sink" optimization to further refine everything about that initial guess, and improve metrics
     on average around 20%.
+    - Re-run a position-only optimization on each trial segment, optionally spread across `num_processes` worker
+    processes.
+
+    The iteration budget of each solve is controlled by `iteration_policy`. This returns the telemetry of every solve
+    that was run, as JSON-ready dicts, with the `trials` of each solve given as trial indices in `subject`.
     """
+    solve_telemetry: List[SolveTelemetry] = []
     header_proto = subject.getHeaderProto()
     trial_protos = header_proto.getTrials()
     num_trials = subject.getNumTrials()
@@ -49,8 +127,9 @@ def dynamics_pass(subject: nimble.biomechanics.SubjectOnDisk):
             missing_grf = subject.getMissingGRF(trial)
             track_indices = [missing_reason == nimble.biomechanics.MissingGRFReason.notMissingGRF for missing_reason in
                              missing_grf]
+            track_mask = np.array(track_indices, dtype=bool)
 
-            num_tracked = sum(track_indices)
+            num_tracked = int(np.count_nonzero(track_mask))
             if num_tracked == 0 or trial_len < 10:
                 continue
 
@@ -67,7 +146,6 @@ def dynamics_pass(subject: nimble.biomechanics.SubjectOnDisk):
             accs = smoothed_pass.getAccs()
             root_linear_accs = accs[3:6, :]
             com_accs = smoothed_pass.getComAccs()
-            acc_offsets = com_accs - root_linear_accs
 
             total_forces = np.zeros((3, trial_len))
             cop_torque_force_in_root = smoothed_pass.getGroundBodyCopTorqueForce()
@@ -77,12 +155,10 @@ def dynamics_pass(subject: nimble.biomechanics.SubjectOnDisk):
 
             # Make a rough subject mass estimate
             if num_tracked > 0:
-                total_observed_forces = np.zeros(3)
-                total_observed_accs = np.zeros(3)
-                for t in range(trial_len):
-                    if track_indices[t]:
-                        total_observed_forces += total_forces[:, t]
-                        total_observed_accs += com_accs[:, t]
+                # Summing the (frames, 3) rows along axis 0 accumulates the frames in order, exactly like adding them
+                # up one at a time would
+                total_observed_forces = np.ascontiguousarray(total_forces[:, track_mask].T).sum(axis=0)
+                total_observed_accs = np.ascontiguousarray(com_accs[:, track_mask].T).sum(axis=0)
                 total_observed_forces /= num_tracked
                 total_observed_accs /= num_tracked
                 print("Averaged observed forces: " + str(total_observed_forces))
@@ -117,36 +193,13 @@ def dynamics_pass(subject: nimble.biomechanics.SubjectOnDisk):
                                                                          trackObservedAccWeight=track_observed_acc_weight,
                                                                          regularizationWeight=regularization_weight, dt=dt)
 
+            # We don't have anything to track on frames without trustworthy GRF data
+            target_root_linear_accs[:, ~track_mask] = 0.0
+
             output_root_poses = np.zeros((3, trial_len))
             for index in range(3):
-                root_pose = root_poses[index, :]
-                target_accs = target_root_linear_accs[index, :]
-                for t in range(trial_len):
-                    if not track_indices[t]:
-                        target_accs[t] = 0.0
-                output = smooth_and_track.minimize(root_pose, target_accs)
+                output = smooth_and_track.minimize(root_poses[index, :], target_root_linear_accs[index, :])
                 output_root_poses[index, :] = output.series
-                offset = output.accelerationOffset
-
-                input_acc = np.zeros(trial_len)
-                output_acc = np.zeros(trial_len)
-                for t in range(1, trial_len - 1):
-                    input_acc[t] = (root_pose[t + 1] - 2 * root_pose[t] + root_pose[t - 1]) / (dt * dt)
-                    output_acc[t] = (output.series[t + 1] - 2 * output.series[t] + output.series[t - 1]) / (dt * dt)
-                if trial_len > 2:
-                    input_acc[0] = input_acc[1]
-                    input_acc[trial_len - 1] = input_acc[trial_len - 2]
-                    output_acc[0] = output_acc[1]
-                    output_acc[trial_len - 1] = output_acc[trial_len - 2]
-
-            output_root_acc = np.zeros((3, trial_len))
-            for t in range(1, trial_len - 1):
-                output_root_acc[:, t] = (output_root_poses[:, t + 1] - 2 * output_root_poses[:, t] + output_root_poses[:,
-                                                                                                     t - 1]) / (dt * dt)
-            if trial_len > 2:
-                output_root_acc[:, 0] = output_root_acc[:, 1]
-                output_root_acc[:, trial_len - 1] = output_root_acc[:, trial_len - 2]
-            # print("Output root linear accs: " + str(np.mean(output_root_acc, axis=1)))
 
             average_root_offset_distance = np.mean(np.linalg.norm(output_root_poses - root_poses, axis=0))
             if average_root_offset_distance < 0.03:
@@ -188,19 +241,15 @@ def dynamics_pass(subject: nimble.biomechanics.SubjectOnDisk):
             for trial in dynamics_trials:
                 cop_torque_force_world = trial_protos[trial].getPasses()[1].getGroundBodyCopTorqueForce()
                 num_plates = int(cop_torque_force_world.shape[0] / 9)
+                # Each frame is a column of the matrix, so the rows of the transposed matrix are the per-frame vectors
+                # that ForcePlate expects
+                frames = np.ascontiguousarray(cop_torque_force_world[:, :subject.getTrialLength(trial)].T)
                 force_plate_list = []
                 for i in range(num_plates):
                     force_plate = nimble.biomechanics.ForcePlate()
-                    forces: List[np.ndarray] = []
-                    moments: List[np.ndarray] = []
-                    centers_of_pressure: List[np.ndarray] = []
-                    for t in range(subject.getTrialLength(trial)):
-                        forces.append(cop_torque_force_world[i * 9 + 6:i * 9 + 9, t])
-                        moments.append(cop_torque_force_world[i * 9 + 3:i * 9 + 6, t])
-                        centers_of_pressure.append(cop_torque_force_world[i * 9:i * 9 + 3, t])
-                    force_plate.forces = forces
-                    force_plate.moments = moments
-                    force_plate.centersOfPressure = centers_of_pressure
+                    force_plate.forces = list(frames[:, i * 9 + 6:i * 9 + 9])
+                    force_plate.moments = list(frames[:, i * 9 + 3:i * 9 + 6])
+                    force_plate.centersOfPressure = list(frames[:, i * 9:i * 9 + 3])
                     force_plate_list.append(force_plate)
                 trial_foot_force_plates.append(force_plate_list)
 
@@ -239,10 +288,8 @@ def dynamics_pass(subject: nimble.biomechanics.SubjectOnDisk):
                       'external forces acting on your subject. Aborting the physics fitter!', flush=True)
             else:
                 # Run an optimization to figure out the model parameters
-                dynamics_fitter.setIterationLimit(200)
-                dynamics_fitter.setLBFGSHistoryLength(20)
-
-                dynamics_fitter.runIPOPTOptimization(
+                kitchen_sink_telemetry = run_ipopt_optimization(
+                    dynamics_fitter,
                     dynamics_init,
                     nimble.biomechanics.DynamicsFitProblemConfig(skel)
                     .setDefaults(True)
@@ -262,7 +309,16 @@ def dynamics_pass(subject: nimble.biomechanics.SubjectOnDisk):
                     # .setRegularizeBodyScales(1.0)
                     .setRegularizeBodyScales(1.0)
                     .setRegularizePoses(0.01)
-                    .setRegularizeJointAcc(1e-6))
+                    .setRegularizeJointAcc(1e-6),
+                    'kitchen sink',
+                    list(dynamics_trials),
+                    200,
+                    20,
+                    iteration_policy)
+                kitchen_sink_telemetry.marker_rms = dynamics_fitter.computeAverageMarkerRMSE(dynamics_init)
+                kitchen_sink_telemetry.linear_residual, kitchen_sink_telemetry.angular_residual = \
+                    dynamics_fitter.computeAverageResidualForce(dynamics_init)
+                solve_telemetry.append(kitchen_sink_telemetry)
 
                 dynamics_pass = subject.getHeaderProto().addProcessingPass()
                 dynamics_fitter.applyInitToSkeleton(skel, dynamics_init)
@@ -276,33 +332,14 @@ def dynamics_pass(subject: nimble.biomechanics.SubjectOnDisk):
                 dynamics_pass.setProcessingPassType(
                     nimble.biomechanics.ProcessingPassType.DYNAMICS)
 
-                # Now re-run a position-only optimization on every trial in the dataset
+                # Now re-run a position-only optimization on every trial in the dataset. The body parameters are
+                # frozen at this point, so each segment's solve is independent of the others, and we can run them in
+                # parallel if we have the processes to spare.
+                segment_results = run_segment_pose_optimizations(
+                    dynamics_fitter, dynamics_init, skel, num_processes, iteration_policy)
+
                 for segment in range(len(dynamics_init.poseTrials)):
-                    if len(dynamics_init.probablyMissingGRF[segment]) < 1000:
-                        dynamics_fitter.setIterationLimit(200)
-                        dynamics_fitter.setLBFGSHistoryLength(20)
-                    elif len(dynamics_init.probablyMissingGRF[segment]) < 5000:
-                        dynamics_fitter.setIterationLimit(100)
-                        dynamics_fitter.setLBFGSHistoryLength(15)
-                    else:
-                        dynamics_fitter.setIterationLimit(50)
-                        dynamics_fitter.setLBFGSHistoryLength(3)
-
-                    dynamics_fitter.runIPOPTOptimization(
-                        dynamics_init,
-                        nimble.biomechanics.DynamicsFitProblemConfig(
-                            skel)
-                        .setDefaults(True)
-                        .setOnlyOneTrial(segment)
-                        .setResidualWeight(1e-2)
-                        .setConstrainResidualsZero(False)
-                        .setIncludePoses(True)
-                        .setJointWeight(0.0)  # We have to disable this, because we don't have the joint info
-                        .setMarkerWeight(50.0)
-                        .setRegularizePoses(0.01)
-                        .setRegularizeJointAcc(1e-6))
-
-                    dynamics_positions = dynamics_init.poseTrials[segment]
+                    dynamics_positions, segment_telemetry = segment_results[segment]
 
                     trial_proto = trial_protos[dynamics_trials[segment]]
                     marker_observations = trial_proto.getMarkerObservations()
@@ -327,3 +364,17 @@ def dynamics_pass(subject: nimble.biomechanics.SubjectOnDisk):
                                                                      trial_foot_force_plates[segment])
                     trial_dynamics_data.setMarkerRMS(dynamics_ik_error_report.rootMeanSquaredError)
                     trial_dynamics_data.setMarkerMax(dynamics_ik_error_report.maxError)
+
+                    # Summarize the segment's results on the frames we trust the GRF for, to go with its telemetry
+                    not_missing_grf = np.array([reason == nimble.biomechanics.MissingGRFReason.notMissingGRF
+                                                for reason in trial_proto.getMissingGRFReason()], dtype=bool)
+                    segment_telemetry.trials = [dynamics_trials[segment]]
+                    segment_telemetry.marker_rms = float(np.mean(dynamics_ik_error_report.rootMeanSquaredError))
+                    if np.any(not_missing_grf):
+                        segment_telemetry.linear_residual = float(np.mean(
+                            np.array(trial_dynamics_data.getLinearResidual())[not_missing_grf]))
+                        segment_telemetry.angular_residual = float(np.mean(
+                            np.array(trial_dynamics_data.getAngularResidual())[not_missing_grf]))
+                    solve_telemetry.append(segment_telemetry)
+
+    return [telemetry.to_json() for telemetry in solve_telemetry]
@@ -4,13 +4,16 @@ from typing import List, Tuple
 from bad_frames_detector.thresholds import ThresholdsDetector
 
 
-def missing_grf_detection(subject: nimble.biomechanics.SubjectOnDisk):
+def missing_grf_detection(subject: nimble.biomechanics.SubjectOnDisk, num_processes: int = 1):
     """
     Detects missing GRFs in the subject and sets the missing GRF reason in the trial proto. This then allows the
     dynamics fitter to know that certain frames should be excluded from the dynamics fitting, because they have bad or
     missing ground reaction force numbers, and if we used them to try to fit the dynamics, we would get weird center of
     mass trajectories (probably ones that want to fall through the floor, because we are missing the ground reaction
     forces that are supposed to be holding the body up).
+
+    The trials are classified independently of each other, so if `num_processes` is greater than 1 they are spread
+    across that many worker processes.
     """
     detector = ThresholdsDetector()
     header_proto = subject.getHeaderProto()
@@ -29,7 +32,8 @@ def missing_grf_detection(subject: nimble.biomechanics.SubjectOnDisk):
             print(f"Trial segment '{trial_protos[i].getName()}' has been manually reviewed, "
                   f"skipping missing GRF detection...")
 
-    missing_grf: List[List[nimble.biomechanics.MissingGRFReason]] = detector.estimate_missing_grfs(subject, trials_to_evaluate)
+    missing_grf: List[List[nimble.biomechanics.MissingGRFReason]] = detector.estimate_missing_grfs(
+        subject, trials_to_evaluate, num_processes)
     assert len(missing_grf) == len(trials_to_evaluate)
     for i in range(len(missing_grf)):
         trial_protos[trials_to_evaluate[i]].setMissingGRFReason(missing_grf[i])
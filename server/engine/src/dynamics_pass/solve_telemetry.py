@@ -0,0 +1,222 @@
+import nimblephysics as nimble
+import os
+import re
+import sys
+import time
+import ctypes
+import threading
+from contextlib import contextmanager
+from typing import List, Dict, Any, Optional, Tuple
+
+
+# IPOPT prints one line per iteration, starting with the iteration number (suffixed with 'r' during restoration) and
+# the objective value, and a single 'EXIT: ...' line describing why it stopped.
+_IPOPT_ITERATION_LINE = re.compile(r'^\s*(\d+)r?\s+([-+]?\d+\.\d+[eE][-+]\d+)\s')
+_IPOPT_EXIT_LINE = re.compile(r'^\s*EXIT:\s*(.*?)\s*$')
+
+
+class IterationPolicy:
+    """
+    Controls how many IPOPT iterations each dynamics solve gets. By default, every solve runs to its fixed iteration
+    limit in a single IPOPT call, which is the historical behavior.
+
+    With `adaptive` set, a solve is instead run as a series of warm-started IPOPT calls of `chunk_iterations`
+    iterations each, and stops as soon as a chunk improves the objective by less than `min_relative_improvement`
+    (relative to max(1, |objective|), the same scaling IPOPT uses for its own objective change tests). Restarting
+    IPOPT throws away its L-BFGS history, so this trades a little convergence speed per iteration for not spending
+    iterations on a solve that has plateaued.
+
+    If `max_iterations` is positive, it caps the iteration limit of every solve.
+    """
+    def __init__(self,
+                 adaptive: bool = False,
+                 chunk_iterations: int = 20,
+                 min_relative_improvement: float = 1e-3,
+                 max_iterations: int = -1):
+        self.adaptive = adaptive
+        self.chunk_iterations = chunk_iterations
+        self.min_relative_improvement = min_relative_improvement
+        self.max_iterations = max_iterations
+
+    def get_iteration_limit(self, default_limit: int) -> int:
+        if self.max_iterations > 0:
+            return min(default_limit, self.max_iterations)
+        return default_limit
+
+
+class SolveTelemetry:
+    """
+    A record of what happened during a single dynamics solve, which may span several IPOPT calls if the solve was run
+    with an adaptive IterationPolicy.
+    """
+    def __init__(self, name: str, trials: List[int], iteration_limit: int, lbfgs_history_length: int):
+        self.name = name
+        self.trials = trials
+        self.iteration_limit = iteration_limit
+        self.lbfgs_history_length = lbfgs_history_length
+        # The objective value at every iteration, across all IPOPT calls
+        self.objectives: List[float] = []
+        self.iterations = 0
+        self.seconds = 0.0
+        # One entry per IPOPT call, with the iterations, wall time and termination reason of that call
+        self.calls: List[Dict[str, Any]] = []
+        self.termination_reason: Optional[str] = None
+        self.stopped_on_plateau = False
+        # Filled in once the results of the solve have been evaluated
+        self.marker_rms: Optional[float] = None
+        self.linear_residual: Optional[float] = None
+        self.angular_residual: Optional[float] = None
+
+    def get_seconds_per_iteration(self) -> Optional[float]:
+        if self.iterations == 0:
+            return None
+        return self.seconds / self.iterations
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'trials': self.trials,
+            'iterationLimit': self.iteration_limit,
+            'lbfgsHistoryLength': self.lbfgs_history_length,
+            'iterations': self.iterations,
+            'seconds': self.seconds,
+            'secondsPerIteration': self.get_seconds_per_iteration(),
+            'objectives': self.objectives,
+            'calls': self.calls,
+            'terminationReason': self.termination_reason,
+            'stoppedOnPlateau': self.stopped_on_plateau,
+            'markerRMS': self.marker_rms,
+            'linearResidual': self.linear_residual,
+            'angularResidual': self.angular_residual
+        }
+
+
+class IpoptLogParser:
+    """
+    Pulls the per-iteration objective values, the number of iterations, and the termination reason out of the text
+    that IPOPT prints during a solve, one line at a time. If IPOPT was silenced, this finds no objectives and no
+    termination reason.
+    """
+    def __init__(self):
+        self.objectives: List[float] = []
+        self.last_iteration = -1
+        self.termination_reason: Optional[str] = None
+
+    def parse_line(self, line: str):
+        iteration_match = _IPOPT_ITERATION_LINE.match(line)
+        if iteration_match is not None:
+            self.objectives.append(float(iteration_match.group(2)))
+            self.last_iteration = int(iteration_match.group(1))
+            return
+        exit_match = _IPOPT_EXIT_LINE.match(line)
+        if exit_match is not None:
+            self.termination_reason = exit_match.group(1)
+
+    def get_results(self) -> Tuple[List[float], int, Optional[str]]:
+        return self.objectives, max(self.last_iteration, 0), self.termination_reason
+
+
+def parse_ipopt_log(log: str) -> Tuple[List[float], int, Optional[str]]:
+    """
+    Parse the whole text of an IPOPT log at once, with an IpoptLogParser.
+    """
+    parser = IpoptLogParser()
+    for line in log.splitlines():
+        parser.parse_line(line)
+    return parser.get_results()
+
+
+def _write_fully(fd: int, data: bytes):
+    while len(data) > 0:
+        data = data[os.write(fd, data):]
+
+
+@contextmanager
+def tee_native_stdout(parser: IpoptLogParser):
+    """
+    Route everything written to the process's stdout file descriptor, including output from native code like IPOPT
+    that bypasses sys.stdout, through a pipe. A reader thread passes each line straight on to the real stdout as it
+    arrives, so the live logs are unchanged, and feeds it to `parser` on the way through.
+    """
+    sys.stdout.flush()
+    saved_stdout_fd = os.dup(1)
+    read_fd, write_fd = os.pipe()
+
+    def pass_through_lines():
+        with os.fdopen(read_fd, 'rb') as pipe:
+            for line in pipe:
+                _write_fully(saved_stdout_fd, line)
+                parser.parse_line(line.decode('utf-8', errors='replace'))
+
+    reader = threading.Thread(target=pass_through_lines, daemon=True)
+    reader.start()
+    os.dup2(write_fd, 1)
+    os.close(write_fd)
+    try:
+        yield parser
+    finally:
+        # Flush the C stdio buffer before we swap the file descriptor back, or the tail of the native output would
+        # skip the parser. Restoring fd 1 closes the last write end of the pipe, which lets the reader finish.
+        ctypes.CDLL(None).fflush(None)
+        sys.stdout.flush()
+        os.dup2(saved_stdout_fd, 1)
+        reader.join()
+        os.close(saved_stdout_fd)
+
+
+def run_ipopt_optimization(dynamics_fitter: nimble.biomechanics.DynamicsFitter,
+                           dynamics_init: nimble.biomechanics.DynamicsInitialization,
+                           config: nimble.biomechanics.DynamicsFitProblemConfig,
+                           name: str,
+                           trials: List[int],
+                           iteration_limit: int,
+                           lbfgs_history_length: int,
+                           policy: Optional[IterationPolicy] = None) -> SolveTelemetry:
+    """
+    Run `dynamics_fitter.runIPOPTOptimization()` with the iteration budget given by `iteration_limit` and `policy`,
+    and return the telemetry for the solve. The final marker RMS and residuals are left for the caller to fill in,
+    since how to evaluate them depends on the solve.
+    """
+    if policy is None:
+        policy = IterationPolicy()
+    telemetry = SolveTelemetry(name, trials, policy.get_iteration_limit(iteration_limit), lbfgs_history_length)
+    dynamics_fitter.setLBFGSHistoryLength(lbfgs_history_length)
+
+    remaining_iterations = telemetry.iteration_limit
+    while remaining_iterations > 0:
+        call_iteration_limit = min(policy.chunk_iterations, remaining_iterations) if policy.adaptive \
+            else remaining_iterations
+        dynamics_fitter.setIterationLimit(call_iteration_limit)
+
+        start_time = time.time()
+        with tee_native_stdout(IpoptLogParser()) as parser:
+            dynamics_fitter.runIPOPTOptimization(dynamics_init, config)
+        seconds = time.time() - start_time
+
+        objectives, iterations, termination_reason = parser.get_results()
+        telemetry.objectives.extend(objectives)
+        telemetry.iterations += iterations
+        telemetry.seconds += seconds
+        telemetry.termination_reason = termination_reason
+        telemetry.calls.append({
+            'iterationLimit': call_iteration_limit,
+            'iterations': iterations,
+            'seconds': seconds,
+            'terminationReason': termination_reason
+        })
+        remaining_iterations -= call_iteration_limit
+
+        if not policy.adaptive:
+            break
+        # If IPOPT stopped for any reason other than running out of iterations, another call won't help
+        if termination_reason is not None and 'Maximum Number of Iterations' not in termination_reason:
+            break
+        if len(objectives) >= 2:
+            relative_improvement = (objectives[0] - objectives[-1]) / max(1.0, abs(objectives[0]))
+            if relative_improvement < policy.min_relative_improvement:
+                telemetry.stopped_on_plateau = remaining_iterations > 0
+                break
+
+    print(f'Dynamics solve "{name}" ran {telemetry.iterations}/{telemetry.iteration_limit} iterations in '
+          f'{telemetry.seconds:.2f}s: {telemetry.termination_reason}', flush=True)
+    return telemetry
@@ -10,7 +10,7 @@ Author(s): Keenon Werling, Nicholas Bianco
 import sys
 import os
 import json
-import shutil
+from typing import List
 import traceback
 import textwrap
 import numpy as np
@@ -22,9 +22,14 @@ from dynamics_pass.acceleration_minimizing_pass import add_acceleration_minimizi
 from dynamics_pass.classification_pass import classification_pass
 from dynamics_pass.missing_grf_detection import missing_grf_detection
 from dynamics_pass.dynamics_pass import dynamics_pass
+from dynamics_pass.solve_telemetry import IterationPolicy
 from moco_pass.moco_pass import moco_pass
 from writers.opensim_writer import write_opensim_results
 from writers.web_results_writer import write_web_results
+from writers.deferred_plots import start_generating_plots_in_background, stop_generating_plots, \
+    get_plot_outputs
+from writers.results_archive import ResultsArchive, write_archive_info
+from writers.b3d_writer import write_b3d_files
 from exceptions import Error, LoadingError, TrialPreprocessingError, MarkerFitterError, \
                        DynamicsFitterError, MocoError, WriteError
 
@@ -33,6 +38,15 @@ from exceptions import Error, LoadingError, TrialPreprocessingError, MarkerFitte
 GEOMETRY_FOLDER_PATH = absPath('Geometry') + '/'
 DATA_FOLDER_PATH = absPath('../../data')
 
+# If set, the comma separated list of CPUs the engine should run on. The processing 
+# server uses this to give each of the subjects it processes at once its own CPUs.
+ENGINE_CPUS_ENV_VAR = 'ADDB_ENGINE_CPUS'
+
+# Printed on its own line once every result except the deferred plots is written, so 
+# the processing server can start uploading them while the plots finish. This must 
+# match RESULTS_READY_LINE in app/src/mocap_server.py.
+RESULTS_READY_LINE = 'RESULTS_READY'
+
 # This metaclass wraps all methods in the Subject class with a try-except block, 
 # except for the __init__ method.
 class ExceptionHandlingMeta(type):
@@ -46,7 +60,8 @@ class ExceptionHandlingMeta(type):
         'run_moco': MocoError,
         'run_zip_opensim': WriteError,
         'run_write_web': WriteError,
-        'run_write_b3d': WriteError
+        'run_write_b3d': WriteError,
+        'run_finish_deferred_plots': WriteError
     }
 
     def __new__(cls, name, bases, attrs):
@@ -72,13 +87,37 @@ class ExceptionHandlingMeta(type):
         return wrapper
     
 
+def get_num_available_cpus() -> int:
+    """
+    Returns the number of CPUs this process is allowed to run on. Where the platform
+    supports it, this respects CPU affinity masks (for example, from SLURM's
+    --cpus-per-task), rather than counting every core on the machine.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return max(1, len(os.sched_getaffinity(0)))
+    return max(1, os.cpu_count() or 1)
+
+
 class Engine(metaclass=ExceptionHandlingMeta):
-    def __init__(self, path, output_name, href):
+    def __init__(self, path, output_name, href, num_processes=None):
         self.path = path
         self.output_name = output_name
         self.href = href
+        # The number of worker processes that the parallel stages of the pipeline are 
+        # allowed to use.
+        self.num_processes = num_processes if num_processes is not None else get_num_available_cpus()
         self.subject = Subject()
         self.subject_on_disk: nimble.biomechanics.SubjectOnDisk = None
+        # Telemetry from each of the dynamics pass solves, which gets written out with 
+        # the web results.
+        self.dynamics_telemetry = []
+        # If the subject asked for its plots to be deferred, the manifest of plots to 
+        # generate, and the background process generating them.
+        self.plots_manifest_fpath = None
+        self.plots_process = None
+        # The results zip, which starts compressing as soon as the OpenSim results are 
+        # written
+        self.results_archive = None
 
     def run_loading(self):
         print('Loading folder ' + self.path, flush=True)
@@ -139,20 +178,39 @@ class Engine(metaclass=ExceptionHandlingMeta):
                   'which are marked as not missing GRF are going to be very clean, but '
                   'smaller than we might have with more selective heuristics.', 
                   flush=True)
-            missing_grf_detection(self.subject_on_disk)
+            missing_grf_detection(self.subject_on_disk, self.num_processes)
 
             print('Running dynamics pass...', flush=True)
             print('-> This pass runs the dynamics pipeline on the subject, which '
                   'jointly optimizes a bunch of properties just like the kinematics '
                   'pass, except now we will balance the marker RMS _and_ the residual '
                   'RMS.', flush=True)
-            dynamics_pass(self.subject_on_disk)
+            iteration_policy = IterationPolicy(
+                adaptive=self.subject.dynamicsAdaptiveIterations,
+                min_relative_improvement=self.subject.dynamicsPlateauTolerance,
+                max_iterations=self.subject.dynamicsMaxIterations)
+            self.dynamics_telemetry = dynamics_pass(self.subject_on_disk, 
+                                                    self.num_processes, 
+                                                    iteration_policy)
 
     def run_write_openim(self):
         # This will write out a folder of OpenSim results files.
         print('Writing OpenSim results', flush=True)
-        write_opensim_results(self.subject_on_disk, self.path, self.output_name, 
-                              GEOMETRY_FOLDER_PATH)
+        self.plots_manifest_fpath = write_opensim_results(
+            self.subject_on_disk, self.path, self.output_name, GEOMETRY_FOLDER_PATH, 
+            self.num_processes, defer_plots=self.subject.deferPlots)
+        if self.plots_manifest_fpath is not None:
+            # Generate the plots in the background while the rest of the pipeline runs, 
+            # so that the results don't wait on them.
+            print('Deferring OpenSim results plots to ' + self.plots_manifest_fpath, 
+                  flush=True)
+            self.plots_process = start_generating_plots_in_background(
+                self.plots_manifest_fpath)
+        # Start compressing the results into the zip in the background while Moco runs
+        self.results_archive = ResultsArchive(self.path + self.output_name + '.zip', 
+                                              self.path, self.num_processes)
+        self.results_archive.add_folder(self.path + self.output_name, 
+                                        exclude=self.get_deferred_plot_outputs())
 
     def run_moco(self):
         if self.subject.runMoco:
@@ -163,57 +221,80 @@ class Engine(metaclass=ExceptionHandlingMeta):
                   'activations that best match the observed motion and ground reaction '
                   'forces.', flush=True)
             moco_pass(self.subject_on_disk, self.path, self.output_name, 
-                      self.subject.genericMassKg, self.subject.genericHeightM)
+                      self.subject.genericMassKg, self.subject.genericHeightM, 
+                      self.num_processes)
 
     def run_zip_opensim(self):
         print('Zipping up OpenSim files...', flush=True)
-        shutil.make_archive(self.path + self.output_name, 'zip', root_dir=self.path, 
-                            base_dir=self.output_name)
-        print('Finished outputting OpenSim files.', flush=True)
+        if self.results_archive is None:
+            self.results_archive = ResultsArchive(self.path + self.output_name + '.zip', 
+                                                  self.path, self.num_processes)
+        # This only picks up the files that Moco added or changed, everything else is 
+        # already compressed
+        self.results_archive.add_folder(self.path + self.output_name, 
+                                        exclude=self.get_deferred_plot_outputs())
+        archive_info = self.results_archive.close()
+        write_archive_info(self.path + self.output_name + '.zip', archive_info)
+        print(f'Finished outputting OpenSim files ({archive_info["size"]} bytes, sha256 '
+              f'{archive_info["sha256"]}).', flush=True)
+
+    def get_deferred_plot_outputs(self) -> List[str]:
+        # The deferred plots may be half written at any point, so they're left out of 
+        # the results zip, and get their own archive once they're done.
+        if self.plots_manifest_fpath is None:
+            return []
+        return get_plot_outputs(self.plots_manifest_fpath)
 
     def run_write_web(self):
         # This will write out all the results to display in the web UI back into the 
-        # existing folder structure
+        # existing folder structure. If requested, each segment also gets a binary 
+        # columnar copy of its data CSV.
         print('Writing web visualizer results', flush=True)
-        write_web_results(self.subject_on_disk, GEOMETRY_FOLDER_PATH, self.path)
+        write_web_results(self.subject_on_disk, GEOMETRY_FOLDER_PATH, self.path, 
+                          self.dynamics_telemetry, self.num_processes,
+                          write_columns=self.subject.writeColumnarResults)
 
     def run_write_b3d(self):
-        # This will write out a B3D file
+        # This will write out a B3D file, and a second one with only the dynamics trials
         print('Writing B3D file encoded results', flush=True)
-        nimble.biomechanics.SubjectOnDisk.writeB3D(self.path + self.output_name + '.b3d', 
-                                                   self.subject_on_disk.getHeaderProto())
-
-        # Check if we have any dynamics trials
-        pass_index = -1
-        for p in range(self.subject_on_disk.getNumProcessingPasses()):
-            if (self.subject_on_disk.getProcessingPassType(p) == 
-                nimble.biomechanics.ProcessingPassType.DYNAMICS):
-                pass_index = p
-
-        num_dynamics_trials = 0
-        include_dynamics_trials = []
-        if pass_index > -1:
-            for trial in range(self.subject_on_disk.getNumTrials()):
-                if self.subject_on_disk.getTrialNumProcessingPasses(trial) > pass_index:
-                    include_dynamics_trials.append(True)
-                    num_dynamics_trials += 1
-                else:
-                    include_dynamics_trials.append(False)
-
-        if num_dynamics_trials > 0:
-            print('Writing B3D file encoded results which have been filtered to only '
-                  'include dynamics trials', flush=True)
-            self.subject_on_disk.getHeaderProto().filterTrials(include_dynamics_trials)
-            nimble.biomechanics.SubjectOnDisk.writeB3D(
-                self.path + self.output_name + '_dynamics_trials_only.b3d', 
-                self.subject_on_disk.getHeaderProto())
-        else:
+        num_dynamics_trials = write_b3d_files(
+            self.subject_on_disk, self.path + self.output_name + '.b3d', 
+            self.path + self.output_name + '_dynamics_trials_only.b3d')
+
+        if num_dynamics_trials == 0:
             print('No dynamics trials found', flush=True)
             # Write a flag file to the output directory to indicate that no dynamics 
             # trials were found.
             with open(self.path + 'NO_DYNAMICS_TRIALS', 'w') as f:
                 f.write('No dynamics trials found')
 
+    def run_announce_results_ready(self):
+        # Everything but the deferred plots is written, so tell the processing server it 
+        # can upload the results without waiting for the plots.
+        print(RESULTS_READY_LINE, flush=True)
+
+    def run_finish_deferred_plots(self):
+        if self.plots_process is None:
+            return
+        print('Waiting for the deferred plots to finish...', flush=True)
+        self.plots_process.join()
+        if self.plots_process.exitcode != 0:
+            print('WARNING: generating the deferred plots failed with exit code ' + 
+                  str(self.plots_process.exitcode), flush=True)
+        # The plots are a nice-to-have, and the rest of the results may already be 
+        # uploaded by now, so we don't fail the whole subject over them
+        try:
+            archive = ResultsArchive(self.path + self.output_name + '_plots.zip', 
+                                     self.path, self.num_processes)
+            for plot_path in get_plot_outputs(self.plots_manifest_fpath):
+                if os.path.exists(plot_path):
+                    archive.add_file(plot_path)
+            write_archive_info(self.path + self.output_name + '_plots.zip', 
+                               archive.close())
+            print('Finished outputting deferred plots.', flush=True)
+        except Exception as e:
+            print('WARNING: archiving the deferred plots failed: ' + str(e), flush=True)
+
     def run(self):
         try:
             self.run_loading()
@@ -225,10 +306,20 @@ class Engine(metaclass=ExceptionHandlingMeta):
             self.run_zip_opensim()
             self.run_write_web()
             self.run_write_b3d()
+            self.run_announce_results_ready()
+            self.run_finish_deferred_plots()
 
         except Error as e:
             # If we failed, write a JSON file with the error information.
             print(e, flush=True)
+            # Don't keep compressing the results zip in the background, or leave its 
+            # spool files in the subject folder
+            if self.results_archive is not None:
+                self.results_archive.abort()
+            # Likewise, don't hold up reporting the error until every plot for a failed 
+            # subject has rendered
+            if self.plots_process is not None:
+                stop_generating_plots(self.plots_process, self.plots_manifest_fpath)
             json_data = json.dumps(e.get_error_dict(), indent=4)
             with open(self.path + '_errors.json', "w") as json_file:
                 print('ERRORS:', flush=True)
@@ -257,6 +348,12 @@ def main():
     # Subject href.
     href = sys.argv[3] if len(sys.argv) > 3 else ''
 
+    # Pin the engine (and every process it starts) to the CPUs we were given, which 
+    # get_num_available_cpus() then picks up to size the worker pools.
+    engine_cpus = os.environ.get(ENGINE_CPUS_ENV_VAR, '')
+    if len(engine_cpus) > 0 and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, [int(cpu) for cpu in engine_cpus.split(',')])
+
     # Run the engine.
     engine = Engine(path, output_name, href)
     engine.run()
@@ -87,6 +87,9 @@ class Subject(metaclass=ExceptionHandlingMeta):
         self.dynamicsRegularizePoses = 0.01
         self.ignoreFootNotOverForcePlate = False
         self.disableDynamics = False
+        self.dynamicsAdaptiveIterations = False
+        self.dynamicsMaxIterations = -1 # Indicates that there is no cap beyond the defaults.
+        self.dynamicsPlateauTolerance = 1e-3
         self.segmentTrials = False
         self.trialRanges = dict()
         self.mergeZeroForceSegmentsThreshold = 1.0
@@ -94,6 +97,8 @@ class Subject(metaclass=ExceptionHandlingMeta):
         self.totalForce = 0.0
         self.skippedDynamicsReason = None
         self.runMoco = False
+        self.deferPlots = False
+        self.writeColumnarResults = False
         self.skippedMocoReason = None
         self.lowpass_hz = 30
         # self.lowpass_filter_type: str = 'lowpass'
@@ -207,6 +212,21 @@ class Subject(metaclass=ExceptionHandlingMeta):
         if 'disableDynamics' in subject_json:
             self.disableDynamics = subject_json['disableDynamics']
 
+        if 'deferPlots' in subject_json:
+            self.deferPlots = subject_json['deferPlots']
+
+        if 'writeColumnarResults' in subject_json:
+            self.writeColumnarResults = subject_json['writeColumnarResults']
+
+        if 'dynamicsAdaptiveIterations' in subject_json:
+            self.dynamicsAdaptiveIterations = subject_json['dynamicsAdaptiveIterations']
+
+        if 'dynamicsMaxIterations' in subject_json:
+            self.dynamicsMaxIterations = subject_json['dynamicsMaxIterations']
+
+        if 'dynamicsPlateauTolerance' in subject_json:
+            self.dynamicsPlateauTolerance = subject_json['dynamicsPlateauTolerance']
+
         if 'segmentTrials' in subject_json:
             self.segmentTrials = subject_json['segmentTrials']
 
@@ -2,12 +2,14 @@ import os
 import nimblephysics as nimble
 import opensim as osim
 import numpy as np
-from typing import List, Dict
+from typing import List, Dict, Tuple
 import subprocess
 import sys
-import matplotlib; matplotlib.use('Agg')
-from plotting import (plot_coordinate_samples, plot_path_lengths, plot_moment_arms,
-                      plot_joint_moment_breakdown)
+import shutil
+import hashlib
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from inspect import getsourcefile
 
 MOCO_PATH = os.path.dirname(getsourcefile(lambda:0))
@@ -16,6 +18,23 @@ GENERIC_OSIM_NAME = 'unscaled_generic.osim'
 KINEMATIC_OSIM_NAME = 'match_markers_but_ignore_physics.osim'
 DYNAMICS_OSIM_NAME = 'match_markers_and_physics.osim'
 MOCO_OSIM_NAME = 'match_markers_and_physics_moco.osim'
+# The fewest threads we will give each MocoInverse solve when running several of them at once. The CasADi solver
+# scales well up to a handful of threads, so past this point we get more out of running more trials concurrently.
+MIN_THREADS_PER_MOCO_SOLVE = 4
+# Where to keep fitted function-based paths, so that reprocessing a subject with the same scaled model and coordinate
+# samples can reuse an earlier fit. Set ADDB_FUNCTION_BASED_PATHS_CACHE to an empty string to disable the cache.
+FUNCTION_BASED_PATHS_CACHE_PATH = os.environ.get(
+    'ADDB_FUNCTION_BASED_PATHS_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'addbiomechanics', 'function_based_paths'))
+# The cache is pruned to this many bytes, least recently used entries first, whenever a new fit is stored.
+FUNCTION_BASED_PATHS_CACHE_MAX_BYTES = int(os.environ.get('ADDB_FUNCTION_BASED_PATHS_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+# Entries are written to temporary folders with this prefix first. Any that are older than a day were left behind by a
+# run that crashed, and are removed when the cache is pruned.
+FUNCTION_BASED_PATHS_CACHE_TEMP_PREFIX = '.tmp-'
+FUNCTION_BASED_PATHS_CACHE_TEMP_MAX_AGE = 24 * 60 * 60
+# Bump this whenever the PolynomialPathFitter settings in fit_function_based_paths() change, so that fits made with the
+# old settings are no longer reused.
+FUNCTION_BASED_PATHS_CACHE_VERSION = '1'
 
 
 def update_model(generic_model_fpath, model_input_fpath, model_output_fpath,
@@ -135,7 +154,29 @@ def update_model(generic_model_fpath, model_input_fpath, model_output_fpath,
     model.printToXML(model_output_fpath)
 
 
-def fit_function_based_paths(model, coordinate_values, results_dir):
+def get_function_based_paths_cache_key(model, coordinate_values):
+    """
+    Hash the scaled model and the coordinate samples that a function-based path fit depends on. The coordinate values
+    are rounded before hashing, so that tiny differences from writing and re-reading the IK results don't defeat the
+    cache.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(FUNCTION_BASED_PATHS_CACHE_VERSION.encode('utf-8'))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        model_fpath = os.path.join(temp_dir, 'model.osim')
+        model.printToXML(model_fpath)
+        with open(model_fpath, 'rb') as f:
+            hasher.update(f.read())
+    column_labels = coordinate_values.getColumnLabels()
+    hasher.update('\n'.join([column_labels[i] for i in range(len(column_labels))]).encode('utf-8'))
+    hasher.update(coordinate_values.getTableMetaDataAsString('inDegrees').encode('utf-8'))
+    values = np.round(coordinate_values.getMatrix().to_numpy(), 6)
+    hasher.update(str(values.shape).encode('utf-8'))
+    hasher.update(np.ascontiguousarray(values).tobytes())
+    return hasher.hexdigest()
+
+
+def run_polynomial_path_fitter(model, coordinate_values, results_dir):
     fitter = osim.PolynomialPathFitter()
     fitter.setModel(osim.ModelProcessor(model))
     table_processor = osim.TableProcessor(coordinate_values)
@@ -154,11 +195,159 @@ def fit_function_based_paths(model, coordinate_values, results_dir):
         fitter.setNumParallelThreads(50)
     fitter.run()
 
+
+def get_folder_size(folder):
+    size = 0
+    for root, _, files in os.walk(folder):
+        for file in files:
+            size += os.path.getsize(os.path.join(root, file))
+    return size
+
+
+def prune_function_based_paths_cache(cache_dir, max_bytes=FUNCTION_BASED_PATHS_CACHE_MAX_BYTES):
+    """
+    Delete the least recently used cache entries until the cache fits in `max_bytes`, along with any temporary folders
+    left behind by crashed runs. Entries are touched whenever they are reused, so their modification time is the last
+    time they were used. The most recent entry is always kept.
+    """
+    now = time.time()
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry_dir = os.path.join(cache_dir, name)
+        try:
+            mtime = os.path.getmtime(entry_dir)
+            if name.startswith(FUNCTION_BASED_PATHS_CACHE_TEMP_PREFIX):
+                if now - mtime > FUNCTION_BASED_PATHS_CACHE_TEMP_MAX_AGE:
+                    shutil.rmtree(entry_dir, ignore_errors=True)
+                continue
+            entries.append((mtime, get_folder_size(entry_dir), entry_dir))
+        except OSError:
+            # Another run removed it while we were looking.
+            continue
+
+    entries.sort()
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, entry_dir in entries[:-1]:
+        if total_bytes <= max_bytes:
+            break
+        print(f'Evicting cached function-based paths {entry_dir}', flush=True)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total_bytes -= size
+
+
+def store_function_based_paths_in_cache(results_dir, cache_dir, cache_entry_dir):
+    # Copy into a temporary folder next to the entry and rename it into place, so that concurrent runs never see a
+    # partially written entry.
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        temp_entry_dir = tempfile.mkdtemp(prefix=FUNCTION_BASED_PATHS_CACHE_TEMP_PREFIX, dir=cache_dir)
+        try:
+            shutil.copytree(results_dir, temp_entry_dir, dirs_exist_ok=True)
+            try:
+                os.rename(temp_entry_dir, cache_entry_dir)
+            except OSError:
+                # Another run cached the same fit first.
+                pass
+        finally:
+            if os.path.exists(temp_entry_dir):
+                shutil.rmtree(temp_entry_dir, ignore_errors=True)
+        prune_function_based_paths_cache(cache_dir)
+    except OSError as e:
+        print(f'Failed to cache function-based paths in {cache_dir}: {e}', flush=True)
+
+
+def load_function_based_paths_from_cache(cache_entry_dir, results_dir):
+    """
+    Copy a cached fit into `results_dir`, and mark it as recently used. Returns False if there is no such entry, or it
+    was evicted while we were copying it.
+    """
+    if not os.path.exists(cache_entry_dir):
+        return False
+    try:
+        os.utime(cache_entry_dir)
+        shutil.copytree(cache_entry_dir, results_dir, dirs_exist_ok=True)
+    except (OSError, shutil.Error) as e:
+        print(f'Failed to reuse cached function-based paths from {cache_entry_dir}: {e}', flush=True)
+        return False
+    print(f'Reused cached function-based paths from {cache_entry_dir}', flush=True)
+    return True
+
+
+def fit_function_based_paths(model, coordinate_values, results_dir, 
+                             cache_dir=FUNCTION_BASED_PATHS_CACHE_PATH):
+    if not cache_dir:
+        run_polynomial_path_fitter(model, coordinate_values, results_dir)
+    else:
+        # Reuse an earlier fit of the same model to the same coordinate samples, if we 
+        # have one.
+        cache_entry_dir = os.path.join(
+            cache_dir, get_function_based_paths_cache_key(model, coordinate_values))
+        if not load_function_based_paths_from_cache(cache_entry_dir, results_dir):
+            run_polynomial_path_fitter(model, coordinate_values, results_dir)
+            store_function_based_paths_in_cache(results_dir, cache_dir, cache_entry_dir)
+
+    # Importing plotting pulls in matplotlib and pandas, so we only do it once we actually need to make a plot
+    from plotting import plot_coordinate_samples, plot_path_lengths, plot_moment_arms
     plot_coordinate_samples(results_dir, model.getName())
     plot_path_lengths(results_dir, model.getName())
     plot_moment_arms(results_dir, model.getName())
 
 
+def get_trial_timestamps(trial_proto: nimble.biomechanics.SubjectOnDiskTrial) -> np.ndarray:
+    """
+    The timestamps of every frame in a trial, computed the same way the OpenSim writer computes the time column of the
+    IK, ID and GRF files.
+    """
+    start_time = trial_proto.getOriginalTrialStartTime()
+    dt = trial_proto.getTimestep()
+    return np.array([start_time + i * dt for i in range(trial_proto.getTrialLength())])
+
+
+def get_coordinate_values_table(skel: nimble.dynamics.Skeleton, 
+                                trial_protos: List[nimble.biomechanics.SubjectOnDiskTrial],
+                                samples_per_trial: int) -> osim.TimeSeriesTable:
+    """
+    Build the table of coordinate samples for function-based path fitting from the first `samples_per_trial` frames of
+    each trial's final poses. This holds the same values as the trials' IK .mot files, but in radians, and without the
+    round trip through text.
+    """
+    coordinate_values = osim.TimeSeriesTable()
+    curr_row = 0
+    for trial_proto in trial_protos:
+        poses = trial_proto.getPasses()[-1].getPoses()
+        for irow in range(min(samples_per_trial, poses.shape[1])):
+            coordinate_values.appendRow(curr_row, osim.RowVector.createFromMat(poses[:, irow]))
+            curr_row += 1
+
+    column_labels = osim.StdVectorString()
+    for idof in range(skel.getNumDofs()):
+        column_labels.append(skel.getDofByIndex(idof).getName())
+    coordinate_values.setColumnLabels(column_labels)
+    coordinate_values.addTableMetaDataString('inDegrees', 'no')
+    return coordinate_values
+
+
+def get_max_abs_generalized_forces(skel: nimble.dynamics.Skeleton, 
+                                   trial_proto: nimble.biomechanics.SubjectOnDiskTrial,
+                                   initial_time: float, final_time: float) -> Dict[str, float]:
+    """
+    The largest absolute generalized force on each DOF between `initial_time` and `final_time`, keyed by the column 
+    names the DOF has in the trial's ID .sto file (e.g. 'hip_flexion_r_moment' or 'pelvis_tx_force').
+    """
+    taus = trial_proto.getPasses()[-1].getTaus()
+    timestamps = get_trial_timestamps(trial_proto)
+    in_range = np.logical_and(timestamps >= initial_time, timestamps <= final_time)
+    max_abs_taus = np.max(np.abs(taus[:, in_range]), axis=1)
+
+    max_abs_generalized_forces: Dict[str, float] = {}
+    for idof in range(skel.getNumDofs()):
+        dof_name = skel.getDofByIndex(idof).getName()
+        # The caller knows each coordinate's motion type, and so which suffix to look up.
+        max_abs_generalized_forces[f'{dof_name}_moment'] = max_abs_taus[idof]
+        max_abs_generalized_forces[f'{dof_name}_force'] = max_abs_taus[idof]
+    return max_abs_generalized_forces
+
+
 def create_residuals_force_set(output_folder, trial_name, residual_strengths):
     residuals = osim.ForceSet()
     for key, value in residual_strengths.items():
@@ -175,7 +364,8 @@ def create_residuals_force_set(output_folder, trial_name, residual_strengths):
 
 def fill_moco_template(moco_template_fpath, script_fpath, model_name, trial_name, 
                        reserve_strength, max_isometric_force_scale, initial_time, 
-                       final_time, excitation_effort, activation_effort, reserve_effort):
+                       final_time, excitation_effort, activation_effort, reserve_effort,
+                       parallel=1):
     with open(moco_template_fpath) as ft:
         content = ft.read()
         content = content.replace('@TRIAL@', trial_name)
@@ -188,16 +378,67 @@ def fill_moco_template(moco_template_fpath, script_fpath, model_name, trial_name
         content = content.replace('@EXCITATION_EFFORT@', str(excitation_effort))
         content = content.replace('@ACTIVATION_EFFORT@', str(activation_effort))
         content = content.replace('@RESERVE_EFFORT@', str(reserve_effort))
+        content = content.replace('@PARALLEL@', str(parallel))
 
     with open(script_fpath, 'w') as f:
         f.write(content)
 
 
+class MocoTrialSolve:
+    """
+    The settings for the MocoInverse problem on a single trial.
+    """
+    def __init__(self, trial_name: str, id_fpath: str, reserve_strength: float, 
+                 initial_time: float, final_time: float):
+        self.trial_name = trial_name
+        self.id_fpath = id_fpath
+        self.reserve_strength = reserve_strength
+        self.initial_time = initial_time
+        self.final_time = final_time
+
+
+def get_moco_solve_schedule(num_solves: int, cpu_budget: int) -> Tuple[int, int]:
+    """
+    Split a budget of `cpu_budget` CPUs across `num_solves` MocoInverse solves. Returns the number of solves to run at
+    once, and the value of the MocoCasADiSolver 'parallel' setting to give each of them. With a budget of 1 CPU or
+    less, the solves run one at a time on a single thread each, and a single solve with the whole machine as its
+    budget uses the solver's default of every core.
+    """
+    # In the 'parallel' setting, 1 means all the cores on the machine, and 0 means a single thread.
+    if cpu_budget <= 1:
+        return 1, 0
+    if num_solves <= 1 and cpu_budget >= os.cpu_count():
+        return 1, 1
+    concurrent_solves = max(1, min(num_solves, cpu_budget // MIN_THREADS_PER_MOCO_SOLVE))
+    threads_per_solve = cpu_budget // concurrent_solves
+    return concurrent_solves, threads_per_solve if threads_per_solve > 1 else 0
+
+
+def run_moco_script(script_fpath: str, moco_dir: str, log_fpath: str = None):
+    """
+    Run a generated MocoInverse script in a subprocess. If `log_fpath` is given, the script's output is written there
+    and echoed to our stdout in one piece once the script finishes, so that concurrent solves don't interleave their
+    logs.
+    """
+    if log_fpath is None:
+        subprocess.run([sys.executable, script_fpath], stdout=sys.stdout, 
+                       stderr=sys.stderr, cwd=moco_dir)
+        return
+    with open(log_fpath, 'w') as log_file:
+        subprocess.run([sys.executable, script_fpath], stdout=log_file, 
+                       stderr=subprocess.STDOUT, cwd=moco_dir)
+    with open(log_fpath) as log_file:
+        print(log_file.read(), flush=True)
+
+
 def moco_pass(subject: nimble.biomechanics.SubjectOnDisk,
               path: str, output_name: str, 
-              generic_mass: float, generic_height: float):
+              generic_mass: float, generic_height: float,
+              num_processes: int = 1):
     """
-    This function is responsible for running the Moco pass on the subject.
+    This function is responsible for running the Moco pass on the subject. The MocoInverse solves for the trials are
+    spread across a budget of `num_processes` CPUs, running several trials at once if the budget allows it, and the
+    results are plotted once all the solves have finished.
     """
 
     # TODOs
@@ -283,23 +524,19 @@ def moco_pass(subject: nimble.biomechanics.SubjectOnDisk,
                                     f'motion type "{invalid_type}".')                
             break
 
+    # The skeleton for the final poses of the trials, which we build the Moco inputs 
+    # from directly, rather than re-reading the IK and ID results files we just wrote 
+    # out from them.
+    skel = subject.readOpenSimFile(subject.getNumProcessingPasses()-1, 
+                                   ignoreGeometry=True).skeleton
+
     # Function-based paths.
     # ---------------------
     # Fit a set of function-based paths to the model. Grab the coordinate samples from 
     # all trials in this subject.
     samples_per_trial = total_samples // num_trials
-    coordinate_values = osim.TimeSeriesTable()
-    curr_row = 0
-    for itrial in range(num_trials):
-        trial_name = trial_protos[itrial].getName()
-        ik = osim.TimeSeriesTable(os.path.join(output_folder, 'IK', f'{trial_name}_ik.mot'))
-        for irow in range(min(samples_per_trial, ik.getNumRows())):
-            coordinate_values.appendRow(curr_row, ik.getRowAtIndex(irow))
-            curr_row += 1
-            
-    coordinate_values.setColumnLabels(ik.getColumnLabels())
-    coordinate_values.addTableMetaDataString('inDegrees', 
-                                             ik.getTableMetaDataAsString('inDegrees'))
+    coordinate_values = get_coordinate_values_table(
+        skel, [trial_protos[itrial] for itrial in range(num_trials)], samples_per_trial)
     fit_function_based_paths(model, coordinate_values, fbpaths_dir)
 
     # Filter trials.
@@ -319,6 +556,8 @@ def moco_pass(subject: nimble.biomechanics.SubjectOnDisk,
     # maximum allowed trial length.
     sto = osim.STOFileAdapter()
     not_missing_grf = nimble.biomechanics.MissingGRFReason.notMissingGRF
+    moco_dir = os.path.join(output_folder, 'Moco')
+    moco_solves: List[MocoTrialSolve] = []
     for trial in moco_trials:
         trial_name = trial_protos[trial].getName()
         start_time = trial_protos[trial].getOriginalTrialStartTime()
@@ -347,20 +586,13 @@ def moco_pass(subject: nimble.biomechanics.SubjectOnDisk,
                     final_time = time
                     break
 
-        # Check that initial_time and final_time are valid.
-        ik = osim.TimeSeriesTable(os.path.join(output_folder, 'IK', f'{trial_name}_ik.mot'))
-        ik_time = ik.getIndependentColumn()
-        if initial_time < ik_time[0]:
-            initial_time = ik_time[0]
-        if final_time > ik_time[-1]:
-            final_time = ik_time[-1]
-
-        grf = osim.TimeSeriesTable(os.path.join(output_folder, 'ID', f'{trial_name}_grf.mot'))
-        grf_time = grf.getIndependentColumn()
-        if initial_time < grf_time[0]:
-            initial_time = grf_time[0]
-        if final_time > grf_time[-1]:
-            final_time = grf_time[-1]
+        # Check that initial_time and final_time are valid. The IK and GRF files share 
+        # these timestamps.
+        timestamps = get_trial_timestamps(trial_protos[trial])
+        if initial_time < timestamps[0]:
+            initial_time = timestamps[0]
+        if final_time > timestamps[-1]:
+            final_time = timestamps[-1]
 
         # Final trim and safety checks.
         initial_time += 0.05
@@ -372,10 +604,10 @@ def moco_pass(subject: nimble.biomechanics.SubjectOnDisk,
 
         # Detect the needed residual strengths based on the trial ID moments.
         id_fpath = os.path.join(output_folder, 'ID', f'{trial_name}_id.sto')
-        id = osim.TimeSeriesTable(id_fpath)
-        id.trim(initial_time, final_time)
+        max_abs_generalized_forces = get_max_abs_generalized_forces(
+            skel, trial_protos[trial], initial_time, final_time)
         for key in residual_strengths.keys():
-            max_gen_force = 4.0*max(abs(id.getDependentColumn(key).to_numpy()))
+            max_gen_force = 4.0*max_abs_generalized_forces[key]
             residual_strengths[key] = np.ceil(max_gen_force)
         create_residuals_force_set(output_folder, trial_name, residual_strengths)
 
@@ -383,22 +615,46 @@ def moco_pass(subject: nimble.biomechanics.SubjectOnDisk,
         reserve_strength = 1.0*default_reserve_strength
         for coord_name in coordinate_names:
             moment_name = f'{coord_name}_moment'
-            max_reserve_strength = max(abs(id.getDependentColumn(moment_name).to_numpy()))
+            max_reserve_strength = max_abs_generalized_forces[moment_name]
             if max_reserve_strength > reserve_strength:
                 reserve_strength = np.ceil(max_reserve_strength)
 
+        moco_solves.append(MocoTrialSolve(trial_name, id_fpath, reserve_strength, 
+                                          initial_time, final_time))
+
+    # Run the MocoInverse problems.
+    # -----------------------------
+    # Each solve runs in its own subprocess. Within the CPU budget, we run as many at once as we can give a reasonable
+    # number of threads each.
+    concurrent_solves, parallel = get_moco_solve_schedule(len(moco_solves), num_processes)
+    template_fpath = os.path.join(TEMPLATES_PATH, 'template_moco.py.txt')
+    script_fpaths: List[str] = []
+    for solve in moco_solves:
         # Fill the MocoInverse problem template.
-        script_fpath = os.path.join(output_folder, 'Moco', f'{trial_name}_moco.py')
-        template_fpath = os.path.join(TEMPLATES_PATH, 'template_moco.py.txt')
-        fill_moco_template(template_fpath, script_fpath, model.getName(), trial_name, 
-                           reserve_strength, max_isometric_force_scale, initial_time, 
-                           final_time, excitation_effort, activation_effort,
-                           reserve_effort)
-                            
-        # Run the MocoInverse problem.
-        moco_dir = os.path.join(output_folder, 'Moco')
-        subprocess.run([sys.executable, script_fpath], stdout=sys.stdout, 
-                    stderr=sys.stderr, cwd=moco_dir)
+        script_fpath = os.path.join(moco_dir, f'{solve.trial_name}_moco.py')
+        fill_moco_template(template_fpath, script_fpath, model.getName(), solve.trial_name, 
+                           solve.reserve_strength, max_isometric_force_scale, 
+                           solve.initial_time, solve.final_time, excitation_effort, 
+                           activation_effort, reserve_effort, parallel)
+        script_fpaths.append(script_fpath)
+
+    if concurrent_solves <= 1:
+        for script_fpath in script_fpaths:
+            run_moco_script(script_fpath, moco_dir)
+    else:
+        print(f'Running {len(script_fpaths)} MocoInverse problems, {concurrent_solves} at a time, with '
+              f'{parallel} threads each...', flush=True)
+        with ThreadPoolExecutor(max_workers=concurrent_solves) as executor:
+            futures = [executor.submit(run_moco_script, script_fpath, moco_dir, 
+                                       script_fpath[:-len('.py')] + '.log')
+                       for script_fpath in script_fpaths]
+            for future in futures:
+                future.result()
+
+    # Plot the results.
+    # -----------------
+    for solve in moco_solves:
+        trial_name = solve.trial_name
         solution_fpath = os.path.join(moco_dir, f'{trial_name}_moco.sto')
         model_fpath = os.path.join(moco_dir, f'{trial_name}_moco.osim')
 
@@ -413,11 +669,12 @@ def moco_pass(subject: nimble.biomechanics.SubjectOnDisk,
         model_moco.initSystem()
         
         # Plot the joint moment breakdown.
+        from plotting import plot_joint_moment_breakdown
         tendon_forces_fpath = os.path.join(moco_dir, f'{trial_name}_tendon_forces.sto')
         output_fpath = os.path.join(moco_dir, f'{trial_name}_joint_moment_breakdown.pdf')
         plot_joint_moment_breakdown(model_moco, solution_fpath, 
-                                    tendon_forces_fpath, id_fpath, coordinate_names, 
-                                    reserve_strength, output_fpath)
+                                    tendon_forces_fpath, solve.id_fpath, coordinate_names, 
+                                    solve.reserve_strength, output_fpath)
 
 
 
@@ -0,0 +1,68 @@
+import contextlib
+import multiprocessing
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+# The function and shared state of the pool that is currently running, as (fn, state). This is set in the parent right
+# before the pool forks, so every worker gets its own copy-on-write copy of the state, and nothing but the items and
+# results has to be pickled. It is reset as soon as the pool is done.
+_fork_pool_job: Optional[Tuple[Callable[[Any, Any], Any], Any]] = None
+
+
+def _init_fork_pool_worker(initializer: Callable[[Any], Any]):
+    global _fork_pool_job
+    fn, state = _fork_pool_job
+    _fork_pool_job = (fn, initializer(state))
+
+
+def _run_fork_pool_item(item: Any) -> Any:
+    fn, state = _fork_pool_job
+    return fn(state, item)
+
+
+@contextlib.contextmanager
+def _fork_pool(fn: Callable[[Any, Any], Any],
+               state: Any,
+               num_processes: int,
+               initializer: Optional[Callable[[Any], Any]]):
+    global _fork_pool_job
+    _fork_pool_job = (fn, state)
+    try:
+        context = multiprocessing.get_context('fork')
+        with context.Pool(processes=max(1, num_processes),
+                          initializer=_init_fork_pool_worker if initializer is not None else None,
+                          initargs=(initializer,) if initializer is not None else ()) as pool:
+            yield pool
+    finally:
+        _fork_pool_job = None
+
+
+def fork_pool_imap_unordered(fn: Callable[[Any, T], R],
+                             items: Iterable[T],
+                             state: Any,
+                             num_processes: int,
+                             initializer: Optional[Callable[[Any], Any]] = None) -> Iterator[R]:
+    """
+    Call `fn(state, item)` for every item in a pool of at most `num_processes` forked worker processes, and yield the
+    results as they finish. If `initializer` is given, each worker replaces its copy of `state` with
+    `initializer(state)` once, on startup, which is useful for per-worker setup like loading a skeleton.
+    """
+    items = list(items)
+    with _fork_pool(fn, state, min(num_processes, len(items)), initializer) as pool:
+        for result in pool.imap_unordered(_run_fork_pool_item, items, chunksize=1):
+            yield result
+
+
+def fork_pool_map(fn: Callable[[Any, T], R],
+                  items: Iterable[T],
+                  state: Any,
+                  num_processes: int,
+                  initializer: Optional[Callable[[Any], Any]] = None) -> List[R]:
+    """
+    Like fork_pool_imap_unordered(), but wait for every item and return the results in the same order as `items`.
+    """
+    items = list(items)
+    with _fork_pool(fn, state, min(num_processes, len(items)), initializer) as pool:
+        return pool.map(_run_fork_pool_item, items, chunksize=1)
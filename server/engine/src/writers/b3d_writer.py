@@ -0,0 +1,63 @@
+import shutil
+import nimblephysics as nimble
+import multiprocessing
+from typing import List
+
+
+def get_dynamics_trials(subject: nimble.biomechanics.SubjectOnDisk) -> List[bool]:
+    """
+    For each trial, whether it made it through the (last) dynamics processing pass. If the subject has no dynamics
+    pass, no trials are included.
+    """
+    pass_index = -1
+    for p in range(subject.getNumProcessingPasses()):
+        if subject.getProcessingPassType(p) == nimble.biomechanics.ProcessingPassType.DYNAMICS:
+            pass_index = p
+    if pass_index == -1:
+        return [False] * subject.getNumTrials()
+    return [subject.getTrialNumProcessingPasses(trial) > pass_index for trial in range(subject.getNumTrials())]
+
+
+def write_filtered_b3d(header_proto: nimble.biomechanics.SubjectOnDiskHeader,
+                       include_trials: List[bool],
+                       b3d_fpath: str):
+    # This mutates the header, so it must only ever run on a copy of it, like the one in a forked child process
+    header_proto.filterTrials(include_trials)
+    nimble.biomechanics.SubjectOnDisk.writeB3D(b3d_fpath, header_proto)
+
+
+def write_b3d_files(subject: nimble.biomechanics.SubjectOnDisk,
+                    b3d_fpath: str,
+                    dynamics_b3d_fpath: str) -> int:
+    """
+    Write the full B3D file for the subject, and, if any trials made it through the dynamics pass, a second B3D file
+    with only those trials. Returns the number of dynamics trials. The subject's header proto is left untouched.
+
+    If every trial is a dynamics trial, the two files are identical, so the full file is simply copied. Otherwise, the
+    filtered file is written by a forked child process, which filters its own copy-on-write copy of the header while
+    the full file is written here.
+    """
+    include_trials = get_dynamics_trials(subject)
+    num_dynamics_trials = sum(include_trials)
+    header_proto = subject.getHeaderProto()
+
+    filtered_process = None
+    if 0 < num_dynamics_trials < len(include_trials):
+        print('Writing B3D file encoded results which have been filtered to only include dynamics trials', flush=True)
+        context = multiprocessing.get_context('fork')
+        filtered_process = context.Process(target=write_filtered_b3d,
+                                           args=(header_proto, include_trials, dynamics_b3d_fpath))
+        filtered_process.start()
+
+    try:
+        nimble.biomechanics.SubjectOnDisk.writeB3D(b3d_fpath, header_proto)
+    finally:
+        if filtered_process is not None:
+            filtered_process.join()
+    if filtered_process is not None and filtered_process.exitcode != 0:
+        raise RuntimeError(f'Writing {dynamics_b3d_fpath} failed with exit code {filtered_process.exitcode}')
+
+    if num_dynamics_trials > 0 and num_dynamics_trials == len(include_trials):
+        print('All trials are dynamics trials, so the dynamics-only B3D file is a copy of the full one', flush=True)
+        shutil.copyfile(b3d_fpath, dynamics_b3d_fpath)
+    return num_dynamics_trials
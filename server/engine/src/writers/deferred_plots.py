@@ -0,0 +1,97 @@
+import os
+import sys
+import json
+import multiprocessing
+from typing import List, Dict, Any, Optional
+
+PLOTS_MANIFEST_NAME = 'plots_manifest.json'
+
+
+def get_plot_job(function_name: str, output_folder: str, output_fpath: str, *fpaths: str) -> Dict[str, Any]:
+    """
+    Describe a call to one of the plotting functions in plotting.py, which will write the PDF at `output_fpath`. The
+    paths are stored relative to `output_folder`, so the manifest still works if the results folder is moved or
+    unzipped somewhere else.
+    """
+    return {'function': function_name,
+            'args': [os.path.relpath(fpath, output_folder) for fpath in fpaths],
+            'output': os.path.relpath(output_fpath, output_folder)}
+
+
+def get_plot_outputs(manifest_fpath: str) -> List[str]:
+    """
+    The absolute paths of all the PDFs that the plots in a manifest will write.
+    """
+    output_folder = os.path.dirname(os.path.abspath(manifest_fpath))
+    with open(manifest_fpath) as f:
+        plot_jobs = json.load(f)['plots']
+    return [os.path.join(output_folder, plot_job['output']) for plot_job in plot_jobs]
+
+
+def write_plots_manifest(output_folder: str, plot_jobs: List[Dict[str, Any]]) -> str:
+    manifest_fpath = os.path.join(output_folder, PLOTS_MANIFEST_NAME)
+    with open(manifest_fpath, 'w') as f:
+        json.dump({'plots': plot_jobs}, f, indent=4)
+    return manifest_fpath
+
+
+def run_plot_job(output_folder: str, plot_job: Dict[str, Any]):
+    # Importing plotting pulls in matplotlib and pandas, so we only do it once we actually need to make a plot
+    import plotting
+    plot_function = getattr(plotting, plot_job['function'])
+    plot_function(*[os.path.join(output_folder, fpath) for fpath in plot_job['args']])
+
+
+def generate_plots_from_manifest(manifest_fpath: str):
+    """
+    Generate every PDF plot listed in a manifest written by write_plots_manifest().
+    """
+    output_folder = os.path.dirname(os.path.abspath(manifest_fpath))
+    with open(manifest_fpath) as f:
+        plot_jobs = json.load(f)['plots']
+    print(f'Generating {len(plot_jobs)} deferred plots from {manifest_fpath}', flush=True)
+    for plot_job in plot_jobs:
+        run_plot_job(output_folder, plot_job)
+
+
+def start_generating_plots_in_background(manifest_fpath: str) -> multiprocessing.Process:
+    """
+    Start generating the plots in a manifest in a forked background process, and return the process so the caller
+    can join it once it needs the plots.
+    """
+    context = multiprocessing.get_context('fork')
+    process = context.Process(target=generate_plots_from_manifest, args=(manifest_fpath,))
+    process.start()
+    return process
+
+
+def stop_generating_plots(process: multiprocessing.Process, manifest_fpath: str):
+    """
+    Stop a background process started by start_generating_plots_in_background() without waiting for the rest of the
+    plots, and delete whatever plots it got to, since the last one may be half written. The manifest is kept, so the
+    plots can still be generated later on demand.
+    """
+    if process.is_alive():
+        process.terminate()
+    process.join()
+    for plot_output in get_plot_outputs(manifest_fpath):
+        if os.path.exists(plot_output):
+            os.remove(plot_output)
+
+
+def main(argv: Optional[List[str]] = None):
+    """
+    Generate the plots for a results folder on demand: python deferred_plots.py <path to plots_manifest.json>
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) != 1:
+        print('Usage: python deferred_plots.py <path to ' + PLOTS_MANIFEST_NAME + '>')
+        exit(1)
+    generate_plots_from_manifest(argv[0])
+
+
+if __name__ == '__main__':
+    # plotting.py lives one folder up from here
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    main()
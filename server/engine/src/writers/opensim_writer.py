@@ -1,8 +1,9 @@
 import os
 import nimblephysics as nimble
 import shutil
-from typing import List, Optional
-from plotting import plot_ik_results, plot_id_results, plot_marker_errors, plot_grf_data
+from typing import List, Optional, Dict, Any
+from utilities.fork_pool import fork_pool_map
+from writers.deferred_plots import get_plot_job, run_plot_job, write_plots_manifest
 import numpy as np
 
 GENERIC_OSIM_NAME = 'unscaled_generic.osim'
@@ -12,8 +13,17 @@ DYNAMICS_OSIM_NAME = 'match_markers_and_physics.osim'
 
 def write_opensim_results(subject: nimble.biomechanics.SubjectOnDisk,
                           path: str, output_name: str,                           
-                          original_geometry_folder_path: Optional[str] = None):
-    
+                          original_geometry_folder_path: Optional[str] = None,
+                          num_processes: int = 1,
+                          defer_plots: bool = False) -> Optional[str]:
+    """
+    Write out the folder of OpenSim results for the subject. The shared Models/ folder is written first, and then
+    each trial's IK, ID, GRF and marker files and plots, which are independent of each other. If `num_processes` is
+    greater than 1, the trials are written by that many forked worker processes.
+
+    If `defer_plots` is set, the PDF plots are not generated here. Instead, they are listed in a plots manifest in the
+    output folder, whose path is returned, to be generated later with writers.deferred_plots.
+    """
     output_folder = os.path.join(path, output_name)
     if not output_folder.endswith('/'):
         output_folder += '/'
@@ -62,152 +72,191 @@ def write_opensim_results(subject: nimble.biomechanics.SubjectOnDisk,
     marker_names: List[str] = list(osim.markersMap.keys())
 
     # 9.9. Write the results to disk.
-    trial_protos = subject.getHeaderProto().getTrials()
-    for i in range(subject.getNumTrials()):
-        trial_proto = trial_protos[i]
-        trial_name = subject.getTrialName(i)
-        print('Writing OpenSim output for trial ' + trial_name, flush=True)
-
-        trial_passes = trial_proto.getPasses()
-        any_dynamics_passes = any([p.getType() == nimble.biomechanics.ProcessingPassType.DYNAMICS for p in trial_passes])
-        any_kinematics_passes = any([p.getType() == nimble.biomechanics.ProcessingPassType.KINEMATICS for p in trial_passes])
-
-        ik_fpath = ''
-        id_fpath = ''
-        grf_fpath = ''
-        grf_raw_fpath = ''
-        # Write out the result data files.
-        result_ik: Optional[nimble.biomechanics.IKErrorReport] = None
-        marker_observations = None
-        if any_dynamics_passes:
-            last_pass = trial_passes[-1]
-            poses = last_pass.getPoses()
-            taus = last_pass.getTaus()
-            marker_observations = trial_proto.getMarkerObservations()
-            start_time = trial_proto.getOriginalTrialStartTime()
-            dt = trial_proto.getTimestep()
-            num_steps = trial_proto.getTrialLength()
-            timestamps = [start_time + i * dt for i in range(num_steps)]
-            assert(len(timestamps) == poses.shape[1])
-            print(f'Writing OpenSim ID file, shape={str(poses.shape)}', flush=True)
-
-            # Write out the inverse kinematics results,
-            ik_fpath = f'{output_folder}IK/{trial_name}_ik.mot'
-            print(f'Writing OpenSim {ik_fpath} file, shape={str(poses.shape)}', flush=True)
-            nimble.biomechanics.OpenSimParser.saveMot(osim.skeleton,
-                                                      ik_fpath,
-                                                      timestamps,
-                                                      poses)
-            # Write the inverse dynamics results.
-            id_fpath = f'{output_folder}ID/{trial_name}_id.sto'
-            nimble.biomechanics.OpenSimParser.saveIDMot(osim.skeleton,
-                                                        id_fpath,
-                                                        timestamps,
-                                                        taus)
-            # Create the IK error report for this segment
-            result_ik = nimble.biomechanics.IKErrorReport(
-                osim.skeleton,
-                osim.markersMap,
-                poses,
-                marker_observations)
-            # Write out the OpenSim ID files:
-            grf_fpath = f'{output_folder}ID/{trial_name}_grf.mot'
-            grf_raw_fpath = f'{output_folder}ID/{trial_name}_grf_raw.mot'
-
-            force_plates = last_pass.getProcessedForcePlates()
-
-            nimble.biomechanics.OpenSimParser.saveProcessedGRFMot(
-                grf_fpath,
-                timestamps,
-                [osim.skeleton.getBodyNode(name) for name in subject.getGroundForceBodies()],
-                osim.skeleton,
-                poses,
-                force_plates,
-                last_pass.getGroundBodyWrenches())
-            nimble.biomechanics.OpenSimParser.saveOsimInverseDynamicsProcessedForcesXMLFile(
-                trial_name,
-                [osim.skeleton.getBodyNode(name) for name in subject.getGroundForceBodies()],
-                trial_name + '_grf.mot',
-                output_folder + 'ID/' + trial_name + '_external_forces.xml')
-
-            # TODO: update to use the subject's ground force bodies.
-            # nimble.biomechanics.OpenSimParser.saveRawGRFMot(grf_raw_fpath, timestamps, force_plates)
-            # nimble.biomechanics.OpenSimParser.saveOsimInverseDynamicsRawForcesXMLFile(
-            #     trial_name,
-            #     osim.skeleton,
-            #     poses,
-            #     force_plates,
-            #     trial_name + '_grf_raw.mot',
-            #     output_folder + 'ID/' + trial_name + '_external_forces_raw.xml')
-            # nimble.biomechanics.OpenSimParser.saveOsimInverseDynamicsXMLFile(
-            #     trial_name,
-            #     '../Models/' + DYNAMICS_OSIM_NAME,
-            #     '../IK/' + trial_name + '_ik.mot',
-            #     trial_name + '_external_forces_raw.xml',
-            #     trial_name + '_id.sto',
-            #     trial_name + '_id_body_forces.sto',
-            #     output_folder + 'ID/' + trial_name + '_id_setup.xml',
-            #     min(timestamps), max(timestamps))
-
-        elif any_kinematics_passes:
-            # Write out the inverse kinematics results,
-            ik_fpath = f'{output_folder}IK/{trial_name}_ik.mot'
-            last_pass = trial_passes[-1]
-            poses = last_pass.getPoses()
-            marker_observations = trial_proto.getMarkerObservations()
-            start_time = trial_proto.getOriginalTrialStartTime()
-            dt = trial_proto.getTimestep()
-            num_steps = trial_proto.getTrialLength()
-            timestamps = [start_time + i * dt for i in range(num_steps)]
-            assert(len(timestamps) == poses.shape[1])
-            print(f'Writing OpenSim {ik_fpath} file, shape={str(poses.shape)}', flush=True)
-            nimble.biomechanics.OpenSimParser.saveMot(osim.skeleton, ik_fpath, timestamps,
-                                                      poses)
-            # Create the IK error report for this segment
-            result_ik = nimble.biomechanics.IKErrorReport(
-                osim.skeleton, osim.markersMap, poses, marker_observations)
-
-        if result_ik is not None:
-            # Save OpenSim setup files to make it easy to (re)run IK on the results in OpenSim
-            nimble.biomechanics.OpenSimParser.saveOsimInverseKinematicsXMLFile(
-                trial_name,
-                marker_names,
-                f'../{osim_path}',
-                f'../MarkerData/{trial_name}.trc',
-                f'{trial_name}_ik_by_opensim.mot',
-                f'{output_folder}IK/{trial_name}_ik_setup.xml')
-
-        if marker_observations is not None:
-            # Write out the marker trajectories.
-            markers_fpath = f'{output_folder}MarkerData/{trial_name}.trc'
-            print('Saving TRC for trial ' + trial_name, flush=True)
-            start_time = trial_proto.getOriginalTrialStartTime()
-            dt = trial_proto.getTimestep()
-            num_steps = trial_proto.getTrialLength()
-            timestamps = [start_time + i * dt for i in range(num_steps)]
-            assert(len(timestamps) == len(marker_observations))
-            nimble.biomechanics.OpenSimParser.saveTRC(
-                markers_fpath, timestamps, marker_observations)
-            print('Saved', flush=True)
-
-        # Write out the marker errors.
-        if result_ik is not None:
-            marker_errors_fpath = f'{output_folder}IK/{trial_name}_marker_errors.csv'
-            result_ik.saveCSVMarkerErrorReport(marker_errors_fpath)
-
-        # 9.9.11. Plot results.
-        print(f'Plotting results for trial {trial_name}')
-        if ik_fpath and os.path.exists(ik_fpath):
-            plot_ik_results(ik_fpath)
-            plot_marker_errors(marker_errors_fpath, ik_fpath)
-
-        if id_fpath and os.path.exists(id_fpath):
-            plot_id_results(id_fpath)
-
-        if grf_fpath and os.path.exists(grf_fpath):
-            plot_grf_data(grf_fpath)
-
-        if os.path.exists(grf_raw_fpath):
-            plot_grf_data(grf_raw_fpath)
+    num_trials = subject.getNumTrials()
+    if num_processes <= 1 or num_trials <= 1:
+        trial_plot_jobs = [write_trial_opensim_results(subject, trial, output_folder, osim, marker_names, osim_path,
+                                                       defer_plots)
+                           for trial in range(num_trials)]
+    else:
+        # Start the longest trials first, so one long trial doesn't end up running alone at the end
+        trials = sorted(range(num_trials), key=lambda trial: -subject.getTrialLength(trial))
+        trial_plot_jobs = fork_pool_map(_write_trial_opensim_results_worker, trials,
+                                        (subject, output_folder, osim, marker_names, osim_path, defer_plots),
+                                        num_processes)
+
+    if defer_plots:
+        return write_plots_manifest(output_folder, [job for jobs in trial_plot_jobs for job in jobs])
+    return None
+
+
+def write_trial_opensim_results(subject: nimble.biomechanics.SubjectOnDisk,
+                                trial: int,
+                                output_folder: str,
+                                osim: nimble.biomechanics.OpenSimFile,
+                                marker_names: List[str],
+                                osim_path: str,
+                                defer_plots: bool = False) -> List[Dict[str, Any]]:
+    """
+    Write out the IK, ID, GRF and marker data files, setup files and plots for a single trial. If `defer_plots` is
+    set, the plots are returned as plot jobs for a plots manifest instead of being generated.
+    """
+    trial_proto = subject.getHeaderProto().getTrials()[trial]
+    trial_name = subject.getTrialName(trial)
+    print('Writing OpenSim output for trial ' + trial_name, flush=True)
+
+    trial_passes = trial_proto.getPasses()
+    any_dynamics_passes = any([p.getType() == nimble.biomechanics.ProcessingPassType.DYNAMICS for p in trial_passes])
+    any_kinematics_passes = any([p.getType() == nimble.biomechanics.ProcessingPassType.KINEMATICS for p in trial_passes])
+
+    ik_fpath = ''
+    id_fpath = ''
+    grf_fpath = ''
+    grf_raw_fpath = ''
+    # Write out the result data files.
+    result_ik: Optional[nimble.biomechanics.IKErrorReport] = None
+    marker_observations = None
+    if any_dynamics_passes:
+        last_pass = trial_passes[-1]
+        poses = last_pass.getPoses()
+        taus = last_pass.getTaus()
+        marker_observations = trial_proto.getMarkerObservations()
+        start_time = trial_proto.getOriginalTrialStartTime()
+        dt = trial_proto.getTimestep()
+        num_steps = trial_proto.getTrialLength()
+        timestamps = [start_time + i * dt for i in range(num_steps)]
+        assert(len(timestamps) == poses.shape[1])
+        print(f'Writing OpenSim ID file, shape={str(poses.shape)}', flush=True)
+
+        # Write out the inverse kinematics results,
+        ik_fpath = f'{output_folder}IK/{trial_name}_ik.mot'
+        print(f'Writing OpenSim {ik_fpath} file, shape={str(poses.shape)}', flush=True)
+        nimble.biomechanics.OpenSimParser.saveMot(osim.skeleton,
+                                                  ik_fpath,
+                                                  timestamps,
+                                                  poses)
+        # Write the inverse dynamics results.
+        id_fpath = f'{output_folder}ID/{trial_name}_id.sto'
+        nimble.biomechanics.OpenSimParser.saveIDMot(osim.skeleton,
+                                                    id_fpath,
+                                                    timestamps,
+                                                    taus)
+        # Create the IK error report for this segment
+        result_ik = nimble.biomechanics.IKErrorReport(
+            osim.skeleton,
+            osim.markersMap,
+            poses,
+            marker_observations)
+        # Write out the OpenSim ID files:
+        grf_fpath = f'{output_folder}ID/{trial_name}_grf.mot'
+        grf_raw_fpath = f'{output_folder}ID/{trial_name}_grf_raw.mot'
+
+        force_plates = last_pass.getProcessedForcePlates()
+
+        nimble.biomechanics.OpenSimParser.saveProcessedGRFMot(
+            grf_fpath,
+            timestamps,
+            [osim.skeleton.getBodyNode(name) for name in subject.getGroundForceBodies()],
+            osim.skeleton,
+            poses,
+            force_plates,
+            last_pass.getGroundBodyWrenches())
+        nimble.biomechanics.OpenSimParser.saveOsimInverseDynamicsProcessedForcesXMLFile(
+            trial_name,
+            [osim.skeleton.getBodyNode(name) for name in subject.getGroundForceBodies()],
+            trial_name + '_grf.mot',
+            output_folder + 'ID/' + trial_name + '_external_forces.xml')
+
+        # TODO: update to use the subject's ground force bodies.
+        # nimble.biomechanics.OpenSimParser.saveRawGRFMot(grf_raw_fpath, timestamps, force_plates)
+        # nimble.biomechanics.OpenSimParser.saveOsimInverseDynamicsRawForcesXMLFile(
+        #     trial_name,
+        #     osim.skeleton,
+        #     poses,
+        #     force_plates,
+        #     trial_name + '_grf_raw.mot',
+        #     output_folder + 'ID/' + trial_name + '_external_forces_raw.xml')
+        # nimble.biomechanics.OpenSimParser.saveOsimInverseDynamicsXMLFile(
+        #     trial_name,
+        #     '../Models/' + DYNAMICS_OSIM_NAME,
+        #     '../IK/' + trial_name + '_ik.mot',
+        #     trial_name + '_external_forces_raw.xml',
+        #     trial_name + '_id.sto',
+        #     trial_name + '_id_body_forces.sto',
+        #     output_folder + 'ID/' + trial_name + '_id_setup.xml',
+        #     min(timestamps), max(timestamps))
+
+    elif any_kinematics_passes:
+        # Write out the inverse kinematics results,
+        ik_fpath = f'{output_folder}IK/{trial_name}_ik.mot'
+        last_pass = trial_passes[-1]
+        poses = last_pass.getPoses()
+        marker_observations = trial_proto.getMarkerObservations()
+        start_time = trial_proto.getOriginalTrialStartTime()
+        dt = trial_proto.getTimestep()
+        num_steps = trial_proto.getTrialLength()
+        timestamps = [start_time + i * dt for i in range(num_steps)]
+        assert(len(timestamps) == poses.shape[1])
+        print(f'Writing OpenSim {ik_fpath} file, shape={str(poses.shape)}', flush=True)
+        nimble.biomechanics.OpenSimParser.saveMot(osim.skeleton, ik_fpath, timestamps,
+                                                  poses)
+        # Create the IK error report for this segment
+        result_ik = nimble.biomechanics.IKErrorReport(
+            osim.skeleton, osim.markersMap, poses, marker_observations)
+
+    if result_ik is not None:
+        # Save OpenSim setup files to make it easy to (re)run IK on the results in OpenSim
+        nimble.biomechanics.OpenSimParser.saveOsimInverseKinematicsXMLFile(
+            trial_name,
+            marker_names,
+            f'../{osim_path}',
+            f'../MarkerData/{trial_name}.trc',
+            f'{trial_name}_ik_by_opensim.mot',
+            f'{output_folder}IK/{trial_name}_ik_setup.xml')
+
+    if marker_observations is not None:
+        # Write out the marker trajectories.
+        markers_fpath = f'{output_folder}MarkerData/{trial_name}.trc'
+        print('Saving TRC for trial ' + trial_name, flush=True)
+        start_time = trial_proto.getOriginalTrialStartTime()
+        dt = trial_proto.getTimestep()
+        num_steps = trial_proto.getTrialLength()
+        timestamps = [start_time + i * dt for i in range(num_steps)]
+        assert(len(timestamps) == len(marker_observations))
+        nimble.biomechanics.OpenSimParser.saveTRC(
+            markers_fpath, timestamps, marker_observations)
+        print('Saved', flush=True)
+
+    # Write out the marker errors.
+    if result_ik is not None:
+        marker_errors_fpath = f'{output_folder}IK/{trial_name}_marker_errors.csv'
+        result_ik.saveCSVMarkerErrorReport(marker_errors_fpath)
+
+    # 9.9.11. Plot results.
+    # Each plot is written next to the data file it plots.
+    plot_jobs: List[Dict[str, Any]] = []
+    if ik_fpath and os.path.exists(ik_fpath):
+        plot_jobs.append(get_plot_job('plot_ik_results', output_folder, ik_fpath.replace('.mot', '.pdf'), ik_fpath))
+        plot_jobs.append(get_plot_job('plot_marker_errors', output_folder, marker_errors_fpath.replace('.csv', '.pdf'),
+                                      marker_errors_fpath, ik_fpath))
+
+    if id_fpath and os.path.exists(id_fpath):
+        plot_jobs.append(get_plot_job('plot_id_results', output_folder, id_fpath.replace('.sto', '.pdf'), id_fpath))
+
+    if grf_fpath and os.path.exists(grf_fpath):
+        plot_jobs.append(get_plot_job('plot_grf_data', output_folder, grf_fpath.replace('.mot', '.pdf'), grf_fpath))
+
+    if os.path.exists(grf_raw_fpath):
+        plot_jobs.append(get_plot_job('plot_grf_data', output_folder, grf_raw_fpath.replace('.mot', '.pdf'),
+                                      grf_raw_fpath))
+
+    if defer_plots:
+        return plot_jobs
+    print(f'Plotting results for trial {trial_name}')
+    for plot_job in plot_jobs:
+        run_plot_job(output_folder, plot_job)
+    return []
 
 
+def _write_trial_opensim_results_worker(state, trial: int) -> List[Dict[str, Any]]:
+    subject, output_folder, osim, marker_names, osim_path, defer_plots = state
+    return write_trial_opensim_results(subject, trial, output_folder, osim, marker_names, osim_path, defer_plots)
@@ -0,0 +1,307 @@
+import os
+import zlib
+import time
+import json
+import struct
+import hashlib
+import shutil
+import zipfile
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import BinaryIO, Dict, Any, Iterable, Tuple, Optional
+
+# Formats that are already compressed, so deflating them again costs time for next to no gain. These are stored as-is.
+STORED_EXTENSIONS = {'.zip', '.gz', '.bz2', '.xz', '.b3d', '.pdf', '.png', '.jpg', '.jpeg', '.mp4'}
+
+# Sizes and offsets at or above this don't fit in the classic zip headers, and need the Zip64 extensions
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_COUNT_LIMIT = 0xFFFF
+
+
+# How much of a file to read, compress and copy at a time, so no member is ever held in memory whole
+CHUNK_SIZE = 1024 * 1024
+
+
+def copy_member(f: BinaryIO, spool_path: str) -> Tuple[int, int]:
+    """
+    Copy the rest of an open file into a spool file as-is, returning its (CRC32, size).
+    """
+    crc = 0
+    size = 0
+    with open(spool_path, 'wb') as spool:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if len(chunk) == 0:
+                break
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            spool.write(chunk)
+    return crc, size
+
+
+def compress_member(file_path: str, store: bool, spool_dir: str) -> Optional[Tuple[int, int, int, int, str]]:
+    """
+    Compress a single file for the archive into a spool file in `spool_dir`, a chunk at a time, returning its
+    (compression method, CRC32, uncompressed size, compressed size, spool path). Files that don't get any smaller when
+    deflated are stored instead. If the file is gone by the time it gets compressed, this returns None.
+    """
+    try:
+        f = open(file_path, 'rb')
+    except FileNotFoundError:
+        return None
+    with f:
+        spool_fd, spool_path = tempfile.mkstemp(dir=spool_dir)
+        os.close(spool_fd)
+        if not store:
+            # A raw deflate stream (negative window bits), which is what zip members hold
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+            crc = 0
+            size = 0
+            with open(spool_path, 'wb') as spool:
+                while True:
+                    chunk = f.read(CHUNK_SIZE)
+                    if len(chunk) == 0:
+                        break
+                    crc = zlib.crc32(chunk, crc)
+                    size += len(chunk)
+                    spool.write(compressor.compress(chunk))
+                spool.write(compressor.flush())
+                compressed_size = spool.tell()
+            if compressed_size < size:
+                return zipfile.ZIP_DEFLATED, crc, size, compressed_size, spool_path
+            f.seek(0)
+        crc, size = copy_member(f, spool_path)
+        return zipfile.ZIP_STORED, crc, size, size, spool_path
+
+
+def remove_spool(compressed: Future):
+    """
+    Delete the spool file of a member that was replaced or dropped before the archive was written, once it has been
+    compressed.
+    """
+    try:
+        result = compressed.result()
+        if result is not None:
+            os.remove(result[4])
+    except Exception:
+        pass
+
+
+def get_dos_date_time(mtime: float) -> Tuple[int, int]:
+    t = time.localtime(mtime)
+    # Zip timestamps can't represent anything before 1980
+    if t.tm_year < 1980:
+        return (0 << 9) | (1 << 5) | 1, 0
+    dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    return dos_date, dos_time
+
+
+class ArchiveMember:
+    def __init__(self, name: str, stat: os.stat_result, is_dir: bool, compressed: Optional[Future]):
+        self.name = name
+        self.stat = stat
+        self.is_dir = is_dir
+        self.compressed = compressed
+        self.offset = 0
+
+    def is_unchanged(self, stat: os.stat_result) -> bool:
+        return self.stat.st_mtime_ns == stat.st_mtime_ns and self.stat.st_size == stat.st_size
+
+
+class ResultsArchive:
+    """
+    Builds a zip archive of a results folder while the results are still being produced. Each file starts compressing
+    on a pool of threads as soon as it is added (zlib releases the GIL while it deflates, so the members really are
+    compressed in parallel), into its own spool file next to the archive. When the archive is closed, the spooled
+    members are concatenated, in the order the files were added, with their headers. zipfile.ZipFile can only write
+    one member at a time, so the headers are written here.
+
+    Adding a file that is already in the archive is a no-op, unless the file has changed since it was added, in which
+    case it is compressed again. That makes it safe to add a whole folder after every stage that writes into it. Files
+    that are deleted before the archive is written are left out of it.
+
+    Either close() or abort() must be called once the archive is no longer being added to, to stop the compression
+    threads and clean up the spool files.
+    """
+    def __init__(self, zip_fpath: str, root_dir: str, num_threads: int = 1):
+        self.zip_fpath = zip_fpath
+        self.root_dir = root_dir
+        self.executor = ThreadPoolExecutor(max_workers=max(1, num_threads))
+        self.spool_dir = tempfile.mkdtemp(prefix='.spool-', dir=os.path.dirname(os.path.abspath(zip_fpath)))
+        self.members: Dict[str, ArchiveMember] = {}
+
+    def get_member_name(self, path: str) -> str:
+        return os.path.relpath(path, self.root_dir).replace(os.sep, '/')
+
+    def add_file(self, file_path: str):
+        name = self.get_member_name(file_path)
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            self.remove_member(name)
+            return
+        existing = self.members.get(name)
+        if existing is not None and existing.is_unchanged(stat):
+            return
+        if existing is not None:
+            existing.compressed.add_done_callback(remove_spool)
+        store = os.path.splitext(file_path)[1].lower() in STORED_EXTENSIONS
+        self.members[name] = ArchiveMember(name, stat, False,
+                                           self.executor.submit(compress_member, file_path, store, self.spool_dir))
+
+    def remove_member(self, name: str):
+        member = self.members.pop(name, None)
+        if member is not None and member.compressed is not None:
+            member.compressed.add_done_callback(remove_spool)
+
+    def add_folder(self, folder: str, exclude: Iterable[str] = ()):
+        """
+        Add a folder and everything in it, except the files whose absolute paths are in `exclude`. Anything that was
+        added from this folder before, but has been deleted since, is dropped from the archive.
+        """
+        exclude = set(exclude)
+        prefix = self.get_member_name(folder) + '/'
+        for name in [name for name in self.members if name.startswith(prefix)]:
+            if not os.path.exists(os.path.join(self.root_dir, name)):
+                self.remove_member(name)
+        for root, dirs, files in os.walk(folder):
+            dirs.sort()
+            name = self.get_member_name(root) + '/'
+            if name not in self.members:
+                self.members[name] = ArchiveMember(name, os.stat(root), True, None)
+            for file in sorted(files):
+                file_path = os.path.join(root, file)
+                if os.path.abspath(file_path) not in exclude:
+                    self.add_file(file_path)
+
+    def close(self) -> Dict[str, Any]:
+        """
+        Write out the archive, and return its size in bytes and SHA-256 checksum.
+        """
+        sha256 = hashlib.sha256()
+        offset = 0
+        central_directory = []
+        try:
+            with open(self.zip_fpath, 'wb') as f:
+                def write(data: bytes):
+                    nonlocal offset
+                    f.write(data)
+                    sha256.update(data)
+                    offset += len(data)
+
+                for member in self.members.values():
+                    if member.is_dir:
+                        method, crc, size, compressed_size, spool_path = zipfile.ZIP_STORED, 0, 0, 0, None
+                    else:
+                        compressed = member.compressed.result()
+                        if compressed is None:
+                            # The file was deleted before we got to compress it
+                            continue
+                        method, crc, size, compressed_size, spool_path = compressed
+                    member.offset = offset
+                    write(self.get_local_header(member, method, crc, size, compressed_size))
+                    if spool_path is not None:
+                        with open(spool_path, 'rb') as spool:
+                            while True:
+                                chunk = spool.read(CHUNK_SIZE)
+                                if len(chunk) == 0:
+                                    break
+                                write(chunk)
+                        os.remove(spool_path)
+                    central_directory.append(
+                        self.get_central_directory_header(member, method, crc, size, compressed_size))
+
+                central_directory_offset = offset
+                for header in central_directory:
+                    write(header)
+                write(self.get_end_of_central_directory(len(central_directory), offset - central_directory_offset,
+                                                        central_directory_offset))
+        finally:
+            self.executor.shutdown(wait=True)
+            shutil.rmtree(self.spool_dir, ignore_errors=True)
+        return {'size': offset, 'sha256': sha256.hexdigest()}
+
+    def abort(self):
+        """
+        Give up on the archive without writing it: skip compressing any members that haven't started yet, wait for the
+        ones in progress, and delete the spool files.
+        """
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        shutil.rmtree(self.spool_dir, ignore_errors=True)
+
+    def get_local_header(self, member: ArchiveMember, method: int, crc: int, size: int, compressed_size: int) -> bytes:
+        name = member.name.encode('utf-8')
+        dos_date, dos_time = get_dos_date_time(member.stat.st_mtime)
+        extra = b''
+        version = 20
+        if size >= ZIP64_LIMIT or compressed_size >= ZIP64_LIMIT:
+            extra = struct.pack('<HHQQ', 1, 16, size, compressed_size)
+            size = compressed_size = ZIP64_LIMIT
+            version = 45
+        return struct.pack('<IHHHHHIIIHH', 0x04034b50, version, self.get_flags(name), method, dos_time, dos_date,
+                           crc, compressed_size, size, len(name), len(extra)) + name + extra
+
+    def get_central_directory_header(self,
+                                     member: ArchiveMember,
+                                     method: int,
+                                     crc: int,
+                                     size: int,
+                                     compressed_size: int) -> bytes:
+        name = member.name.encode('utf-8')
+        dos_date, dos_time = get_dos_date_time(member.stat.st_mtime)
+        offset = member.offset
+        # The Zip64 extra field holds, in this order, whichever of these values don't fit in the header
+        zip64_fields = []
+        if size >= ZIP64_LIMIT:
+            zip64_fields.append(size)
+            size = ZIP64_LIMIT
+        if compressed_size >= ZIP64_LIMIT:
+            zip64_fields.append(compressed_size)
+            compressed_size = ZIP64_LIMIT
+        if offset >= ZIP64_LIMIT:
+            zip64_fields.append(offset)
+            offset = ZIP64_LIMIT
+        extra = b''
+        version = 20
+        if len(zip64_fields) > 0:
+            extra = struct.pack('<HH', 1, 8 * len(zip64_fields)) + struct.pack(f'<{len(zip64_fields)}Q', *zip64_fields)
+            version = 45
+        external_attributes = (member.stat.st_mode & 0xFFFF) << 16
+        if member.is_dir:
+            # The MS-DOS directory flag
+            external_attributes |= 0x10
+        # Made by version `version` on Unix (3), so the permissions in the external attributes are honored
+        return struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | version, version, self.get_flags(name),
+                           method, dos_time, dos_date, crc, compressed_size, size, len(name), len(extra), 0, 0, 0,
+                           external_attributes, offset) + name + extra
+
+    def get_end_of_central_directory(self, count: int, size: int, offset: int) -> bytes:
+        end = b''
+        if count >= ZIP64_COUNT_LIMIT or size >= ZIP64_LIMIT or offset >= ZIP64_LIMIT:
+            zip64_end_offset = offset + size
+            end += struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0, count, count, size, offset)
+            end += struct.pack('<IIQI', 0x07064b50, 0, zip64_end_offset, 1)
+            count = min(count, ZIP64_COUNT_LIMIT)
+            size = min(size, ZIP64_LIMIT)
+            offset = min(offset, ZIP64_LIMIT)
+        return end + struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, count, count, size, offset, 0)
+
+    @staticmethod
+    def get_flags(name: bytes) -> int:
+        # Bit 11 marks the file name as UTF-8
+        try:
+            name.decode('ascii')
+            return 0
+        except UnicodeDecodeError:
+            return 0x800
+
+
+def write_archive_info(zip_fpath: str, archive_info: Dict[str, Any]) -> str:
+    """
+    Publish the size and checksum of an archive next to it, as `{zip_fpath}.json`, so the upload can be verified.
+    """
+    info_fpath = zip_fpath + '.json'
+    with open(info_fpath, 'w') as f:
+        json.dump(archive_info, f)
+    return info_fpath
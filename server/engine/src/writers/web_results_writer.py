@@ -4,10 +4,16 @@ import shutil
 from typing import List, Optional, Dict, Any, Tuple
 import json
 import textwrap
+from utilities.fork_pool import fork_pool_imap_unordered
 import numpy as np
 
+# Prefixes the line announce_segment_results() prints for every segment whose web results are complete. The processing
+# server watches our stdout for these lines, so this must match SEGMENT_RESULTS_READY_PREFIX in mocap_server.py.
+SEGMENT_RESULTS_READY_PREFIX = 'SEGMENT_RESULTS_READY: '
 
-def get_segment_results_json(trial_proto: nimble.biomechanics.SubjectOnDiskTrial) -> Dict[str, Any]:
+
+def get_segment_results_json(trial_proto: nimble.biomechanics.SubjectOnDiskTrial,
+                             dynamics_solves: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
     trial_passes = trial_proto.getPasses()
 
     kinematics_pass = -1
@@ -55,6 +61,8 @@ def get_segment_results_json(trial_proto: nimble.biomechanics.SubjectOnDiskTrial
         'angularResiduals': angular_residual if dynamics_pass != -1 else None,
         'totalTimestepsWithGRF': num_not_missing_grf,
         'totalTimestepsMissingGRF': num_missing_grf,
+        # Telemetry from every dynamics solve that included this segment
+        'dynamicsSolves': dynamics_solves if dynamics_solves is not None else [],
         # Hand scaled marker error results, if present
         'goldAvgRMSE': None,
         'goldAvgMax': None,
@@ -69,6 +77,35 @@ def get_segment_results_json(trial_proto: nimble.biomechanics.SubjectOnDiskTrial
     return results
 
 
+def get_marker_trajectories(marker_observations: List[Dict[str, np.ndarray]],
+                            marker_names: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Pack a list of per-frame marker observations into a (frames, markers, 3) array of positions, in the order of
+    `marker_names`, along with a (frames, markers) mask of which markers were observed on each frame. Unobserved
+    positions are left at zero.
+    """
+    marker_index = {name: m for m, name in enumerate(marker_names)}
+    positions = np.zeros((len(marker_observations), len(marker_names), 3))
+    observed = np.zeros((len(marker_observations), len(marker_names)), dtype=bool)
+    for t, obs in enumerate(marker_observations):
+        for name in obs:
+            positions[t, marker_index[name]] = obs[name]
+            observed[t, marker_index[name]] = True
+    return positions, observed
+
+
+def get_changed_frames(values: np.ndarray) -> np.ndarray:
+    """
+    Given a (frames, ...) array, return a mask of the frames whose values differ from the frame before. The first
+    frame always counts as changed.
+    """
+    changed = np.ones(len(values), dtype=bool)
+    if len(values) > 1:
+        changed[1:] = np.any(values[1:].reshape(len(values) - 1, -1) != values[:-1].reshape(len(values) - 1, -1),
+                             axis=1)
+    return changed
+
+
 def save_segment_to_gui(trial_proto: nimble.biomechanics.SubjectOnDiskTrial,
                         gui_file_path: str,
                         kinematics_pass_index: int = -1,
@@ -126,11 +163,8 @@ def save_segment_to_gui(trial_proto: nimble.biomechanics.SubjectOnDiskTrial,
         gui.createLayer(dynamics_fit_layer_name, defaultShow=True)
 
     # 1.2. Create the marker set objects, so we don't recreate them every frame
-    render_markers_set = set()
-    for obs in marker_observations:
-        for key in obs:
-            render_markers_set.add(key)
-    for marker in render_markers_set:
+    render_markers = sorted(set(key for obs in marker_observations for key in obs))
+    for marker in render_markers:
         gui.createBox('marker_' + str(marker),
                       np.ones(3, dtype=np.float64) * 0.02,
                       np.zeros(3, dtype=np.float64),
@@ -139,63 +173,82 @@ def save_segment_to_gui(trial_proto: nimble.biomechanics.SubjectOnDiskTrial,
                       layer=markers_layer_name)
         gui.setObjectTooltip('marker_' + str(marker), str(marker))
 
-    for t in range(len(marker_observations)):
-        if t % 50 == 0:
-            print(f'> Rendering frame {t} of {len(marker_observations)}')
-
+    # 1.3. Work out up front which objects actually change on each frame, so that we only send the GUI the changes.
+    # The marker boxes start out observed, at the origin, as created above.
+    num_frames = len(marker_observations)
+    marker_positions, marker_observed = get_marker_trajectories(marker_observations, render_markers)
+    prev_marker_positions = np.concatenate([np.zeros((1, len(render_markers), 3)), marker_positions[:-1]], axis=0)
+    prev_marker_observed = np.concatenate([np.ones((1, len(render_markers)), dtype=bool), marker_observed[:-1]], axis=0)
+    markers_appeared = marker_observed & ~prev_marker_observed
+    markers_moved = marker_observed & prev_marker_observed & np.any(marker_positions != prev_marker_positions, axis=2)
+    markers_disappeared = ~marker_observed & prev_marker_observed
+
+    force_plate_lines: List[np.ndarray] = []
+    force_plate_lines_changed: List[np.ndarray] = []
+    for i in range(len(force_plates)):
+        num_plate_frames = min(len(force_plate_raw_cops[i]), len(force_plate_raw_forces[i]),
+                               len(force_plate_raw_moments[i]), num_frames)
+        if num_plate_frames == 0:
+            force_plate_lines.append(np.zeros((0, 2, 3)))
+            force_plate_lines_changed.append(np.zeros(0, dtype=bool))
+            continue
+        cops = np.array(force_plate_raw_cops[i][:num_plate_frames])
+        forces = np.array(force_plate_raw_forces[i][:num_plate_frames])
+        lines = np.stack([cops, cops + forces * 0.001], axis=1)
+        force_plate_lines.append(lines)
+        force_plate_lines_changed.append(get_changed_frames(lines.reshape(num_plate_frames, -1)))
+
+    kinematics_poses_changed = get_changed_frames(kinematics_poses.T) if has_kinematics_pass else None
+    dynamics_poses_changed = get_changed_frames(dynamics_poses.T) if has_dynamics_pass else None
+
+    print(f'> Rendering {num_frames} frames', flush=True)
+    for t in range(num_frames):
         # 2. Always render the markers, even if we don't have kinematics or dynamics
-        for marker in render_markers_set:
-            if marker in marker_observations[t]:
-                # Render all the marker observations
-                gui.createBox('marker_' + str(marker),
-                              np.ones(3, dtype=np.float64) * 0.02,
-                              marker_observations[t][marker],
-                              np.zeros(3, dtype=np.float64),
-                              [0.5, 0.5, 0.5, 1.0],
-                              layer=markers_layer_name)
-            else:
-                gui.deleteObject('marker_' + str(marker))
-
-            # Render any marker warnings
-            # if self.marker_error_report is not None:
-            #     renamed_from_to: Set[Tuple[str, str]] = set(self.marker_error_report.markersRenamedFromTo[t])
-            #     for from_marker, to_marker in renamed_from_to:
-            #         from_marker_location = None
-            #         if from_marker in self.marker_observations[t]:
-            #             from_marker_location = self.marker_observations[t][from_marker]
-            #         to_marker_location = None
-            #         if to_marker in self.marker_observations[t]:
-            #             to_marker_location = self.marker_observations[t][to_marker]
-            #
-            #         if to_marker_location is not None and from_marker_location is not None:
-            #             gui.createLine('marker_renamed_' + str(from_marker) + '_to_' + str(to_marker), [to_marker_location, from_marker_location], [1.0, 0.0, 0.0, 1.0], layer=warnings_layer_name)
-            #         gui.setObjectWarning('marker_'+str(to_marker), 'warning_marker_renamed_' + str(from_marker) + '_to_' + str(to_marker), 'Marker ' + str(to_marker) + ' was originally named ' + str(from_marker), warnings_layer_name)
-            #     for from_marker, to_marker in self.render_markers_renamed_set:
-            #         if (from_marker, to_marker) not in renamed_from_to:
-            #             gui.deleteObject('marker_renamed_' + str(from_marker) + '_to_' + str(to_marker))
-            #         gui.deleteObjectWarning('marker_'+str(to_marker), 'warning_marker_renamed_' + str(from_marker) + '_to_' + str(to_marker))
+        for m in np.flatnonzero(markers_appeared[t]):
+            gui.createBox('marker_' + str(render_markers[m]),
+                          np.ones(3, dtype=np.float64) * 0.02,
+                          marker_positions[t, m],
+                          np.zeros(3, dtype=np.float64),
+                          [0.5, 0.5, 0.5, 1.0],
+                          layer=markers_layer_name)
+        for m in np.flatnonzero(markers_moved[t]):
+            gui.setObjectPosition('marker_' + str(render_markers[m]), marker_positions[t, m])
+        for m in np.flatnonzero(markers_disappeared[t]):
+            gui.deleteObject('marker_' + str(render_markers[m]))
+
+        # Render any marker warnings
+        # if self.marker_error_report is not None:
+        #     renamed_from_to: Set[Tuple[str, str]] = set(self.marker_error_report.markersRenamedFromTo[t])
+        #     for from_marker, to_marker in renamed_from_to:
+        #         from_marker_location = None
+        #         if from_marker in self.marker_observations[t]:
+        #             from_marker_location = self.marker_observations[t][from_marker]
+        #         to_marker_location = None
+        #         if to_marker in self.marker_observations[t]:
+        #             to_marker_location = self.marker_observations[t][to_marker]
+        #
+        #         if to_marker_location is not None and from_marker_location is not None:
+        #             gui.createLine('marker_renamed_' + str(from_marker) + '_to_' + str(to_marker), [to_marker_location, from_marker_location], [1.0, 0.0, 0.0, 1.0], layer=warnings_layer_name)
+        #         gui.setObjectWarning('marker_'+str(to_marker), 'warning_marker_renamed_' + str(from_marker) + '_to_' + str(to_marker), 'Marker ' + str(to_marker) + ' was originally named ' + str(from_marker), warnings_layer_name)
+        #     for from_marker, to_marker in self.render_markers_renamed_set:
+        #         if (from_marker, to_marker) not in renamed_from_to:
+        #             gui.deleteObject('marker_renamed_' + str(from_marker) + '_to_' + str(to_marker))
+        #         gui.deleteObjectWarning('marker_'+str(to_marker), 'warning_marker_renamed_' + str(from_marker) + '_to_' + str(to_marker))
 
         # 3. Always render the force plates if we've got them, even if we don't have kinematics or dynamics
-        for i, force_plate in enumerate(force_plates):
-            # IMPORTANT PERFORMANCE NOTE: Every time force_plate.forces is referenced, it copies the ENTIRE ARRAY from
-            # C++ to Python, even if we're only asking for force_plate.forces[i]. So to avoid the performance hit, we
-            # need to use copies of these values that are already accessible from Python
-            if len(force_plate_raw_cops[i]) > t and len(force_plate_raw_forces[i]) > t and len(
-                    force_plate_raw_moments[i]) > t:
-                cop = force_plate_raw_cops[i][t]
-                force = force_plate_raw_forces[i][t]
-                moment = force_plate_raw_moments[i][t]
-                line = [cop, cop + force * 0.001]
-                gui.createLine('force_plate_' + str(i), line, [1.0, 0.0, 0.0, 1.0], layer=force_plate_layer_name,
-                               width=[2.0, 1.0])
-
-        # 4. Render the kinematics skeleton, if we have it
-        if has_kinematics_pass:
+        for i in range(len(force_plates)):
+            if t < len(force_plate_lines_changed[i]) and force_plate_lines_changed[i][t]:
+                gui.createLine('force_plate_' + str(i), list(force_plate_lines[i][t]), [1.0, 0.0, 0.0, 1.0],
+                               layer=force_plate_layer_name, width=[2.0, 1.0])
+
+        # 4. Render the kinematics skeleton, if we have it. Unlike the markers, the skeleton still goes through
+        # renderSkeleton() on every frame its pose changes, since that's what knows how its bodies map to GUI objects.
+        if has_kinematics_pass and kinematics_poses_changed[t]:
             kinematics_osim.skeleton.setPositions(kinematics_poses[:, t])
             gui.renderSkeleton(kinematics_osim.skeleton, prefix='kinematics_', layer=kinematics_fit_layer_name)
 
         # 5. Render the dynamics skeleton, if we have it
-        if has_dynamics_pass:
+        if has_dynamics_pass and dynamics_poses_changed[t]:
             dynamics_osim.skeleton.setPositions(dynamics_poses[:, t])
             gui.renderSkeleton(dynamics_osim.skeleton, prefix='dynamics_', layer=dynamics_fit_layer_name)
         gui.saveFrame()
@@ -206,7 +259,14 @@ def save_segment_to_gui(trial_proto: nimble.biomechanics.SubjectOnDiskTrial,
 def save_segment_csv(
         trial_proto: nimble.biomechanics.SubjectOnDiskTrial,
         csv_file_path: str,
-        final_skeleton: Optional[nimble.dynamics.Skeleton] = None):
+        final_skeleton: Optional[nimble.dynamics.Skeleton] = None,
+        columns_file_path: Optional[str] = None):
+    """
+    Write the segment's timestamps, and if we have a skeleton, the joint positions, velocities, accelerations, torques
+    and powers plus a missing GRF flag for every frame, as a CSV. If `columns_file_path` is given, the same table is
+    also written there in the binary columnar format of `save_segment_columns`, which the frontend can load without
+    parsing text.
+    """
     if len(trial_proto.getPasses()) == 0:
         return
 
@@ -216,56 +276,71 @@ def save_segment_csv(
     vels: np.ndarray = final_pass.getVels()
     accs: np.ndarray = final_pass.getAccs()
     taus: np.ndarray = final_pass.getTaus()
-    marker_observations = trial_proto.getMarkerObservations()
+    num_frames = len(trial_proto.getMarkerObservations())
     dt = trial_proto.getTimestep()
+    start_time = trial_proto.getOriginalTrialStartTime()
     missing_grf_reason = trial_proto.getMissingGRFReason()
 
-    # Write the CSV file
+    column_names = ['timestamp']
+    timestamps = [round(t * dt + start_time, 3) for t in range(num_frames)]
+    values: Optional[np.ndarray] = None
+    missing_grf: Optional[np.ndarray] = None
+    if final_skeleton is not None:
+        dof_names = [final_skeleton.getDofByIndex(i).getName() for i in range(final_skeleton.getNumDofs())]
+        for suffix in ['_pos', '_vel', '_acc', '_tau', '_pwr']:
+            column_names += [dof_name + suffix for dof_name in dof_names]
+        column_names.append('missing_grf_data')
+        num_dofs = len(dof_names)
+        # One row per frame, with the columns in the order of the header
+        values = np.concatenate([poses[:num_dofs, :num_frames],
+                                 vels[:num_dofs, :num_frames],
+                                 accs[:num_dofs, :num_frames],
+                                 taus[:num_dofs, :num_frames],
+                                 vels[:num_dofs, :num_frames] * taus[:num_dofs, :num_frames]], axis=0).T
+        missing_grf = np.array([reason != nimble.biomechanics.MissingGRFReason.notMissingGRF
+                                for reason in missing_grf_reason[:num_frames]], dtype=bool)
+
+    # Write the CSV file. Formatting through Python floats gives exactly the same text as str() on each value.
+    lines = [','.join(column_names)]
+    if values is None:
+        lines += [str(timestamp) for timestamp in timestamps]
+    else:
+        for timestamp, row, missing in zip(timestamps, values.tolist(), missing_grf.tolist()):
+            lines.append(str(timestamp) + ',' + ','.join(map(str, row)) + ',' + str(missing))
     with open(csv_file_path, 'w') as f:
-        f.write('timestamp')
-        if final_skeleton is not None:
-            # Joint positions
-            for i in range(final_skeleton.getNumDofs()):
-                f.write(',' + final_skeleton.getDofByIndex(i).getName() + '_pos')
-            # Joint velocities
-            for i in range(final_skeleton.getNumDofs()):
-                f.write(',' + final_skeleton.getDofByIndex(i).getName() + '_vel')
-            # Joint accelerations
-            for i in range(final_skeleton.getNumDofs()):
-                f.write(',' + final_skeleton.getDofByIndex(i).getName() + '_acc')
-            # Joint torques
-            for i in range(final_skeleton.getNumDofs()):
-                f.write(',' + final_skeleton.getDofByIndex(i).getName() + '_tau')
-            # Joint powers
-            for i in range(final_skeleton.getNumDofs()):
-                f.write(',' + final_skeleton.getDofByIndex(i).getName() + '_pwr')
-            f.write(',missing_grf_data')
-        f.write('\n')
-
-        for t in range(len(marker_observations)):
-            timestamp = t * dt + trial_proto.getOriginalTrialStartTime()
-            f.write(str(round(timestamp, 3)))
-            if final_skeleton is not None:
-                # Joint positions
-                for i in range(final_skeleton.getNumDofs()):
-                    f.write(',' + str(poses[i, t]))
-                # Joint velocities
-                for i in range(final_skeleton.getNumDofs()):
-                    f.write(',' + str(vels[i, t]))
-                # Joint accelerations
-                for i in range(final_skeleton.getNumDofs()):
-                    f.write(',' + str(accs[i, t]))
-                # Joint torques
-                for i in range(final_skeleton.getNumDofs()):
-                    f.write(',' + str(taus[i, t]))
-                # Joint power
-                for i in range(final_skeleton.getNumDofs()):
-                    f.write(',' + str(vels[i, t] * taus[i, t]))
-                f.write(',' + str(missing_grf_reason[t] != nimble.biomechanics.MissingGRFReason.notMissingGRF))
-            f.write('\n')
-
-
-def get_overall_results_json(subject: nimble.biomechanics.SubjectOnDisk) -> Dict[str, Any]:
+        f.write('\n'.join(lines) + '\n')
+
+    if columns_file_path is not None:
+        columns = [np.array(timestamps, dtype=np.float64)]
+        if values is not None:
+            columns += list(values.T) + [missing_grf.astype(np.float64)]
+        save_segment_columns(columns_file_path, column_names, columns)
+
+
+def save_segment_columns(columns_file_path: str, column_names: List[str], columns: List[np.ndarray]):
+    """
+    Write a table in a simple binary columnar format: a little-endian uint32 giving the length of a UTF-8 JSON header,
+    the header itself ({"columns": [...names], "numRows": N, "dtype": "float64"}), and then each column in order as N
+    little-endian float64 values.
+    """
+    num_rows = len(columns[0]) if len(columns) > 0 else 0
+    header = json.dumps({'columns': column_names, 'numRows': num_rows, 'dtype': 'float64'}).encode('utf-8')
+    with open(columns_file_path, 'wb') as f:
+        f.write(np.uint32(len(header)).astype('<u4').tobytes())
+        f.write(header)
+        for column in columns:
+            f.write(np.ascontiguousarray(column, dtype='<f8').tobytes())
+
+
+def get_segment_dynamics_solves(dynamics_telemetry: Optional[List[Dict[str, Any]]],
+                                segment_index: int) -> List[Dict[str, Any]]:
+    if dynamics_telemetry is None:
+        return []
+    return [solve for solve in dynamics_telemetry if segment_index in solve['trials']]
+
+
+def get_overall_results_json(subject: nimble.biomechanics.SubjectOnDisk,
+                             dynamics_telemetry: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
     overall_results: Dict[str, Any] = {}
     trial_protos = subject.getHeaderProto().getTrials()
     trial_results_by_original_trial_name: Dict[str, List[Dict[str, Any]]] = {}
@@ -273,7 +348,8 @@ def get_overall_results_json(subject: nimble.biomechanics.SubjectOnDisk) -> Dict
         trial_proto: nimble.biomechanics.SubjectOnDiskTrial = trial_protos[i]
         if trial_proto.getOriginalTrialName() not in trial_results_by_original_trial_name:
             trial_results_by_original_trial_name[trial_proto.getOriginalTrialName()] = []
-        trial_results_by_original_trial_name[trial_proto.getOriginalTrialName()].append(get_segment_results_json(trial_proto))
+        trial_results_by_original_trial_name[trial_proto.getOriginalTrialName()].append(
+            get_segment_results_json(trial_proto, get_segment_dynamics_solves(dynamics_telemetry, i)))
     for original_trial in trial_results_by_original_trial_name:
         trial_results: Dict[str, Any] = {'segments': trial_results_by_original_trial_name[original_trial]}
         overall_results[original_trial] = trial_results
@@ -298,20 +374,75 @@ def generate_readme() -> str:
     return text
 
 
+def save_segment_preview_and_csv(trial_proto: nimble.biomechanics.SubjectOnDiskTrial,
+                                 segment_path: str,
+                                 kinematics_pass_index: int,
+                                 kinematics_osim: Optional[nimble.biomechanics.OpenSimFile],
+                                 dynamics_pass_index: int,
+                                 dynamics_osim: Optional[nimble.biomechanics.OpenSimFile],
+                                 write_columns: bool = False):
+    # Write out the animation preview binary
+    save_segment_to_gui(
+        trial_proto,
+        segment_path + 'preview.bin',
+        kinematics_pass_index,
+        kinematics_osim,
+        dynamics_pass_index,
+        dynamics_osim)
+    # Write out the data CSV for the plotting software to synchronize on the frontend
+    save_segment_csv(
+        trial_proto,
+        segment_path + 'data.csv',
+        dynamics_osim.skeleton if dynamics_pass_index != -1 else kinematics_osim.skeleton,
+        segment_path + 'data.bin' if write_columns else None)
+
+
+def announce_segment_results(output_folder: str, segment_path: str):
+    """
+    Tell whoever is reading our stdout (the processing server) that a segment's web results are complete, so they can
+    be uploaded while the rest of the subject is still being written.
+    """
+    segment_results = {
+        'path': os.path.relpath(segment_path, output_folder) + '/',
+        'files': sorted(os.listdir(segment_path))
+    }
+    print(SEGMENT_RESULTS_READY_PREFIX + json.dumps(segment_results), flush=True)
+
+
+def _save_segment_preview_and_csv_worker(state, segment: Tuple[int, str]) -> str:
+    trial_protos, kinematics_pass_index, kinematics_osim, dynamics_pass_index, dynamics_osim, write_columns = state
+    segment_index, segment_path = segment
+    save_segment_preview_and_csv(trial_protos[segment_index],
+                                 segment_path,
+                                 kinematics_pass_index,
+                                 kinematics_osim,
+                                 dynamics_pass_index,
+                                 dynamics_osim,
+                                 write_columns)
+    return segment_path
+
+
 def write_web_results(
         subject: nimble.biomechanics.SubjectOnDisk,
         geometry_folder: str,
-        output_folder: str):
+        output_folder: str,
+        dynamics_telemetry: Optional[List[Dict[str, Any]]] = None,
+        num_processes: int = 1,
+        write_columns: bool = False):
+    """
+    Write out the results JSON, and each segment's results JSON, preview and data CSV, into the folder structure the
+    web UI reads from. The segment previews and CSVs are independent of each other, so if `num_processes` is greater
+    than 1 they are written by that many forked worker processes. If `write_columns` is set, each segment also gets a
+    data.bin with the contents of data.csv in binary columnar form.
+
+    Each segment is announced on stdout with announce_segment_results() as soon as its files are complete, and the
+    overall results JSON is written last, since it marks the whole subject as done.
+    """
     if not output_folder.endswith('/'):
         output_folder += '/'
     if not os.path.exists(output_folder):
         os.mkdir(output_folder)
 
-    overall_results = get_overall_results_json(subject)
-    with open(output_folder + '_results.json', 'w') as f:
-        json.dump(overall_results, f, indent=4)
-        print('Wrote JSON results to ' + output_folder + '_results.json', flush=True)
-
     trials_folder_path = output_folder + 'trials/'
     if not os.path.exists(trials_folder_path):
         os.mkdir(trials_folder_path)
@@ -338,6 +469,8 @@ def write_web_results(
             dynamics_osim = subject.readOpenSimFile(p, geometryFolder=geometry_folder)
             dynamics_pass_index = p
 
+    # The index and output folder of every segment, to write the previews and CSVs for once the JSONs are written
+    segments: List[Tuple[int, str]] = []
     for trial_name in trial_names_to_segments:
         trial_path = output_folder + 'trials/' + trial_name + '/'
         if not os.path.exists(trial_path):
@@ -350,19 +483,39 @@ def write_web_results(
                 os.mkdir(segment_path)
             # Write out the result summary JSON
             print('Writing JSON result to ' + segment_path + '_results.json', flush=True)
-            segment_json = get_segment_results_json(trial_proto)
+            segment_json = get_segment_results_json(
+                trial_proto, get_segment_dynamics_solves(dynamics_telemetry, segment_index))
             with open(segment_path + '_results.json', 'w') as f:
                 json.dump(segment_json, f, indent=4)
-            # Write out the animation preview binary
-            save_segment_to_gui(
-                trial_proto,
-                segment_path + 'preview.bin',
-                kinematics_pass_index,
-                kinematics_osim,
-                dynamics_pass_index,
-                dynamics_osim)
-            # Write out the data CSV for the plotting software to synchronize on the frontend
-            save_segment_csv(
-                trial_proto,
-                segment_path + 'data.csv',
-                dynamics_osim.skeleton if dynamics_pass_index != -1 else kinematics_osim.skeleton)
+            segments.append((segment_index, segment_path))
+
+    if num_processes <= 1 or len(segments) <= 1:
+        for segment_index, segment_path in segments:
+            save_segment_preview_and_csv(trial_protos[segment_index],
+                                         segment_path,
+                                         kinematics_pass_index,
+                                         kinematics_osim,
+                                         dynamics_pass_index,
+                                         dynamics_osim,
+                                         write_columns)
+            announce_segment_results(output_folder, segment_path)
+        write_overall_results_json(subject, output_folder, dynamics_telemetry)
+        return
+
+    # Start the longest segments first, so one long trial doesn't end up running alone at the end
+    segments.sort(key=lambda segment: -trial_protos[segment[0]].getTrialLength())
+    worker_state = (trial_protos, kinematics_pass_index, kinematics_osim, dynamics_pass_index, dynamics_osim,
+                    write_columns)
+    for segment_path in fork_pool_imap_unordered(_save_segment_preview_and_csv_worker, segments, worker_state,
+                                                 num_processes):
+        announce_segment_results(output_folder, segment_path)
+    write_overall_results_json(subject, output_folder, dynamics_telemetry)
+
+
+def write_overall_results_json(subject: nimble.biomechanics.SubjectOnDisk,
+                               output_folder: str,
+                               dynamics_telemetry: Optional[List[Dict[str, Any]]] = None):
+    overall_results = get_overall_results_json(subject, dynamics_telemetry)
+    with open(output_folder + '_results.json', 'w') as f:
+        json.dump(overall_results, f, indent=4)
+        print('Wrote JSON results to ' + output_folder + '_results.json', flush=True)
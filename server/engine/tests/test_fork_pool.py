@@ -0,0 +1,36 @@
+import unittest
+import os
+from utilities import fork_pool
+from utilities.fork_pool import fork_pool_map, fork_pool_imap_unordered
+
+
+def _scale_worker(state, item: int) -> int:
+    return state * item
+
+
+def _pid_worker(state, item: int) -> int:
+    return state
+
+
+class TestForkPool(unittest.TestCase):
+    def test_map_keeps_order(self):
+        self.assertEqual(fork_pool_map(_scale_worker, range(6), 10, 3), [0, 10, 20, 30, 40, 50])
+
+    def test_imap_unordered_returns_every_result(self):
+        results = list(fork_pool_imap_unordered(_scale_worker, range(6), 2, 3))
+        self.assertCountEqual(results, [0, 2, 4, 6, 8, 10])
+
+    def test_initializer_runs_in_the_workers(self):
+        pids = fork_pool_map(_pid_worker, range(4), None, 2, initializer=lambda state: os.getpid())
+        self.assertNotIn(os.getpid(), pids)
+
+    def test_state_is_reset(self):
+        fork_pool_map(_scale_worker, range(2), 1, 2)
+        self.assertIsNone(fork_pool._fork_pool_job)
+        with self.assertRaises(ZeroDivisionError):
+            fork_pool_map(lambda state, item: item / state, range(2), 0, 2)
+        self.assertIsNone(fork_pool._fork_pool_job)
+
+
+if __name__ == '__main__':
+    unittest.main()
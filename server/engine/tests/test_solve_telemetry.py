@@ -0,0 +1,106 @@
+import unittest
+import os
+import tempfile
+import time
+from typing import List
+from dynamics_pass.solve_telemetry import IterationPolicy, IpoptLogParser, parse_ipopt_log, run_ipopt_optimization, \
+    tee_native_stdout
+
+IPOPT_LOG = """
+This is Ipopt version 3.14.4, running with linear solver MUMPS 5.2.1.
+
+iter    objective    inf_pr   inf_du lg(mu)  ||d||  lg(rg) alpha_du alpha_pr  ls
+   0  1.2000000e+03 0.00e+00 1.00e+02   0.0 0.00e+00    -  0.00e+00 0.00e+00   0
+   1  6.0000000e+02 0.00e+00 5.00e+01  -1.0 1.00e+00    -  1.00e+00 1.00e+00f  1
+   2r 5.0000000e+02 0.00e+00 1.00e+01  -1.0 1.00e+00    -  1.00e+00 1.00e+00f  1
+
+Number of Iterations....: 2
+
+EXIT: Maximum Number of Iterations Exceeded.
+"""
+
+
+class FakeDynamicsFitter:
+    """
+    Stands in for nimble's DynamicsFitter, writing an IPOPT style log straight to the stdout file descriptor the way
+    the native solver does, with an objective that falls quickly and then flattens out.
+    """
+    def __init__(self):
+        self.iteration_limit = 0
+        self.lbfgs_history_length = 0
+        self.objective = 1000.0
+        self.iteration_limits: List[int] = []
+
+    def setIterationLimit(self, limit: int):
+        self.iteration_limit = limit
+
+    def setLBFGSHistoryLength(self, length: int):
+        self.lbfgs_history_length = length
+
+    def runIPOPTOptimization(self, init, config):
+        self.iteration_limits.append(self.iteration_limit)
+        lines = ['iter    objective    inf_pr   inf_du lg(mu)  ||d||  lg(rg) alpha_du alpha_pr  ls']
+        for i in range(self.iteration_limit + 1):
+            lines.append(f'{i:4d}  {self.objective:.7e} 0.00e+00 1.00e+00   0.0 0.00e+00    -  0.00e+00 0.00e+00   0')
+            if i < self.iteration_limit:
+                self.objective = 1.0 + (self.objective - 1.0) * 0.5
+        lines.append('EXIT: Maximum Number of Iterations Exceeded.')
+        os.write(1, ('\n'.join(lines) + '\n').encode('utf-8'))
+
+
+class TestSolveTelemetry(unittest.TestCase):
+    def test_parse_ipopt_log(self):
+        objectives, iterations, termination_reason = parse_ipopt_log(IPOPT_LOG)
+        self.assertEqual(objectives, [1200.0, 600.0, 500.0])
+        self.assertEqual(iterations, 2)
+        self.assertEqual(termination_reason, 'Maximum Number of Iterations Exceeded.')
+
+    def test_parse_silent_ipopt_log(self):
+        self.assertEqual(parse_ipopt_log(''), ([], 0, None))
+
+    def test_tee_native_stdout_passes_lines_through_live(self):
+        with tempfile.TemporaryFile() as stdout_file:
+            saved_stdout_fd = os.dup(1)
+            os.dup2(stdout_file.fileno(), 1)
+            try:
+                with tee_native_stdout(IpoptLogParser()) as parser:
+                    os.write(1, b'   0  1.2000000e+03 0.00e+00\n')
+                    # The line should reach the real stdout while the solve is still running
+                    for _ in range(100):
+                        if os.fstat(stdout_file.fileno()).st_size > 0:
+                            break
+                        time.sleep(0.01)
+                    self.assertGreater(os.fstat(stdout_file.fileno()).st_size, 0)
+                    os.write(1, b'EXIT: Optimal Solution Found.\n')
+            finally:
+                os.dup2(saved_stdout_fd, 1)
+                os.close(saved_stdout_fd)
+            stdout_file.seek(0)
+            self.assertEqual(stdout_file.read(), b'   0  1.2000000e+03 0.00e+00\nEXIT: Optimal Solution Found.\n')
+        self.assertEqual(parser.get_results(), ([1200.0], 0, 'Optimal Solution Found.'))
+
+    def test_fixed_iteration_budget(self):
+        fitter = FakeDynamicsFitter()
+        telemetry = run_ipopt_optimization(fitter, None, None, 'test', [0], 200, 20)
+        self.assertEqual(fitter.iteration_limits, [200])
+        self.assertEqual(fitter.lbfgs_history_length, 20)
+        self.assertEqual(telemetry.iterations, 200)
+        self.assertEqual(len(telemetry.objectives), 201)
+        self.assertEqual(telemetry.termination_reason, 'Maximum Number of Iterations Exceeded.')
+        self.assertFalse(telemetry.stopped_on_plateau)
+
+    def test_adaptive_iteration_budget_stops_on_plateau(self):
+        fitter = FakeDynamicsFitter()
+        policy = IterationPolicy(adaptive=True, chunk_iterations=10, min_relative_improvement=1e-3)
+        telemetry = run_ipopt_optimization(fitter, None, None, 'test', [0], 200, 20, policy)
+        self.assertTrue(telemetry.stopped_on_plateau)
+        # The third chunk only improves the objective from ~1.001 to ~1.000
+        self.assertEqual(fitter.iteration_limits, [10, 10, 10])
+        self.assertEqual(telemetry.iterations, 30)
+        self.assertEqual(len(telemetry.calls), 3)
+
+    def test_iteration_cap(self):
+        fitter = FakeDynamicsFitter()
+        telemetry = run_ipopt_optimization(fitter, None, None, 'test', [0], 200, 20, IterationPolicy(max_iterations=40))
+        self.assertEqual(fitter.iteration_limits, [40])
+        self.assertEqual(telemetry.iteration_limit, 40)
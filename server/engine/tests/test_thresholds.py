@@ -0,0 +1,157 @@
+import nimblephysics as nimble
+import unittest
+import os
+from inspect import getsourcefile
+from bad_frames_detector.thresholds import ThresholdsDetector
+import numpy as np
+
+TESTS_PATH = os.path.dirname(getsourcefile(lambda:0))
+TEST_DATA_PATH = os.path.join(TESTS_PATH, 'data')
+
+
+def extend_missing_grf_nested_loops(force_mags: np.ndarray, extend_frames: int):
+    """
+    The original nested-loop implementation of the force ramp extension, kept here as the reference that the
+    linear-time implementation must match exactly.
+    """
+    trial_len = len(force_mags)
+    missing = [nimble.biomechanics.MissingGRFReason.zeroForceFrame if force_mag < 10.0 else
+               nimble.biomechanics.MissingGRFReason.notMissingGRF for force_mag in force_mags]
+    for i in range(trial_len):
+        if missing[i] != nimble.biomechanics.MissingGRFReason.notMissingGRF or i == 0:
+            for j in range(1, extend_frames + 1):
+                if i + j < trial_len and force_mags[i] < force_mags[i + j]:
+                    for k in range(j):
+                        missing[i + k] = nimble.biomechanics.MissingGRFReason.extendedToNearestPeakForce
+    for i in range(trial_len - 1, -1, -1):
+        if missing[i] != nimble.biomechanics.MissingGRFReason.notMissingGRF or i == trial_len - 1:
+            for j in range(1, extend_frames + 1):
+                if i - j >= 0 and force_mags[i] < force_mags[i - j]:
+                    for k in range(j):
+                        missing[i - k] = nimble.biomechanics.MissingGRFReason.extendedToNearestPeakForce
+    return missing
+
+
+def extend_missing_grf_linear(force_mags: np.ndarray, extend_frames: int):
+    missing = [nimble.biomechanics.MissingGRFReason.zeroForceFrame if force_mag < 10.0 else
+               nimble.biomechanics.MissingGRFReason.notMissingGRF for force_mag in force_mags]
+    missing = ThresholdsDetector.extend_missing_into_force_ramp(missing, force_mags, extend_frames)
+    return ThresholdsDetector.extend_missing_into_force_ramp(missing[::-1], force_mags[::-1], extend_frames)[::-1]
+
+
+class TestThresholdsDetector(unittest.TestCase):
+    def test_distance_points_to_convex_hulls_2d(self):
+        square = np.array([[0.0, 0.0], [1.0, 0.0], [1.0, 1.0], [0.0, 1.0], [0.5, 0.5]])
+        points = np.array([
+            [0.5, 0.5],  # Inside
+            [0.25, 0.9],  # Inside
+            [2.0, 0.5],  # Right of the hull
+            [-1.0, -1.0],  # Off the corner
+            [0.5, 1.0],  # On the boundary
+        ])
+        hulls = np.repeat(square[np.newaxis, :, :], len(points), axis=0)
+        distances = ThresholdsDetector.distance_points_to_convex_hulls_2d(points, hulls)
+        np.testing.assert_allclose(distances, [0.0, 0.0, 1.0, np.sqrt(2.0), 0.0], atol=1e-12)
+
+    def test_batched_cop_error_matches_unbatched(self):
+        path = os.path.join(TEST_DATA_PATH, 'b3ds', 'falisse2017_small.b3d')
+        subject = nimble.biomechanics.SubjectOnDisk(path)
+        subject.loadAllFrames(doNotStandardizeForcePlateData=True)
+
+        detector = ThresholdsDetector()
+        osim = subject.readOpenSimFile(processingPass=0, ignoreGeometry=True)
+        skel = osim.skeleton
+        foot_markers = detector.get_foot_marker_sets(osim)
+
+        trial_protos = subject.getHeaderProto().getTrials()
+        for trial in range(subject.getNumTrials()):
+            raw_force_plates = trial_protos[trial].getForcePlates()
+            if len(raw_force_plates) == 0:
+                continue
+            raw_force_plate_forces = [plate.forces for plate in raw_force_plates]
+            raw_force_plate_cops = [plate.centersOfPressure for plate in raw_force_plates]
+            poses = trial_protos[trial].getPasses()[0].getPoses()
+            dt = subject.getTrialTimestep(trial)
+
+            expected = detector.get_force_weighted_convex_foot_cop_error(skel,
+                                                                         foot_markers,
+                                                                         poses,
+                                                                         raw_force_plate_forces,
+                                                                         raw_force_plate_cops,
+                                                                         dt)
+
+            force_plate_forces = np.array(raw_force_plate_forces).reshape((len(raw_force_plates), -1, 3))
+            force_plate_cops = np.array(raw_force_plate_cops).reshape((len(raw_force_plates), -1, 3))
+            contact_frames = np.flatnonzero(np.any(np.linalg.norm(force_plate_forces, axis=2) > 10.0, axis=0))
+            foot_marker_positions = detector.get_foot_marker_world_positions(skel, foot_markers, poses, contact_frames)
+            actual = detector.get_force_weighted_convex_foot_cop_error_batched(contact_frames,
+                                                                               foot_marker_positions,
+                                                                               force_plate_forces,
+                                                                               force_plate_cops,
+                                                                               dt)
+            self.assertAlmostEqual(expected, actual, places=9)
+
+    def test_force_ramp_extension_matches_nested_loops_on_synthetic_data(self):
+        rng = np.random.default_rng(0)
+        for i in range(300):
+            trial_len = int(rng.integers(1, 150))
+            if i % 2 == 0:
+                force_mags = rng.integers(0, 5, size=trial_len).astype(np.float64) * 5.0
+            else:
+                force_mags = np.clip(np.sin(np.arange(trial_len) / rng.uniform(2.0, 15.0)) * 500.0 +
+                                     rng.normal(scale=30.0, size=trial_len), 0.0, None)
+            extend_frames = int(rng.integers(1, 25))
+            self.assertEqual(extend_missing_grf_nested_loops(force_mags, extend_frames),
+                             extend_missing_grf_linear(force_mags, extend_frames))
+
+    def test_force_ramp_extension_matches_nested_loops_on_recorded_trials(self):
+        path = os.path.join(TEST_DATA_PATH, 'b3ds', 'falisse2017_small.b3d')
+        subject = nimble.biomechanics.SubjectOnDisk(path)
+        subject.loadAllFrames(doNotStandardizeForcePlateData=True)
+
+        trial_protos = subject.getHeaderProto().getTrials()
+        for trial in range(subject.getNumTrials()):
+            raw_force_plates = trial_protos[trial].getForcePlates()
+            if len(raw_force_plates) == 0:
+                continue
+            force_plate_forces = np.array([plate.forces for plate in raw_force_plates]).reshape(
+                (len(raw_force_plates), -1, 3))
+            force_mags = np.sum(np.linalg.norm(force_plate_forces, axis=2), axis=0)
+            self.assertEqual(extend_missing_grf_nested_loops(force_mags, 20),
+                             extend_missing_grf_linear(force_mags, 20))
+
+    def test_has_input_outliers(self):
+        class TrialHeader:
+            def __init__(self, marker_observations):
+                self.marker_observations = marker_observations
+
+            def getMarkerObservations(self):
+                return self.marker_observations
+
+        marker_observations = [
+            {'a': np.zeros(3), 'b': np.ones(3) * 0.1, 'c': np.ones(3) * 0.2},
+            {'a': np.zeros(3), 'c': np.ones(3) * 0.2},
+            {},
+        ]
+        forces = [[np.array([0.0, 700.0, 0.0])] * len(marker_observations)]
+        self.assertFalse(ThresholdsDetector.has_input_outliers(TrialHeader(marker_observations), forces))
+
+        # A marker far away from the rest of the cloud
+        far_marker_observations = marker_observations + [{'a': np.zeros(3), 'b': np.zeros(3), 'c': np.ones(3) * 5.0}]
+        far_forces = [forces[0] + [np.array([0.0, 700.0, 0.0])]]
+        self.assertTrue(ThresholdsDetector.has_input_outliers(TrialHeader(far_marker_observations), far_forces))
+
+        # A force plate reading that is too large
+        large_forces = [[np.array([0.0, 700.0, 0.0]), np.array([0.0, 3000.0, 0.0]), np.array([0.0, 700.0, 0.0])]]
+        self.assertTrue(ThresholdsDetector.has_input_outliers(TrialHeader(marker_observations), large_forces))
+
+    def test_parallel_estimate_missing_grfs_matches_serial(self):
+        path = os.path.join(TEST_DATA_PATH, 'b3ds', 'falisse2017_small.b3d')
+        subject = nimble.biomechanics.SubjectOnDisk(path)
+        subject.loadAllFrames(doNotStandardizeForcePlateData=True)
+
+        detector = ThresholdsDetector()
+        trials = list(range(subject.getNumTrials()))
+        serial = detector.estimate_missing_grfs(subject, trials)
+        parallel = detector.estimate_missing_grfs(subject, trials, num_processes=2)
+        self.assertEqual(serial, parallel)
@@ -4,14 +4,151 @@ import os
 from inspect import getsourcefile
 import shutil
 from writers.opensim_writer import write_opensim_results
-from writers.web_results_writer import write_web_results
+from writers.deferred_plots import get_plot_outputs, get_plot_job, write_plots_manifest, stop_generating_plots
+from writers.results_archive import ResultsArchive
+from writers.b3d_writer import write_b3d_files, get_dynamics_trials
+from writers.web_results_writer import write_web_results, get_marker_trajectories, get_changed_frames, \
+    save_segment_columns, save_segment_to_gui, SEGMENT_RESULTS_READY_PREFIX
 import tempfile
+import threading
+import multiprocessing
+import time
+import io
+import contextlib
+import json
+import zipfile
+import hashlib
+from unittest import mock
+import numpy as np
+from typing import Dict, List, Tuple
 
 TESTS_PATH = os.path.dirname(getsourcefile(lambda:0))
 TEST_DATA_PATH = os.path.join(TESTS_PATH, 'data')
 GEOMETRY_PATH = os.path.join(TESTS_PATH, '../Geometry') + '/'
 
 
+class RecordingGUIMock:
+    """
+    Stands in for nimble.server.GUIRecording. It plays the commands it's sent into the scene the web GUI would show,
+    and keeps a copy of that scene every time a frame is saved.
+    """
+    def __init__(self):
+        self.objects: Dict[str, Tuple] = {}
+        self.frames: List[Dict[str, Tuple]] = []
+
+    def setFramesPerSecond(self, fps: int):
+        pass
+
+    def createLayer(self, name: str, *args, **kwargs):
+        pass
+
+    def setObjectTooltip(self, key: str, tooltip: str):
+        pass
+
+    def createBox(self, key: str, size: np.ndarray, pos: np.ndarray, euler: np.ndarray, color: List[float],
+                  layer: str = ''):
+        self.objects[key] = ('box', tuple(pos))
+
+    def setObjectPosition(self, key: str, pos: np.ndarray):
+        self.objects[key] = (self.objects[key][0], tuple(pos))
+
+    def deleteObject(self, key: str):
+        self.objects.pop(key, None)
+
+    def createLine(self, key: str, points: List[np.ndarray], color: List[float], layer: str = '', width=None):
+        self.objects[key] = ('line', tuple(tuple(point) for point in points))
+
+    def renderSkeleton(self, skeleton, prefix: str = '', layer: str = ''):
+        self.objects[prefix + 'skeleton'] = ('skeleton', tuple(skeleton.getPositions()))
+
+    def saveFrame(self):
+        self.frames.append(dict(self.objects))
+
+    def writeFramesJson(self, path: str):
+        pass
+
+
+class SkeletonMock:
+    def __init__(self):
+        self.positions = np.zeros(0)
+
+    def setPositions(self, positions: np.ndarray):
+        self.positions = np.array(positions)
+
+    def getPositions(self) -> np.ndarray:
+        return self.positions
+
+
+class OpenSimMock:
+    def __init__(self):
+        self.skeleton = SkeletonMock()
+
+
+class PassMock:
+    def __init__(self, poses: np.ndarray):
+        self.poses = poses
+
+    def getPoses(self) -> np.ndarray:
+        return self.poses
+
+
+class ForcePlateMock:
+    def __init__(self, cops: List[np.ndarray], forces: List[np.ndarray]):
+        self.centersOfPressure = cops
+        self.forces = forces
+        self.moments = [np.zeros(3) for _ in cops]
+
+
+class TrialMock:
+    def __init__(self, marker_observations: List[Dict[str, np.ndarray]], force_plates: List[ForcePlateMock],
+                 passes: List[PassMock]):
+        self.marker_observations = marker_observations
+        self.force_plates = force_plates
+        self.passes = passes
+
+    def getTimestep(self) -> float:
+        return 0.01
+
+    def getMarkerObservations(self) -> List[Dict[str, np.ndarray]]:
+        return self.marker_observations
+
+    def getForcePlates(self) -> List[ForcePlateMock]:
+        return self.force_plates
+
+    def getPasses(self) -> List[PassMock]:
+        return self.passes
+
+
+def render_segment_every_frame(trial: TrialMock, gui: RecordingGUIMock, kinematics_osim: OpenSimMock,
+                               dynamics_osim: OpenSimMock):
+    """
+    The way save_segment_to_gui() used to render a segment, re-creating every object on every frame.
+    """
+    marker_observations = trial.getMarkerObservations()
+    render_markers = set(key for obs in marker_observations for key in obs)
+    for marker in render_markers:
+        gui.createBox('marker_' + marker, np.ones(3) * 0.02, np.zeros(3), np.zeros(3), [0.5, 0.5, 0.5, 1.0])
+    kinematics_poses = trial.getPasses()[0].getPoses()
+    dynamics_poses = trial.getPasses()[1].getPoses()
+    for t in range(len(marker_observations)):
+        for marker in render_markers:
+            if marker in marker_observations[t]:
+                gui.createBox('marker_' + marker, np.ones(3) * 0.02, marker_observations[t][marker], np.zeros(3),
+                              [0.5, 0.5, 0.5, 1.0])
+            else:
+                gui.deleteObject('marker_' + marker)
+        for i, force_plate in enumerate(trial.getForcePlates()):
+            if len(force_plate.centersOfPressure) > t and len(force_plate.forces) > t and len(force_plate.moments) > t:
+                cop = force_plate.centersOfPressure[t]
+                gui.createLine('force_plate_' + str(i), [cop, cop + force_plate.forces[t] * 0.001],
+                               [1.0, 0.0, 0.0, 1.0])
+        kinematics_osim.skeleton.setPositions(kinematics_poses[:, t])
+        gui.renderSkeleton(kinematics_osim.skeleton, prefix='kinematics_')
+        dynamics_osim.skeleton.setPositions(dynamics_poses[:, t])
+        gui.renderSkeleton(dynamics_osim.skeleton, prefix='dynamics_')
+        gui.saveFrame()
+
+
 class TestWriters(unittest.TestCase):
     def test_write_opensim(self):
         path = os.path.join(TEST_DATA_PATH, 'b3ds', 'falisse2017_small.b3d')
@@ -24,6 +161,62 @@ class TestWriters(unittest.TestCase):
 
             write_opensim_results(subject, temp_dir, 'osim_results')
 
+    def test_write_opensim_in_parallel(self):
+        path = os.path.join(TEST_DATA_PATH, 'b3ds', 'falisse2017_small.b3d')
+        subject = nimble.biomechanics.SubjectOnDisk(path)
+        subject.loadAllFrames(doNotStandardizeForcePlateData=True)
+
+        with tempfile.TemporaryDirectory() as serial_dir, tempfile.TemporaryDirectory() as parallel_dir:
+            write_opensim_results(subject, serial_dir, 'osim_results')
+            write_opensim_results(subject, parallel_dir, 'osim_results', num_processes=2)
+            for root, dirs, files in os.walk(serial_dir):
+                for file in files:
+                    # The PDF plots embed their creation time, so we only compare the data files
+                    if file.endswith('.pdf'):
+                        continue
+                    serial_path = os.path.join(root, file)
+                    parallel_path = os.path.join(parallel_dir, os.path.relpath(serial_path, serial_dir))
+                    with open(serial_path, 'rb') as f_serial, open(parallel_path, 'rb') as f_parallel:
+                        self.assertEqual(f_serial.read(), f_parallel.read())
+
+    def test_write_opensim_with_deferred_plots(self):
+        path = os.path.join(TEST_DATA_PATH, 'b3ds', 'falisse2017_small.b3d')
+        subject = nimble.biomechanics.SubjectOnDisk(path)
+        subject.loadAllFrames(doNotStandardizeForcePlateData=True)
+
+        with tempfile.TemporaryDirectory() as serial_dir, tempfile.TemporaryDirectory() as deferred_dir:
+            self.assertIsNone(write_opensim_results(subject, serial_dir, 'osim_results'))
+            manifest_fpath = write_opensim_results(subject, deferred_dir, 'osim_results', defer_plots=True)
+            self.assertTrue(os.path.exists(manifest_fpath))
+
+            # None of the plots should have been made yet, but they should be the same plots the serial run makes
+            plot_outputs = get_plot_outputs(manifest_fpath)
+            self.assertFalse(any(os.path.exists(plot_output) for plot_output in plot_outputs))
+            serial_plots = []
+            for root, dirs, files in os.walk(serial_dir):
+                serial_plots.extend(os.path.relpath(os.path.join(root, file), serial_dir)
+                                    for file in files if file.endswith('.pdf'))
+            self.assertEqual(sorted(serial_plots),
+                             sorted(os.path.relpath(plot_output, deferred_dir) for plot_output in plot_outputs))
+
+    def test_stop_generating_plots(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            plot_fpaths = [os.path.join(temp_dir, 'done.pdf'), os.path.join(temp_dir, 'half_written.pdf'),
+                           os.path.join(temp_dir, 'not_started.pdf')]
+            manifest_fpath = write_plots_manifest(temp_dir, [get_plot_job('plot_ik_results', temp_dir, plot_fpath)
+                                                             for plot_fpath in plot_fpaths])
+            for plot_fpath in plot_fpaths[:2]:
+                with open(plot_fpath, 'wb') as f:
+                    f.write(b'%PDF')
+            # Stand in for a plot process that's stuck on a slow plot
+            process = multiprocessing.get_context('fork').Process(target=time.sleep, args=(60,))
+            process.start()
+            start_time = time.time()
+            stop_generating_plots(process, manifest_fpath)
+            self.assertLess(time.time() - start_time, 30)
+            self.assertFalse(process.is_alive())
+            self.assertEqual(os.listdir(temp_dir), [os.path.basename(manifest_fpath)])
+
     def test_write_web_results(self):
         path = os.path.join(TEST_DATA_PATH, 'b3ds', 'falisse2017_small.b3d')
         subject = nimble.biomechanics.SubjectOnDisk(path)
@@ -34,3 +227,197 @@ class TestWriters(unittest.TestCase):
             print(f"Temporary directory created: {temp_dir}")
 
             write_web_results(subject, GEOMETRY_PATH, temp_dir)
+
+    def test_write_web_results_in_parallel(self):
+        path = os.path.join(TEST_DATA_PATH, 'b3ds', 'falisse2017_small.b3d')
+        subject = nimble.biomechanics.SubjectOnDisk(path)
+        subject.loadAllFrames(doNotStandardizeForcePlateData=True)
+
+        with tempfile.TemporaryDirectory() as serial_dir, tempfile.TemporaryDirectory() as parallel_dir:
+            write_web_results(subject, GEOMETRY_PATH, serial_dir)
+            write_web_results(subject, GEOMETRY_PATH, parallel_dir, num_processes=2)
+            for root, dirs, files in os.walk(serial_dir):
+                for file in files:
+                    serial_path = os.path.join(root, file)
+                    parallel_path = os.path.join(parallel_dir, os.path.relpath(serial_path, serial_dir))
+                    with open(serial_path, 'rb') as f_serial, open(parallel_path, 'rb') as f_parallel:
+                        self.assertEqual(f_serial.read(), f_parallel.read())
+
+    def test_write_web_results_announces_segments(self):
+        path = os.path.join(TEST_DATA_PATH, 'b3ds', 'falisse2017_small.b3d')
+        subject = nimble.biomechanics.SubjectOnDisk(path)
+        subject.loadAllFrames(doNotStandardizeForcePlateData=True)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            stdout = io.StringIO()
+            with contextlib.redirect_stdout(stdout):
+                write_web_results(subject, GEOMETRY_PATH, temp_dir, num_processes=2)
+            lines = stdout.getvalue().splitlines()
+            announced = [json.loads(line[len(SEGMENT_RESULTS_READY_PREFIX):]) for line in lines
+                         if line.startswith(SEGMENT_RESULTS_READY_PREFIX)]
+            self.assertEqual(len(announced), subject.getNumTrials())
+            for segment in announced:
+                self.assertIn('preview.bin', segment['files'])
+                self.assertIn('data.csv', segment['files'])
+                for file in segment['files']:
+                    self.assertTrue(os.path.exists(os.path.join(temp_dir, segment['path'], file)))
+            # The overall results JSON marks the subject as done, so it comes after every segment
+            self.assertTrue(lines[-1].startswith('Wrote JSON results to'))
+
+    def test_get_marker_trajectories(self):
+        positions, observed = get_marker_trajectories([{'a': np.ones(3)}, {'b': np.array([1.0, 2.0, 3.0])}], ['a', 'b'])
+        np.testing.assert_array_equal(observed, [[True, False], [False, True]])
+        np.testing.assert_array_equal(positions[0], [[1.0, 1.0, 1.0], [0.0, 0.0, 0.0]])
+        np.testing.assert_array_equal(positions[1], [[0.0, 0.0, 0.0], [1.0, 2.0, 3.0]])
+
+    def test_get_changed_frames(self):
+        values = np.array([[0.0, 1.0], [0.0, 1.0], [0.0, 2.0], [0.0, 2.0]])
+        np.testing.assert_array_equal(get_changed_frames(values), [True, False, True, False])
+
+    def test_save_segment_to_gui_replays_like_every_frame_rendering(self):
+        rng = np.random.default_rng(0)
+        num_frames = 60
+        marker_observations = []
+        for t in range(num_frames):
+            obs = {}
+            # A marker that's only seen sometimes, one that holds still for a while, and one that's always moving
+            if t % 7 not in (3, 4):
+                obs['flicker'] = rng.standard_normal(3)
+            obs['still'] = np.array([1.0, 2.0, 3.0]) if 10 <= t < 30 else rng.standard_normal(3)
+            obs['moving'] = rng.standard_normal(3)
+            # A marker that shows up partway through
+            if t >= 20:
+                obs['late'] = np.full(3, float(t // 10))
+            marker_observations.append(obs)
+        # One plate that's flat for a stretch, and one that has fewer frames than the markers
+        cops = [np.zeros(3) if 15 <= t < 40 else rng.standard_normal(3) for t in range(num_frames)]
+        forces = [np.array([0.0, 500.0, 0.0]) if 15 <= t < 40 else rng.standard_normal(3) for t in range(num_frames)]
+        force_plates = [ForcePlateMock(cops, forces),
+                        ForcePlateMock(cops[:40], forces[:40])]
+        kinematics_poses = rng.standard_normal((5, num_frames))
+        kinematics_poses[:, 20:35] = kinematics_poses[:, 20:21]
+        dynamics_poses = rng.standard_normal((5, num_frames))
+        trial = TrialMock(marker_observations, force_plates, [PassMock(kinematics_poses), PassMock(dynamics_poses)])
+
+        expected = RecordingGUIMock()
+        render_segment_every_frame(trial, expected, OpenSimMock(), OpenSimMock())
+        actual = RecordingGUIMock()
+        with mock.patch.object(nimble.server, 'GUIRecording', lambda: actual), \
+                contextlib.redirect_stdout(io.StringIO()):
+            save_segment_to_gui(trial, 'preview.bin', kinematics_pass_index=0, kinematics_osim=OpenSimMock(),
+                                dynamics_pass_index=1, dynamics_osim=OpenSimMock())
+
+        self.assertEqual(len(actual.frames), num_frames)
+        for t in range(num_frames):
+            # The same objects are visible, in the same places, on every frame
+            self.assertEqual(actual.frames[t], expected.frames[t], f'frame {t}')
+
+    def test_save_segment_columns(self):
+        timestamps = np.array([0.0, 0.01, 0.02])
+        values = np.array([1.5, -2.0, 3.25])
+        with tempfile.TemporaryDirectory() as temp_dir:
+            columns_path = os.path.join(temp_dir, 'data.bin')
+            save_segment_columns(columns_path, ['timestamp', 'q_pos'], [timestamps, values])
+            with open(columns_path, 'rb') as f:
+                raw = f.read()
+        header_length = int(np.frombuffer(raw[:4], dtype='<u4')[0])
+        header = json.loads(raw[4:4 + header_length].decode('utf-8'))
+        self.assertEqual(header, {'columns': ['timestamp', 'q_pos'], 'numRows': 3, 'dtype': 'float64'})
+        columns = np.frombuffer(raw[4 + header_length:], dtype='<f8').reshape((2, 3))
+        np.testing.assert_array_equal(columns[0], timestamps)
+        np.testing.assert_array_equal(columns[1], values)
+
+    def test_results_archive(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            results_dir = os.path.join(temp_dir, 'osim_results')
+            os.makedirs(os.path.join(results_dir, 'IK'))
+            with open(os.path.join(results_dir, 'IK', 'trial_ik.mot'), 'w') as f:
+                f.write('\n'.join(f'{i * 0.01}\t{i}' for i in range(1000)))
+            with open(os.path.join(results_dir, 'IK', 'trial_ik.pdf'), 'wb') as f:
+                f.write(b'%PDF' * 1000)
+
+            archive = ResultsArchive(os.path.join(temp_dir, 'osim_results.zip'), temp_dir, num_threads=2)
+            archive.add_folder(results_dir)
+            # Files that show up or change after the first pass get picked up by the next one
+            with open(os.path.join(results_dir, 'IK', 'trial_ik.mot'), 'a') as f:
+                f.write('\nchanged')
+            with open(os.path.join(results_dir, 'late.txt'), 'w') as f:
+                f.write('late')
+            archive.add_folder(results_dir)
+            archive_info = archive.close()
+            # The spooled members are cleaned up once they're in the archive
+            self.assertEqual(sorted(os.listdir(temp_dir)), ['osim_results', 'osim_results.zip'])
+
+            with open(os.path.join(temp_dir, 'osim_results.zip'), 'rb') as f:
+                data = f.read()
+            self.assertEqual(archive_info, {'size': len(data), 'sha256': hashlib.sha256(data).hexdigest()})
+            with zipfile.ZipFile(os.path.join(temp_dir, 'osim_results.zip')) as z:
+                self.assertIsNone(z.testzip())
+                for name in ['osim_results/IK/trial_ik.mot', 'osim_results/IK/trial_ik.pdf', 'osim_results/late.txt']:
+                    with open(os.path.join(temp_dir, name), 'rb') as f:
+                        self.assertEqual(z.read(name), f.read())
+                self.assertEqual(z.getinfo('osim_results/IK/trial_ik.mot').compress_type, zipfile.ZIP_DEFLATED)
+                # PDFs are already compressed, so they're stored as-is
+                self.assertEqual(z.getinfo('osim_results/IK/trial_ik.pdf').compress_type, zipfile.ZIP_STORED)
+
+    def test_results_archive_drops_deleted_files(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            results_dir = os.path.join(temp_dir, 'osim_results')
+            os.makedirs(os.path.join(results_dir, 'IK'))
+            for name in ['kept.txt', 'removed.txt', os.path.join('IK', 'removed.mot')]:
+                with open(os.path.join(results_dir, name), 'w') as f:
+                    f.write(name * 100)
+
+            archive = ResultsArchive(os.path.join(temp_dir, 'osim_results.zip'), temp_dir)
+            archive.add_folder(results_dir)
+            os.remove(os.path.join(results_dir, 'removed.txt'))
+            shutil.rmtree(os.path.join(results_dir, 'IK'))
+            archive.add_folder(results_dir)
+            # A file that's gone by the time it gets compressed is left out too. Hold up the compression thread, so
+            # the file is deleted before its turn comes.
+            unblock = threading.Event()
+            archive.executor.submit(unblock.wait)
+            with open(os.path.join(results_dir, 'late.txt'), 'w') as f:
+                f.write('late')
+            archive.add_file(os.path.join(results_dir, 'late.txt'))
+            os.remove(os.path.join(results_dir, 'late.txt'))
+            unblock.set()
+            archive.close()
+            self.assertEqual(sorted(os.listdir(temp_dir)), ['osim_results', 'osim_results.zip'])
+
+            with zipfile.ZipFile(os.path.join(temp_dir, 'osim_results.zip')) as z:
+                self.assertIsNone(z.testzip())
+                self.assertEqual(z.namelist(), ['osim_results/', 'osim_results/kept.txt'])
+
+    def test_results_archive_abort(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            results_dir = os.path.join(temp_dir, 'osim_results')
+            os.makedirs(results_dir)
+            for i in range(20):
+                with open(os.path.join(results_dir, f'{i}.txt'), 'w') as f:
+                    f.write(str(i) * 10000)
+
+            archive = ResultsArchive(os.path.join(temp_dir, 'osim_results.zip'), temp_dir, num_threads=2)
+            archive.add_folder(results_dir)
+            archive.abort()
+            # No archive gets written, and the spool files are cleaned up
+            self.assertEqual(os.listdir(temp_dir), ['osim_results'])
+
+    def test_write_b3d_files(self):
+        path = os.path.join(TEST_DATA_PATH, 'b3ds', 'falisse2017_small.b3d')
+        subject = nimble.biomechanics.SubjectOnDisk(path)
+        subject.loadAllFrames(doNotStandardizeForcePlateData=True)
+        num_trials = len(subject.getHeaderProto().getTrials())
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            b3d_fpath = os.path.join(temp_dir, 'subject.b3d')
+            dynamics_b3d_fpath = os.path.join(temp_dir, 'subject_dynamics_trials_only.b3d')
+            num_dynamics_trials = write_b3d_files(subject, b3d_fpath, dynamics_b3d_fpath)
+            self.assertEqual(num_dynamics_trials, sum(get_dynamics_trials(subject)))
+
+            # Writing the dynamics-only file must not filter the trials out of the working header
+            self.assertEqual(len(subject.getHeaderProto().getTrials()), num_trials)
+            self.assertEqual(nimble.biomechanics.SubjectOnDisk(b3d_fpath).getNumTrials(), num_trials)
+            if num_dynamics_trials > 0:
+                self.assertEqual(nimble.biomechanics.SubjectOnDisk(dynamics_b3d_fpath).getNumTrials(),
+                                 num_dynamics_trials)
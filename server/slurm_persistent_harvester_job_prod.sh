@@ -19,7 +19,7 @@ trap _resubmit SIGUSR1
 ml python/3.9.0
 ## Run the data harvester, in the background so that we don't lose the trap signal
 export PYTHONUNBUFFERED=1
-CERT_HOME="/home/users/keenon/certs" python3 ~/AddBiomechanics/server/app/data_harvester.py --bucket biomechanics-uploads83039-prod --deployment PROD || true &
+CERT_HOME="/home/users/keenon/certs" python3 ~/AddBiomechanics/server/app/data_harvester.py --bucket biomechanics-uploads83039-prod --deployment PROD --index_snapshot $SCRATCH/addb_index_snapshots/prod_harvester.sqlite || true &
 
 # Loop forever, printing the time
 # This has the advantage that even if the Python script crashes, the job will continue to run, and eventually be
@@ -23,7 +23,7 @@ curl -fsS -m 10 --retry 5 -o /dev/null https://hc-ping.com/29f8f84e-3b4e-4978-a0
 
 ## Run the mocap server, in SLURM mode, in the background so that we don't lose the trap signal
 export PYTHONUNBUFFERED=1
-CERT_HOME="/home/users/keenon/certs" python3 ~/AddBiomechanics/server/app/mocap_server.py --bucket biomechanics-uploads161949-dev --deployment DEV --singularity_image_path $GROUP_HOME/keenon/simg/biomechnet_dev_latest.sif || true &
+CERT_HOME="/home/users/keenon/certs" python3 ~/AddBiomechanics/server/app/mocap_server.py --bucket biomechanics-uploads161949-dev --deployment DEV --index_snapshot $SCRATCH/addb_index_snapshots/dev_mocap_server.sqlite --singularity_image_path $GROUP_HOME/keenon/simg/biomechnet_dev_latest.sif || true &
 # Loop forever, printing the time
 while true; do
     echo "$(date): normal execution"
@@ -23,7 +23,7 @@ curl -fsS -m 10 --retry 5 -o /dev/null https://hc-ping.com/71641412-3e27-4e70-87
 
 ## Run the mocap server, in SLURM mode, in the background so that we don't lose the trap signal
 export PYTHONUNBUFFERED=1
-CERT_HOME="/home/users/keenon/certs" python3 ~/AddBiomechanics/server/app/mocap_server.py --bucket biomechanics-uploads83039-prod --deployment PROD --singularity_image_path $GROUP_HOME/keenon/simg/biomechnet_prod_latest.sif || true &
+CERT_HOME="/home/users/keenon/certs" python3 ~/AddBiomechanics/server/app/mocap_server.py --bucket biomechanics-uploads83039-prod --deployment PROD --index_snapshot $SCRATCH/addb_index_snapshots/prod_mocap_server.sqlite --singularity_image_path $GROUP_HOME/keenon/simg/biomechnet_prod_latest.sif || true &
 # Loop forever, printing the time
 while true; do
     echo "$(date): normal execution"